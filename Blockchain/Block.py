@@ -5,10 +5,10 @@ import datetime
 
 class Block:
     def __init__(self, index: int, previous_hash: str, data: Dict, next_block: Optional['Block'],
-                 previous_block: Optional['Block']):
+                 previous_block: Optional['Block'], timestamp: Optional[datetime.datetime] = None):
         self.index = index
         self.previous_hash = previous_hash
-        self.timestamp = datetime.datetime.now()
+        self.timestamp = timestamp if timestamp is not None else datetime.datetime.now()
         self.data = data
         self.next_block = next_block
         self.previous_block = previous_block
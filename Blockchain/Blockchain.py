@@ -1,32 +1,49 @@
 from .Block import Block
 from .BlockchainNode import BlockchainNode
+from .Clock import Clock
+from .Metrics import MetricsRegistry, default_registry
+from .Profiling import default_profiler
+from .Tracing import Tracer, default_tracer
 from typing import List
+import threading
 
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, clock: Clock = None, metrics: MetricsRegistry = None, tracer: Tracer = None):
+        # every block of the chain is stamped with the time of this clock
+        self.clock = clock if clock is not None else Clock()
+        self.metrics = metrics if metrics is not None else default_registry
+        self.tracer = tracer if tracer is not None else default_tracer
+        # the chain the spans of its nodes are drawn on
+        self.name = "global"
         # create the first block
-        self.head: Block = Block(0, '0', {"type": "genesis"}, None, None)
+        self.head: Block = Block(0, '0', {"type": "genesis"}, None, None, self.clock.now())
         self.tail: Block = self.head
         self.length = 1
         self.nodes: List['BlockchainNode'] = []
         self.nodesCount = 0
-
-    def add_block(self, data: dict):
-        new_block = Block(self.length, self.tail.hash, data, None, self.tail)
-        self.tail.next_block = new_block
-        self.tail = new_block
-        self.length += 1
+        # nodes, forwarding threads and vehicles append concurrently
+        self.lock = threading.Lock()
+
+    def add_block(self, data: dict) -> Block:
+        with self.metrics.timer("block_append"), self.lock:
+            new_block = Block(self.length, self.tail.hash, data, None, self.tail, self.clock.now())
+            self.tail.next_block = new_block
+            self.tail = new_block
+            self.length += 1
+        self.metrics.counter("blocks_appended", type=data.get("type")).inc()
+        return new_block
 
     def validate_chain(self):
-        current = self.head
-        while current.next_block is not None:
-            if current.next_block.previous_hash != current.hash:
-                return False
-            if current.calc_hash() != current.hash:
-                return False
-            current = current.next_block
-        return True
+        with default_profiler.phase("validate"):
+            current = self.head
+            while current.next_block is not None:
+                if current.next_block.previous_hash != current.hash:
+                    return False
+                if current.calc_hash() != current.hash:
+                    return False
+                current = current.next_block
+            return True
 
     def __str__(self):
         return f"Blockchain with {self.length} blocks"
@@ -62,7 +79,7 @@ class Blockchain:
         return self.head != other.head or self.tail != other.tail
 
     def __add__(self, other):
-        new_blockchain = Blockchain()
+        new_blockchain = Blockchain(self.clock, self.metrics, self.tracer)
         for block in self:
             new_blockchain.add_block(block.data)
         for block in other:
@@ -1,13 +1,43 @@
-from typing import Dict
+from typing import Dict, Optional
 
 
 class BlockchainNode:
+    # how the node is named in traces
+    role = "node"
+
     def __init__(self, blockchain: 'Blockchain'):
         self.hash_to_edge: Dict = {}
         self.edge_to_hash: Dict = {}
         self.blockchain = blockchain
+        self.clock = blockchain.clock
+        self.metrics = blockchain.metrics
+        self.tracer = blockchain.tracer
+        # the trace id of the round this node is working on, only set while tracing
+        self.trace_id: Optional[str] = None
         self.node_id = blockchain.get_node_id()
         blockchain.add_node(self)
 
+    def trace_span(self, name: str, trace_id: Optional[str] = None, chain: Optional[str] = None, kind: str = "step",
+                   **args):
+        return self.tracer.span(self.clock, name, trace_id if trace_id is not None else self.trace_id,
+                                f"{self.role} {self.node_id}", chain if chain is not None else self.blockchain.name,
+                                kind, **args)
+
+    def trace_wait(self, block: 'Block', chain: Optional[str] = None, noticed=None):
+        # how long the block sat on its chain until this node noticed it
+        trace_id = block.data.get("trace_id")
+        if trace_id is None or not self.tracer.enabled:
+            return
+        self.tracer.record(f"wait {block.data['type']}", trace_id, block.timestamp,
+                           noticed if noticed is not None else self.clock.now(), f"{self.role} {self.node_id}",
+                           chain if chain is not None else self.blockchain.name, "wait")
+
+    def tag_trace(self, data: Dict, trace_id: Optional[str] = None) -> Dict:
+        # the blocks of a round carry its trace id so every node can attribute them
+        trace_id = trace_id if trace_id is not None else self.trace_id
+        if trace_id is not None:
+            data["trace_id"] = trace_id
+        return data
+
     def __str__(self):
         return f"Node {self.node_id} with {len(self.blockchain)} blocks"
@@ -0,0 +1,81 @@
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+
+class Clock:
+    """Wall clock time, used unless a simulation asks for virtual time."""
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def add_participant(self):
+        pass
+
+    def remove_participant(self):
+        pass
+
+    def __str__(self):
+        return "Wall clock"
+
+
+class VirtualClock(Clock):
+    """
+    A discrete event clock for the simulations.
+
+    Every thread that drives the simulation is a participant. A participant that sleeps is parked until virtual
+    time reaches its wake up time, and virtual time only moves when every participant is asleep, jumping straight
+    to the earliest wake up time. Sleeping therefore costs no real time while computation keeps its real cost.
+    """
+
+    # every reading moves time by one tick so that blocks created at the same instant keep their order
+    tick = datetime.timedelta(microseconds=1)
+
+    def __init__(self, start: datetime.datetime = None):
+        self._now = start if start is not None else datetime.datetime.now()
+        self._condition = threading.Condition()
+        self._participants = 0
+        self._sleeping = 0
+        self._wake_ups = []
+        self._sequence = itertools.count()
+
+    def now(self) -> datetime.datetime:
+        with self._condition:
+            self._now += self.tick
+            return self._now
+
+    def add_participant(self):
+        with self._condition:
+            self._participants += 1
+
+    def remove_participant(self):
+        with self._condition:
+            self._participants -= 1
+            self._advance_if_idle()
+
+    def sleep(self, seconds: float):
+        with self._condition:
+            wake_up = self._now + datetime.timedelta(seconds=seconds)
+            heapq.heappush(self._wake_ups, (wake_up, next(self._sequence)))
+            self._sleeping += 1
+            self._advance_if_idle()
+            while self._now < wake_up:
+                self._condition.wait()
+
+    def _advance_if_idle(self):
+        if not self._wake_ups or self._sleeping < self._participants:
+            return
+        self._now = max(self._now, self._wake_ups[0][0])
+        # the woken threads are counted as running right away, before they get the lock back
+        while self._wake_ups and self._wake_ups[0][0] <= self._now:
+            heapq.heappop(self._wake_ups)
+            self._sleeping -= 1
+        self._condition.notify_all()
+
+    def __str__(self):
+        return f"Virtual clock at {self._now}"
@@ -0,0 +1,73 @@
+import hashlib
+from typing import Dict, Optional
+
+from .Block import Block
+
+
+class FacilitatorPool:
+    """
+    The view of the facilitators on the global chain, rebuilt from the chain itself.
+
+    Every facilitator replays the same blocks in the same order, so all of them agree on which facilitator owns
+    a request: the one with the fewest open sessions, ties broken by a hash of the neighborhood and the
+    facilitator id.
+    """
+
+    def __init__(self, answer_block_type: str):
+        self.answer_block_type = answer_block_type
+        self.loads: Dict[int, int] = {}
+        self.served: Dict[int, int] = {}
+        self.assignments: Dict[str, int] = {}
+
+    @staticmethod
+    def _tie_break(neighborhood: str, facilitator_id: int) -> str:
+        return hashlib.sha256(f"{neighborhood}:{facilitator_id}".encode('utf-8')).hexdigest()
+
+    def choose_owner(self, neighborhood: str) -> Optional[int]:
+        if not self.loads:
+            return None
+        return min(self.loads, key=lambda facilitator_id: (self.loads[facilitator_id],
+                                                            self._tie_break(neighborhood, facilitator_id)))
+
+    def get_owner(self, neighborhood: str) -> Optional[int]:
+        return self.assignments.get(neighborhood)
+
+    def _release(self, neighborhood: str, served: bool):
+        owner = self.assignments.pop(neighborhood, None)
+        if owner is not None and owner in self.loads:
+            self.loads[owner] -= 1
+            if served:
+                self.served[owner] += 1
+
+    def apply(self, block: Block):
+        data = block.data
+        block_type = data["type"]
+        if block_type == "facilitator_joined":
+            self.loads.setdefault(data["facilitator"], 0)
+            self.served.setdefault(data["facilitator"], 0)
+        elif block_type == "facilitator_left":
+            self.loads.pop(data["facilitator"], None)
+            for neighborhood, owner in list(self.assignments.items()):
+                if owner == data["facilitator"]:
+                    del self.assignments[neighborhood]
+        elif block_type == "request_facilitator":
+            neighborhood = data["neighborhood"]
+            # a new request for the same neighborhood replaces an unfinished one
+            self._release(neighborhood, False)
+            owner = self.choose_owner(neighborhood)
+            if owner is not None:
+                self.assignments[neighborhood] = owner
+                self.loads[owner] += 1
+        elif block_type == self.answer_block_type:
+            self._release(data["neighborhood"], True)
+
+    def replay(self, first_block: Block, last_block: Block):
+        block = first_block
+        while block is not None:
+            self.apply(block)
+            if block is last_block:
+                break
+            block = block.next_block
+
+    def __str__(self):
+        return f"Facilitator pool with loads {self.loads}"
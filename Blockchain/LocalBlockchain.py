@@ -1,7 +1,12 @@
 from Blockchain.Blockchain import Blockchain
+from Blockchain.Clock import Clock
+from Blockchain.Metrics import MetricsRegistry
+from Blockchain.Tracing import Tracer
 
 
 class LocalBlockchain(Blockchain):
-    def __init__(self, neighborhood: str):
-        super().__init__()
+    def __init__(self, neighborhood: str, clock: Clock = None, metrics: MetricsRegistry = None,
+                 tracer: Tracer = None):
+        super().__init__(clock, metrics, tracer)
         self.neighborhood = neighborhood
+        self.name = f"local {neighborhood}"
@@ -0,0 +1,236 @@
+import sys
+import threading
+import tracemalloc
+import types
+from collections import deque
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .Block import Block
+from .Blockchain import Blockchain
+from .BlockchainNode import BlockchainNode
+from .Clock import Clock
+from .Metrics import MetricsRegistry
+from .Profiling import Profiler
+from .Tracing import Tracer
+
+# objects that are shared infrastructure or that reach the whole chain, never part of the size of a block or a node
+SKIPPED_TYPES = (Block, Blockchain, BlockchainNode, Clock, MetricsRegistry, Tracer, Profiler, threading.Thread,
+                 type(threading.Lock()), type(threading.RLock()), threading.Condition, threading.Event, type,
+                 types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+ATOMIC_TYPES = (str, bytes, bytearray, int, float, complex, bool, type(None))
+
+# the links of a block, following them would measure the whole chain
+BLOCK_LINKS = ("next_block", "previous_block")
+
+
+def deep_sizeof(obj, sizes: Optional[Dict[int, int]] = None, skip: Tuple[type, ...] = SKIPPED_TYPES) -> int:
+    """
+    The bytes of obj and of everything it references, as sys.getsizeof counts them.
+
+    Objects already in sizes (object id to bytes) are not counted again, so one sizes map across several calls
+    counts shared objects once and tells which objects the callers share.
+    """
+    if sizes is None:
+        sizes = {}
+    total = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in sizes or isinstance(current, skip):
+            continue
+        size = sys.getsizeof(current)
+        sizes[id(current)] = size
+        total += size
+        if isinstance(current, ATOMIC_TYPES):
+            continue
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset, deque)):
+            stack.extend(current)
+        else:
+            if hasattr(current, '__dict__'):
+                stack.append(vars(current))
+            for slot in getattr(type(current), '__slots__', ()):
+                if hasattr(current, slot):
+                    stack.append(getattr(current, slot))
+    return total
+
+
+def block_sizeof(block: Block, sizes: Optional[Dict[int, int]] = None) -> int:
+    if sizes is None:
+        sizes = {}
+    if id(block) in sizes:
+        return 0
+    total = sys.getsizeof(block) + sys.getsizeof(vars(block))
+    sizes[id(block)] = total
+    for name, value in vars(block).items():
+        if name not in BLOCK_LINKS:
+            total += deep_sizeof(value, sizes)
+    return total
+
+
+def chain_memory(blockchain: Blockchain) -> Tuple[Dict, Dict[int, int]]:
+    sizes: Dict[int, int] = {}
+    block_types: Dict[str, Dict[str, int]] = {}
+    total = 0
+    for block in blockchain:
+        size = block_sizeof(block, sizes)
+        total += size
+        entry = block_types.setdefault(block.data.get("type"), {"count": 0, "bytes": 0})
+        entry["count"] += 1
+        entry["bytes"] += size
+    report = {
+        "blocks": blockchain.length,
+        "bytes": total,
+        # what get_data_size reports, the length of the printed data
+        "data_size": blockchain.get_data_size(),
+        "block_types": block_types,
+    }
+    return report, sizes
+
+
+def node_memory(node: BlockchainNode) -> Dict:
+    sizes: Dict[int, int] = {}
+    attributes = {name: deep_sizeof(value, sizes) for name, value in vars(node).items()}
+    return {
+        "bytes": sum(attributes.values()),
+        "attributes": {name: size for name, size in sorted(attributes.items(), key=lambda item: -item[1]) if size},
+    }
+
+
+def node_label(node: BlockchainNode) -> str:
+    # node ids are given out per chain
+    return f"{node.blockchain.name} {node.role} {node.node_id}"
+
+
+def chain_names(chains: Sequence[Blockchain]) -> List[str]:
+    # the two blockchains scheme has two chains of the default name
+    names = []
+    for blockchain in chains:
+        name = blockchain.name
+        copies = sum(1 for other in names if other == name or other.startswith(name + " #"))
+        names.append(name if copies == 0 else f"{name} #{copies + 1}")
+    return names
+
+
+def memory_report(chains: Sequence[Blockchain], nodes: Optional[Sequence[BlockchainNode]] = None) -> Dict:
+    """Real bytes per chain, per block type of every chain and per node."""
+    if nodes is None:
+        nodes = []
+        for blockchain in chains:
+            nodes.extend(node for node in blockchain.nodes if all(node is not other for other in nodes))
+    chain_reports = {}
+    chain_sizes = {}
+    for blockchain, name in zip(chains, chain_names(chains)):
+        chain_reports[name], chain_sizes[name] = chain_memory(blockchain)
+    # blocks forwarded from one chain to the other share their payload
+    owners: Dict[int, int] = {}
+    for sizes in chain_sizes.values():
+        for object_id in sizes:
+            owners[object_id] = owners.get(object_id, 0) + 1
+    for name, sizes in chain_sizes.items():
+        chain_reports[name]["shared_bytes"] = sum(size for object_id, size in sizes.items() if owners[object_id] > 1)
+    union: Dict[int, int] = {}
+    for sizes in chain_sizes.values():
+        union.update(sizes)
+    return {
+        "chains": chain_reports,
+        "chains_total_bytes": sum(union.values()),
+        "nodes": {node_label(node): node_memory(node) for node in nodes},
+    }
+
+
+def simulation_chains(simulation) -> List[Blockchain]:
+    # every scheme keeps its chains as attributes of the simulation
+    chains = []
+    for value in vars(simulation).values():
+        if isinstance(value, Blockchain) and all(value is not chain for chain in chains):
+            chains.append(value)
+    return chains
+
+
+class MemoryAccountant:
+    """
+    Takes memory reports of a simulation over its rounds and tells how they grew.
+
+    With trace_allocations every snapshot also takes a tracemalloc snapshot, whose growth between the first and the
+    last snapshot is attributed to source lines. Node attributes that grew in every one of the last leak_window
+    snapshots are flagged as leaks, the chains themselves are expected to grow.
+    """
+
+    def __init__(self, simulation=None, chains: Optional[Sequence[Blockchain]] = None,
+                 trace_allocations: bool = True, leak_window: int = 3):
+        self.chains = list(chains) if chains is not None else simulation_chains(simulation)
+        self.trace_allocations = trace_allocations
+        self.leak_window = leak_window
+        self.snapshots: List[Tuple[str, Dict]] = []
+        self.allocation_snapshots: List[tracemalloc.Snapshot] = []
+        self.started_tracing = False
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def snapshot(self, label: str) -> Dict:
+        report = memory_report(self.chains)
+        if self.trace_allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            report["traced_bytes"] = current
+            report["traced_peak_bytes"] = peak
+            self.allocation_snapshots.append(tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            )))
+        self.snapshots.append((label, report))
+        return report
+
+    def growth(self) -> List[Dict]:
+        rows = []
+        for (_, previous), (label, report) in zip(self.snapshots, self.snapshots[1:]):
+            row = {"label": label, "chains": {}, "nodes": {}}
+            for name, chain in report["chains"].items():
+                before = previous["chains"].get(name, {"bytes": 0, "blocks": 0})
+                row["chains"][name] = {"bytes": chain["bytes"] - before["bytes"],
+                                       "blocks": chain["blocks"] - before["blocks"]}
+            for name, node in report["nodes"].items():
+                row["nodes"][name] = node["bytes"] - previous["nodes"].get(name, {"bytes": 0})["bytes"]
+            if "traced_bytes" in report:
+                row["traced_bytes"] = report["traced_bytes"] - previous["traced_bytes"]
+            rows.append(row)
+        return rows
+
+    def leaks(self) -> List[str]:
+        if len(self.snapshots) <= self.leak_window:
+            return []
+        findings = []
+        recent = [report for _, report in self.snapshots[-self.leak_window - 1:]]
+        for name, node in recent[-1]["nodes"].items():
+            for attribute in node["attributes"]:
+                sizes = [report["nodes"].get(name, {}).get("attributes", {}).get(attribute, 0) for report in recent]
+                if all(before < after for before, after in zip(sizes, sizes[1:])):
+                    findings.append(f"{name}.{attribute} grew in each of the last {self.leak_window} snapshots, "
+                                    f"{sizes[0]} to {sizes[-1]} bytes")
+        return findings
+
+    def allocation_growth(self, limit: int = 10) -> List[Dict]:
+        if len(self.allocation_snapshots) < 2:
+            return []
+        statistics = self.allocation_snapshots[-1].compare_to(self.allocation_snapshots[0], 'lineno')
+        return [{
+            "location": f"{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}",
+            "size_diff": statistic.size_diff,
+            "count_diff": statistic.count_diff,
+        } for statistic in statistics[:limit]]
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def to_dict(self) -> Dict:
+        return {
+            "snapshots": [{"label": label, **report} for label, report in self.snapshots],
+            "growth": self.growth(),
+            "leaks": self.leaks(),
+            "allocation_growth": self.allocation_growth(),
+        }
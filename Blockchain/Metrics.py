@@ -0,0 +1,229 @@
+import json
+import threading
+import time
+from typing import Dict, List, Tuple
+
+# every power of two is split into 2 ** SUB_BUCKET_BITS buckets, about 3% relative error
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value: int) -> int:
+    if value < 2 * SUB_BUCKET_COUNT:
+        return max(0, value)
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKET_COUNT + (value >> shift) - SUB_BUCKET_COUNT
+
+
+def bucket_bounds(index: int) -> Tuple[int, int]:
+    if index < 2 * SUB_BUCKET_COUNT:
+        return index, index
+    shift = index // SUB_BUCKET_COUNT - 1
+    mantissa = index % SUB_BUCKET_COUNT + SUB_BUCKET_COUNT
+    return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Histogram:
+    """Log-linear buckets in the style of HdrHistogram, values are integers such as nanoseconds."""
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def record(self, value: int):
+        index = bucket_index(value)
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def quantile(self, fraction: float) -> float:
+        if self.count == 0:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                lower, upper = bucket_bounds(index)
+                return min(max((lower + upper) / 2, self.min), self.max)
+        return self.max
+
+
+class _NullMetric:
+    # what a disabled registry hands out, every update is a no-op
+    value = 0
+    count = 0
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def record(self, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_METRIC = _NullMetric()
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.record(time.perf_counter_ns() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and latency histograms of the hot paths of the schemes.
+
+    A disabled registry hands out no-op metrics, so instrumented code costs one attribute check. Timers record
+    perf_counter_ns durations; they are exported in seconds.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics: Dict[Tuple[str, str, Tuple], object] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, kind: str, name: str, labels: Dict, factory):
+        key = (kind, name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, factory())
+        return metric
+
+    def counter(self, name: str, **labels) -> Counter:
+        if not self.enabled:
+            return NULL_METRIC
+        return self._get("counter", name, labels, Counter)
+
+    def gauge(self, name: str, **labels) -> Gauge:
+        if not self.enabled:
+            return NULL_METRIC
+        return self._get("gauge", name, labels, Gauge)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        if not self.enabled:
+            return NULL_METRIC
+        return self._get("histogram", name, labels, Histogram)
+
+    def timer(self, name: str, **labels):
+        if not self.enabled:
+            return NULL_METRIC
+        return _Timer(self._get("histogram", name, labels, Histogram))
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.metrics = {}
+
+    def _sorted_metrics(self) -> List:
+        return sorted(self.metrics.items(), key=lambda item: (item[0][1], item[0][2]))
+
+    def to_dict(self) -> Dict:
+        data = {"counters": [], "gauges": [], "histograms": []}
+        for (kind, name, labels), metric in self._sorted_metrics():
+            entry = {"name": name, "labels": dict(labels)}
+            if kind == "histogram":
+                entry.update({
+                    "count": metric.count,
+                    "sum_seconds": metric.sum / 1e9,
+                    "min_seconds": (metric.min or 0) / 1e9,
+                    "max_seconds": (metric.max or 0) / 1e9,
+                })
+                for fraction in QUANTILES:
+                    entry[f"p{fraction * 100:g}_seconds"] = metric.quantile(fraction) / 1e9
+            else:
+                entry["value"] = metric.value
+            data[kind + "s"].append(entry)
+        return data
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        typed = set()
+        for (kind, name, labels), metric in self._sorted_metrics():
+            if kind == "counter":
+                metric_name = name + "_total"
+            elif kind == "histogram":
+                metric_name = name + "_seconds"
+            else:
+                metric_name = name
+            if metric_name not in typed:
+                typed.add(metric_name)
+                lines.append(f"# TYPE {metric_name} {'summary' if kind == 'histogram' else kind}")
+            if kind == "histogram":
+                for fraction in QUANTILES:
+                    quantile_labels = _format_labels(labels + (("quantile", f"{fraction:g}"),))
+                    lines.append(f"{metric_name}{quantile_labels} {metric.quantile(fraction) / 1e9:g}")
+                lines.append(f"{metric_name}_sum{_format_labels(labels)} {metric.sum / 1e9:g}")
+                lines.append(f"{metric_name}_count{_format_labels(labels)} {metric.count}")
+            else:
+                lines.append(f"{metric_name}{_format_labels(labels)} {metric.value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+# used by every blockchain that is not given its own registry, disabled until someone enables it
+default_registry = MetricsRegistry(enabled=False)
@@ -0,0 +1,230 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+PHASES = ["ingest", "aggregate", "decrypt", "approve", "validate"]
+MODES = ["sampling", "deterministic"]
+
+
+class UnknownPhaseError(Exception):
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.message = f"Unknown profiling phase {phase}, the phases are {', '.join(PHASES)}"
+        super().__init__(self.message)
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._exit(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, profiler: 'Profiler'):
+        super().__init__(daemon=True)
+        self.profiler = profiler
+        self.stopped = threading.Event()
+
+    def run(self):
+        # real time on purpose, the virtual clock of a simulation does not pass while it computes
+        while not self.stopped.wait(self.profiler.interval):
+            self.profiler._sample()
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    """
+    Profiles the chosen phases of the schemes, ingest, aggregate, decrypt, approve and validate.
+
+    In sampling mode a thread samples the stacks of the threads inside a phase every interval seconds and the phases
+    are written as collapsed stacks for flamegraph.pl or speedscope. In deterministic mode every phase gets a cProfile
+    profile per thread, written as pstats files. Profilers hook into the interpreter, so there is one per process.
+    """
+
+    def __init__(self, phases: Sequence[str] = (), mode: str = "sampling", interval: float = 0.005):
+        for phase in phases:
+            if phase not in PHASES:
+                raise UnknownPhaseError(phase)
+        if mode not in MODES:
+            raise ValueError(f"unknown profiling mode {mode}")
+        self.phases = set(phases)
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        # thread ident to the phases it is inside of, outermost first
+        self.active: Dict[int, List[str]] = {}
+        self.samples: Dict[str, Dict[str, int]] = {}
+        self.profiles: Dict[Tuple[str, int], cProfile.Profile] = {}
+        self.calls: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+        self.sampler: Optional[_Sampler] = None
+
+    @staticmethod
+    def from_environment() -> 'Profiler':
+        # VANET_PROFILE=aggregate,decrypt or VANET_PROFILE=all
+        phases = [phase.strip() for phase in os.environ.get("VANET_PROFILE", "").split(",") if phase.strip()]
+        if phases == ["all"]:
+            phases = PHASES
+        return Profiler(phases, os.environ.get("VANET_PROFILE_MODE", "sampling"),
+                        float(os.environ.get("VANET_PROFILE_INTERVAL", "0.005")))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.phases)
+
+    def enable(self, phases: Sequence[str] = PHASES):
+        for phase in phases:
+            if phase not in PHASES:
+                raise UnknownPhaseError(phase)
+        self.phases = set(phases)
+
+    def disable(self):
+        self.phases = set()
+        self._stop_sampler()
+
+    def phase(self, name: str):
+        if name not in self.phases:
+            return NULL_PHASE
+        return _Phase(self, name)
+
+    def _enter(self, name: str):
+        ident = threading.get_ident()
+        with self.lock:
+            stack = self.active.setdefault(ident, [])
+            stack.append(name)
+            outermost = len(stack) == 1
+            if self.mode == "sampling" and self.sampler is None:
+                self.sampler = _Sampler(self)
+                self.sampler.start()
+        # only one cProfile profile can be active in a thread, nested phases count towards the outer one
+        if self.mode == "deterministic" and outermost:
+            profile = self.profiles.get((name, ident))
+            if profile is None:
+                profile = self.profiles.setdefault((name, ident), cProfile.Profile())
+            profile.enable()
+
+    def _exit(self, name: str, seconds: float):
+        ident = threading.get_ident()
+        with self.lock:
+            stack = self.active[ident]
+            stack.pop()
+            outermost = not stack
+            if outermost:
+                del self.active[ident]
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        if self.mode == "deterministic" and outermost:
+            self.profiles[(name, ident)].disable()
+
+    def _sample(self):
+        frames = sys._current_frames()
+        with self.lock:
+            active = [(ident, stack[0]) for ident, stack in self.active.items()]
+        for ident, phase in active:
+            frame = frames.get(ident)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            names.append(phase)
+            stack = ";".join(reversed(names))
+            counts = self.samples.setdefault(phase, {})
+            counts[stack] = counts.get(stack, 0) + 1
+
+    def _stop_sampler(self):
+        if self.sampler is not None:
+            self.sampler.stopped.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def reset(self):
+        self._stop_sampler()
+        with self.lock:
+            self.samples = {}
+            self.profiles = {}
+            self.calls = {}
+            self.seconds = {}
+
+    def summary(self) -> Dict[str, Dict]:
+        return {phase: {"calls": self.calls[phase], "seconds": self.seconds[phase],
+                        "samples": sum(self.samples.get(phase, {}).values())} for phase in sorted(self.calls)}
+
+    def collapsed_stacks(self, phase: str) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.samples.get(phase, {}).items()))
+
+    def stats(self, phase: str) -> Optional[pstats.Stats]:
+        profiles = [profile for (name, _), profile in self.profiles.items() if name == phase]
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def write(self, folder: str) -> List[str]:
+        """Writes every profiled phase to folder and returns the written paths."""
+        self._stop_sampler()
+        os.makedirs(folder, exist_ok=True)
+        paths = []
+        for phase in sorted(self.calls):
+            if self.mode == "sampling":
+                path = os.path.join(folder, f"{phase}.collapsed")
+                with open(path, 'w') as f:
+                    f.write(self.collapsed_stacks(phase))
+                paths.append(path)
+                continue
+            stats = self.stats(phase)
+            if stats is None:
+                continue
+            path = os.path.join(folder, f"{phase}.prof")
+            stats.dump_stats(path)
+            paths.append(path)
+            report = io.StringIO()
+            stats.stream = report
+            stats.sort_stats("cumulative").print_stats(30)
+            with open(os.path.join(folder, f"{phase}.txt"), 'w') as f:
+                f.write(report.getvalue())
+        path = os.path.join(folder, "phases.json")
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        paths.append(path)
+        return paths
+
+
+def progress_disabled() -> bool:
+    # progress bars cost time in the loops they wrap, so they are off while profiling or with VANET_PROGRESS=0
+    return default_profiler.enabled or os.environ.get("VANET_PROGRESS") == "0"
+
+
+# the profiler of this process, configured from VANET_PROFILE, VANET_PROFILE_MODE and VANET_PROFILE_INTERVAL
+default_profiler = Profiler.from_environment()
@@ -0,0 +1,184 @@
+import datetime
+import json
+import threading
+import uuid
+from typing import Dict, List, Optional
+
+from .Clock import Clock
+
+
+class Span:
+    def __init__(self, name: str, trace_id: Optional[str], start: datetime.datetime, end: datetime.datetime,
+                 node: str, chain: str, kind: str, args: Dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.start = start
+        self.end = end
+        self.node = node
+        self.chain = chain
+        # step, hop or wait
+        self.kind = kind
+        self.args = args
+
+    @property
+    def duration(self) -> float:
+        return (self.end - self.start).total_seconds()
+
+    def __str__(self):
+        return f"Span {self.name} of {self.node} on {self.chain} for {self.duration} seconds"
+
+
+class _SpanContext:
+    def __init__(self, tracer: 'Tracer', clock: Clock, name: str, trace_id: Optional[str], node: str, chain: str,
+                 kind: str, args: Dict):
+        self.tracer = tracer
+        self.clock = clock
+        self.name = name
+        self.trace_id = trace_id
+        self.node = node
+        self.chain = chain
+        self.kind = kind
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = self.clock.now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add(Span(self.name, self.trace_id, self.start, self.clock.now(), self.node, self.chain, self.kind,
+                             self.args))
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    Spans of the protocol rounds, grouped by the trace id every block of a round carries.
+
+    Steps are the protocol steps of a node, hops are blocks carried from one chain to the other and waits are the
+    time a block sat on a chain before the node responsible for it noticed it. Spans are taken on the clock of the
+    chains, so on a virtual clock they show virtual time. A disabled tracer records nothing and adds no trace ids.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+
+    def new_trace_id(self) -> Optional[str]:
+        if not self.enabled:
+            return None
+        return uuid.uuid4().hex[:16]
+
+    def add(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+
+    def span(self, clock: Clock, name: str, trace_id: Optional[str], node: str, chain: str, kind: str = "step",
+             **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return _SpanContext(self, clock, name, trace_id, node, chain, kind, args)
+
+    def record(self, name: str, trace_id: Optional[str], start: datetime.datetime, end: datetime.datetime, node: str,
+               chain: str, kind: str = "step", **args):
+        if not self.enabled:
+            return
+        self.add(Span(name, trace_id, start, end, node, chain, kind, args))
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.spans = []
+
+    def trace_ids(self) -> List[str]:
+        # in the order the rounds started
+        first_starts: Dict[str, datetime.datetime] = {}
+        for span in self.spans:
+            if span.trace_id is not None and (span.trace_id not in first_starts or
+                                              span.start < first_starts[span.trace_id]):
+                first_starts[span.trace_id] = span.start
+        return sorted(first_starts, key=first_starts.get)
+
+    def waterfall(self, trace_id: str) -> List[Dict]:
+        spans = sorted((span for span in self.spans if span.trace_id == trace_id), key=lambda span: span.start)
+        if not spans:
+            return []
+        origin = spans[0].start
+        return [{
+            "name": span.name,
+            "kind": span.kind,
+            "node": span.node,
+            "chain": span.chain,
+            "offset_seconds": (span.start - origin).total_seconds(),
+            "duration_seconds": span.duration,
+        } for span in spans]
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        # total seconds per span name of every round
+        rounds: Dict[str, Dict[str, float]] = {}
+        for span in self.spans:
+            if span.trace_id is None:
+                continue
+            names = rounds.setdefault(span.trace_id, {})
+            names[span.name] = names.get(span.name, 0.0) + span.duration
+        return rounds
+
+    def to_chrome_trace(self) -> Dict:
+        """Trace event JSON for chrome://tracing and Perfetto, one process per chain and one thread per node."""
+        spans = sorted(self.spans, key=lambda span: span.start)
+        events = []
+        if not spans:
+            return {"traceEvents": events, "displayTimeUnit": "ms"}
+        origin = spans[0].start
+        process_ids: Dict[str, int] = {}
+        thread_ids: Dict[tuple, int] = {}
+        for span in spans:
+            if span.chain not in process_ids:
+                process_ids[span.chain] = len(process_ids) + 1
+                events.append({"name": "process_name", "ph": "M", "pid": process_ids[span.chain], "tid": 0,
+                               "args": {"name": span.chain}})
+            if (span.chain, span.node) not in thread_ids:
+                thread_ids[(span.chain, span.node)] = len(thread_ids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": process_ids[span.chain],
+                               "tid": thread_ids[(span.chain, span.node)], "args": {"name": span.node}})
+            args = {"trace_id": span.trace_id}
+            args.update(span.args)
+            events.append({
+                "name": span.name,
+                "cat": span.kind,
+                "ph": "X",
+                "ts": (span.start - origin).total_seconds() * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": process_ids[span.chain],
+                "tid": thread_ids[(span.chain, span.node)],
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_chrome_trace())
+
+    def write_chrome_trace(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+# used by every blockchain that is not given its own tracer, disabled until someone enables it
+default_tracer = Tracer(enabled=False)
@@ -2,6 +2,7 @@
 __version__ = '1.0'
 
 # the __all__ should contain all the modules of the package
-__all__ = ['Blockchain', 'Block', 'BlockchainNode', 'LocalBlockchain']
+__all__ = ['Blockchain', 'Block', 'BlockchainNode', 'LocalBlockchain', 'FacilitatorPool', 'Clock', 'Metrics', 'Tracing',
+           'Profiling', 'Memory']
 
 
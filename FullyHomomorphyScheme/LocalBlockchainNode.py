@@ -1,13 +1,14 @@
 from tqdm import tqdm
 from Blockchain import Blockchain, LocalBlockchain
 import networkx.readwrite.gml as gml
-from typing import Dict, Tuple, Optional
-from utils import calc_edge_hash, b64_enc, b64_dec
+from typing import Dict, Tuple, Optional, List
+from utils import calc_edge_hash, b64_enc, b64_dec, encode_edge_bitmap, decode_edge_bitmap, \
+    encode_ordinal_traffic, decode_ordinal_traffic
 import datetime
 from Blockchain.BlockchainNode import BlockchainNode
+from Blockchain.Profiling import default_profiler, progress_disabled
 from PartialHomomorphyScheme.GlobalBlockchainNode import GlobalBlockchainNode
 from enum import Enum
-from time import sleep
 import threading
 import random
 import tenseal as ts
@@ -26,6 +27,10 @@ class NeighborHoodState(Enum):
     DECRYPTION_RESULT_RECEIVED = 10
 
 
+def encrypt_speed(context: ts.Context, speed: int) -> str:
+    return b64_enc(ts.bfv_vector(context, [speed]).serialize())
+
+
 class StreetMapAlreadyInBlockchainError(Exception):
     def __init__(self, block_index: int):
         message = "Street map is already in the blockchain at block with index " + str(block_index)
@@ -54,8 +59,11 @@ class IncorrectStateForAction(Exception):
 
 
 class LocalBlockchainNode(BlockchainNode):
+    role = "local node"
+
     def __init__(self, local_blockchain: LocalBlockchain, global_blockchain: Optional[Blockchain] = None,
-                 sleep_time: float = 0.2, update_interval: int = 10, quiet=False):
+                 sleep_time: float = 0.2, update_interval: int = 10, quiet=False, sparse: bool = False,
+                 ordinal_encoding: bool = False):
         # local blockchain node is primarily a local blockchain node, but it can also be a global blockchain node too
         neighborhood = local_blockchain.neighborhood
         BlockchainNode.__init__(self, local_blockchain)
@@ -65,14 +73,16 @@ class LocalBlockchainNode(BlockchainNode):
         self.street_graph = gml.read_gml("./graphs/" + neighborhood + ".gml")
         self.street_graph_edges_forward: Dict = {}
         self.street_graph_edges_backward: Dict = {}
+        self.street_graph_edge_ordinals: Dict[str, int] = {}
         self.add_street_data_to_node()
         self.state: NeighborHoodState = NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT
         self.state_lock = threading.Lock()
-        self.last_state_update: datetime.datetime = datetime.datetime.now()
+        self.last_state_update: datetime.datetime = self.clock.now()
         self.facilitator_ctx: ts.Context = None
         self.facilitator_response_time = None
         self.encrypted_data = None
         self.state_thread = threading.Thread(target=self.update_state_periodically)
+        self.last_forwarded_global_block = global_blockchain.tail if global_blockchain is not None else None
         self.forwarding_thread = threading.Thread(target=self.forward_related_blocks_periodically)
         self.system_running = True
         self.debug = False
@@ -93,32 +103,48 @@ class LocalBlockchainNode(BlockchainNode):
         self.aggregation_time = None
         self.sleep_time = sleep_time
         self.update_interval = update_interval  # in seconds
+        # in sparse mode only edges that received logs are encrypted and published
+        self.sparse = sparse
+        # traffic blocks refer to edges by their ordinal in the street_graph block instead of their hash
+        self.ordinal_encoding = ordinal_encoding
 
     def run_threaded(self):
         if self.global_node is not None:
+            self.clock.add_participant()
             self.forwarding_thread.start()
+            self.clock.add_participant()
             self.state_thread.start()
             return [self.state_thread, self.forwarding_thread]
         else:
+            self.clock.add_participant()
             self.state_thread.start()
             return self.state_thread
 
     def update_state_periodically(self):
-        while self.system_running:
-            self.update_state()
-            sleep(self.sleep_time)
+        try:
+            while self.system_running:
+                self.update_state()
+                self.clock.sleep(self.sleep_time)
+        finally:
+            self.clock.remove_participant()
 
     def forward_related_blocks_periodically(self):
-        while self.system_running:
-            self.forward_global_related_blocks()
-            sleep(self.sleep_time)
+        try:
+            while self.system_running:
+                self.forward_global_related_blocks()
+                self.clock.sleep(self.sleep_time)
+        finally:
+            self.clock.remove_participant()
 
     def update_state(self):
         self.state_lock.acquire()
+        previous_state = self.state
         block = self.blockchain.tail
         if block is None:
             self.state = NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT
         block_type = block.data["type"]
+        if block.data.get("trace_id") is not None:
+            self.trace_id = block.data["trace_id"]
         if block_type == "request_facilitator":
             if self.state == NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT:
                 if not self.quiet:
@@ -133,7 +159,7 @@ class LocalBlockchainNode(BlockchainNode):
             self.update_facilitator_data(block)
         elif self.state == NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
             if self.facilitator_response_time + datetime.timedelta(
-                    seconds=self.update_interval) < datetime.datetime.now():
+                    seconds=self.update_interval) < self.clock.now():
                 if self.state == NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
                     if not self.quiet:
                         print(
@@ -185,13 +211,22 @@ class LocalBlockchainNode(BlockchainNode):
                 if not self.quiet:
                     print(f"Local node {self.node_id}: Results {block_type}.")
             self.state = NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT
+        if self.state != previous_state:
+            self.metrics.counter("state_transitions", scheme="fully", state=self.state.name).inc()
+            if self.state == NeighborHoodState.ENC_AVERAGE_TRAFFIC_CALCULATION_TIME_REACHED:
+                # step 3 has no block of its own, its span is the window the logs were taken in
+                self.tracer.record("3 traffic logs", self.trace_id, self.facilitator_response_time, self.clock.now(),
+                                   f"{self.role} {self.node_id}", self.blockchain.name)
+            else:
+                self.trace_wait(block)
         self.state_lock.release()
 
     def forward_raw_traffic(self, data):
         if self.global_node is None:
             raise IsNotGlobalNodeError
         data["neighborhood"] = self.neighborhood
-        self.global_blockchain.add_block(data)
+        with self.trace_span("forward_raw_traffic", chain=self.global_blockchain.name, kind="hop"):
+            self.global_blockchain.add_block(data)
 
     def forward_global_block(self, block):
         if self.global_node is None:
@@ -201,20 +236,32 @@ class LocalBlockchainNode(BlockchainNode):
     def forward_global_related_blocks(self):
         if self.global_node is None:
             raise IsNotGlobalNodeError
-        block = self.global_node.blockchain.tail
+        # walk every global block added since the last call so blocks of other neighborhoods cannot hide ours
+        while self.last_forwarded_global_block.next_block is not None:
+            block = self.last_forwarded_global_block.next_block
+            self.last_forwarded_global_block = block
+            self.forward_global_related_block(block)
+
+    def forward_global_related_block(self, block):
         global_block_type = block["type"]
         if "neighborhood" not in block.data or block.data["neighborhood"] != self.neighborhood:
             return
         self.update_state()
         state = self.state
         if state == NeighborHoodState.FACILITATOR_REQUEST_SENT and global_block_type == "facilitator_accepted_request":
-            self.forward_global_block(block.data)
+            self.forward_traced_global_block(block)
         elif state == NeighborHoodState.DECRYPTION_REQUEST_SENT and global_block_type == "decrypted_data":
-            self.forward_global_block(block.data)
+            self.forward_traced_global_block(block)
         else:
             return
         self.update_state()
 
+    def forward_traced_global_block(self, block):
+        self.trace_wait(block, chain=self.global_blockchain.name)
+        with self.trace_span("forward_global_related_blocks", block.data.get("trace_id"), kind="hop",
+                             block_type=block.data["type"]):
+            self.forward_global_block(block.data)
+
     def __str__(self):
         if self.global_node is None:
             return f"Local Node {self.node_id}"
@@ -237,6 +284,9 @@ class LocalBlockchainNode(BlockchainNode):
             "edges": list(self.street_graph_edges_forward.keys())
         }
         self.blockchain.add_block(street_graph_edges_block)
+        if self.global_node is not None:
+            # the approved blocks forwarded to the global chain refer to these edges by ordinal
+            self.forward_raw_traffic(dict(street_graph_edges_block))
         return street_graph_edges_block
 
     def add_street_data_to_node(self):
@@ -245,6 +295,8 @@ class LocalBlockchainNode(BlockchainNode):
             edge_hash = calc_edge_hash(edge)
             self.street_graph_edges_forward[edge_hash] = edge
             self.street_graph_edges_backward[edge] = edge_hash
+        self.street_graph_edge_ordinals = {edge_hash: ordinal
+                                           for ordinal, edge_hash in enumerate(self.street_graph_edges_forward)}
 
     # step 1
     def request_facilitating(self):
@@ -253,12 +305,16 @@ class LocalBlockchainNode(BlockchainNode):
             raise IncorrectStateForAction(self.state, "request_facilitating")
         if self.global_node is None:
             raise
-        request_facilitator_block = {
+        # every round gets its own trace id, carried by all of its blocks
+        self.trace_id = self.tracer.new_trace_id()
+        request_facilitator_block = self.tag_trace({
             "type": "request_facilitator",
             "neighborhood": self.neighborhood
-        }
-        self.global_node.blockchain.add_block(request_facilitator_block)
-        self.blockchain.add_block(request_facilitator_block)
+        })
+        with self.trace_span("1 request facilitator"):
+            # the local chain has to know about the request before the facilitator can answer it
+            self.blockchain.add_block(request_facilitator_block)
+            self.global_node.blockchain.add_block(request_facilitator_block)
         return request_facilitator_block
 
     # step 2 is handled by the facilitator
@@ -268,16 +324,20 @@ class LocalBlockchainNode(BlockchainNode):
         self.update_state()
         if self.state != NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
             raise IncorrectStateForAction(self.state, "send_encrypted_traffic_log")
-        edge_hash = self.street_graph_edges_backward[edge]
         start = datetime.datetime.now()
-        ciphertext = b64_enc(ts.bfv_vector(self.facilitator_ctx, [speed]).serialize())
+        with self.metrics.timer("log_encryption", scheme="fully"):
+            ciphertext = encrypt_speed(self.facilitator_ctx, speed)
+        end = datetime.datetime.now()
+        self.log_encryption_time = end - start
+        return self.add_encrypted_log(edge, ciphertext)
+
+    def add_encrypted_log(self, edge, ciphertext: str):
+        # the speed is encrypted by the caller, e.g. in another process
         traffic_speed_block = {
             "type": "encrypted_log",
-            "edge_hash": edge_hash,
+            "edge_hash": self.street_graph_edges_backward[edge],
             "speed": ciphertext
         }
-        end = datetime.datetime.now()
-        self.log_encryption_time = end - start
         self.blockchain.add_block(traffic_speed_block)
         self.log_size = len(str(traffic_speed_block))
         return traffic_speed_block
@@ -310,12 +370,54 @@ class LocalBlockchainNode(BlockchainNode):
 
     def _calculate_neighborhood_encrypted_traffic_data(self):
         traffic = {}
-        for edge in tqdm(self.street_graph.edges):
+        for edge in tqdm(self.street_graph.edges, disable=progress_disabled()):
             speeds, sqspeeds, count = self._get_edge_data(edge)
             self.speeds_count_per_street[edge] = count
             traffic[calc_edge_hash(edge)] = (b64_enc(speeds.serialize()), b64_enc(sqspeeds.serialize()))
         return traffic
 
+    def _collect_encrypted_logs(self) -> Dict[str, List[str]]:
+        # a single pass over the logs of this round, grouped by edge hash
+        logs: Dict[str, List[str]] = {}
+        block = self.blockchain.tail
+        while block is not None and block.timestamp > self.facilitator_response_time:
+            if block.data["type"] == "encrypted_log":
+                logs.setdefault(block.data["edge_hash"], []).append(block.data["speed"])
+            block = block.previous_block
+        return logs
+
+    def _calculate_neighborhood_sparse_encrypted_traffic_data(self):
+        logs = self._collect_encrypted_logs()
+        self.speeds_count_per_street = {}
+        observed_edges = []
+        traffic = []
+        for ordinal, edge in enumerate(self.street_graph.edges):
+            edge_logs = logs.get(self.street_graph_edges_backward[edge], [])
+            self.speeds_count_per_street[edge] = len(edge_logs)
+            if not edge_logs:
+                continue
+            speeds = ts.bfv_vector(self.facilitator_ctx, [self.error])
+            sqspeeds = ts.bfv_vector(self.facilitator_ctx, [self.error])
+            for ciphertext in edge_logs:
+                speed = ts.bfv_vector_from(self.facilitator_ctx, b64_dec(ciphertext))
+                speeds += speed
+                sqspeeds += speed * speed
+            observed_edges.append(ordinal)
+            traffic.append((b64_enc(speeds.serialize()), b64_enc(sqspeeds.serialize())))
+        return observed_edges, traffic
+
+    def decode_traffic(self, data: Dict, traffic_key: str = "traffic") -> Dict:
+        # readers get an edge hash keyed map whatever encoding the block uses
+        if "edges" in data:
+            return decode_ordinal_traffic(data["edges"], data[traffic_key], list(self.street_graph_edges_forward))
+        if data.get("sparse") and "observed_edges" in data:
+            return self._expand_sparse_traffic(data["observed_edges"], data[traffic_key])
+        return data[traffic_key]
+
+    def _expand_sparse_traffic(self, observed_edges: str, values: List) -> Dict[str, Tuple[int, int]]:
+        edge_hashes = list(self.street_graph_edges_forward.keys())
+        return {edge_hashes[ordinal]: value for ordinal, value in zip(decode_edge_bitmap(observed_edges), values)}
+
     def add_traffic_to_chains(self):
         self.update_state()
         if self.state == NeighborHoodState.ENC_AVERAGE_TRAFFIC_CALCULATION_TIME_REACHED:
@@ -325,18 +427,32 @@ class LocalBlockchainNode(BlockchainNode):
         else:
             raise IncorrectStateForAction(self.state, "add_traffic_to_localchain")
 
+        with self.trace_span("4 first aggregation" if self.first_node else "5 second aggregation"):
+            self._aggregate_traffic_to_chains()
+
+    def _aggregate_traffic_to_chains(self):
         self.generate_parameters()
 
         start = datetime.datetime.now()
-        traffic = self._calculate_neighborhood_encrypted_traffic_data()
+        with self.metrics.timer("aggregation", scheme="fully"), default_profiler.phase("aggregate"):
+            if self.sparse:
+                observed_edges, traffic = self._calculate_neighborhood_sparse_encrypted_traffic_data()
+            else:
+                traffic = self._calculate_neighborhood_encrypted_traffic_data()
         end = datetime.datetime.now()
         self.aggregation_time = end - start
         if not self.quiet:
             print(f"Local node {self.node_id}: Calculated encrypted traffic data in {end - start} seconds")
-        traffic_block = {
+        traffic_block = self.tag_trace({
             "type": "f_a_encrypted" if self.first_node else "f_b_encrypted",
             "traffic": traffic
-        }
+        })
+        if self.sparse:
+            traffic_block["sparse"] = True
+            traffic_block["observed_edges"] = encode_edge_bitmap(observed_edges, len(self.street_graph_edges_forward))
+        elif self.ordinal_encoding:
+            traffic_block["edges"], traffic_block["traffic"] = encode_ordinal_traffic(traffic,
+                                                                                     self.street_graph_edge_ordinals)
         self.blockchain.add_block(traffic_block)
         traffic_block["neighborhood"] = self.neighborhood
         length = len(str(traffic_block))
@@ -350,16 +466,17 @@ class LocalBlockchainNode(BlockchainNode):
         self.update_state()
         if self.state != NeighborHoodState.SECOND_NODE_AGGREGATED_DATA and self.state != NeighborHoodState.FIRST_NODE_PARAMETERS_SENT:
             raise IncorrectStateForAction(self.state, "approve_traffic_encrypted")
-        if self.first_node:
-            self.blockchain.add_block({
-                "type": "first_node_parameters",
-                "a": self.error
-            })
-        else:
-            self.blockchain.add_block({
-                "type": "second_node_parameters",
-                "b": self.error,
-            })
+        with self.trace_span("6 first parameters" if self.first_node else "7 second parameters"):
+            if self.first_node:
+                self.blockchain.add_block(self.tag_trace({
+                    "type": "first_node_parameters",
+                    "a": self.error
+                }))
+            else:
+                self.blockchain.add_block(self.tag_trace({
+                    "type": "second_node_parameters",
+                    "b": self.error,
+                }))
 
     # ============== end of step 6&7 ==============
 
@@ -370,12 +487,13 @@ class LocalBlockchainNode(BlockchainNode):
         self.update_state()
         if self.state != NeighborHoodState.SECOND_NODE_PARAMETERS_SENT:
             raise IncorrectStateForAction(self.state, "send_decryption_request")
-        data = {
+        data = self.tag_trace({
             "type": "send_decryption",
-        }
-        self.blockchain.add_block(data)
-        data["neighborhood"] = self.neighborhood
-        self.global_node.blockchain.add_block(data)
+        })
+        with self.trace_span("8 decryption request"):
+            self.blockchain.add_block(data)
+            data["neighborhood"] = self.neighborhood
+            self.global_node.blockchain.add_block(data)
 
     # ============== end of step 8 ==============
 
@@ -387,7 +505,7 @@ class LocalBlockchainNode(BlockchainNode):
     def count_edge_logs(self):
         if len(self.speeds_count_per_street):
             return
-        for edge in tqdm(self.street_graph.edges):
+        for edge in tqdm(self.street_graph.edges, disable=progress_disabled()):
             edge_hash = self.street_graph_edges_backward[edge]
             block = self.blockchain.tail
             count = 0
@@ -401,18 +519,21 @@ class LocalBlockchainNode(BlockchainNode):
         self.update_state()
         if self.state != NeighborHoodState.DECRYPTION_RESULT_RECEIVED:
             raise IncorrectStateForAction(self.state, "approve_results")
+        with self.trace_span("10 approve"), default_profiler.phase("approve"):
+            return self._approve_decrypted_traffic()
 
+    def _approve_decrypted_traffic(self):
         self.count_edge_logs()
 
         decrypted_traffic = {}
-        for key, value in tqdm(self.f_a.items()):
+        for key, value in tqdm(self.f_a.items(), disable=progress_disabled()):
             speed, speed_sq = value
             if key not in self.f_b:
                 if not self.quiet:
                     print(f'key {key} not in f_b_encrypted')
-                self.blockchain.add_block({
+                self.blockchain.add_block(self.tag_trace({
                     "type": "disapproved"
-                })
+                }))
                 return False
             # for speed
             speed, speed_sq = speed - self.a, speed_sq - self.a
@@ -421,27 +542,37 @@ class LocalBlockchainNode(BlockchainNode):
             if speed != speed2 or speed_sq != speed_sq2:
                 if not self.quiet:
                     print(f'data from node one and two do not match')
-                self.blockchain.add_block({
+                self.blockchain.add_block(self.tag_trace({
                     "type": "disapproved"
-                })
+                }))
                 return False
             n = self.speeds_count_per_street[self.street_graph_edges_forward[key]]
             average = speed / n
             variance = speed_sq - speed * speed / n
             decrypted_traffic[key] = average, variance
 
-        for key, value in tqdm(self.f_b.items()):
+        for key, value in tqdm(self.f_b.items(), disable=progress_disabled()):
             if key not in self.f_a:
                 print(f'key {key} not in f_a_encrypted')
-                self.blockchain.add_block({
+                self.blockchain.add_block(self.tag_trace({
                     "type": "disapproved"
-                })
+                }))
                 return False
 
-        self.blockchain.add_block({
+        if self.sparse:
+            # edges without logs were never encrypted, their default is filled in plaintext
+            for key in self.street_graph_edges_forward:
+                if key not in decrypted_traffic:
+                    decrypted_traffic[key] = self.max_speed, 0
+
+        approved_block = {
             "type": "approved",
             "traffic": decrypted_traffic
-        })
+        }
+        if self.ordinal_encoding:
+            approved_block["edges"], approved_block["traffic"] = encode_ordinal_traffic(decrypted_traffic,
+                                                                                        self.street_graph_edge_ordinals)
+        self.blockchain.add_block(self.tag_trace(approved_block))
         if not self.quiet:
             print(f"Local node {self.node_id}: Results approved.")
         self.decrypted_traffic = decrypted_traffic
@@ -456,3 +587,10 @@ class LocalBlockchainNode(BlockchainNode):
     def save_traffic(self, block):
         self.f_a = block.data["f_a"]
         self.f_b = block.data["f_b"]
+        if block.data.get("sparse"):
+            self.f_a = self._expand_sparse_traffic(block.data["f_a_observed_edges"], self.f_a)
+            self.f_b = self._expand_sparse_traffic(block.data["f_b_observed_edges"], self.f_b)
+        elif "f_a_edges" in block.data:
+            edge_hashes = list(self.street_graph_edges_forward)
+            self.f_a = decode_ordinal_traffic(block.data["f_a_edges"], self.f_a, edge_hashes)
+            self.f_b = decode_ordinal_traffic(block.data["f_b_edges"], self.f_b, edge_hashes)
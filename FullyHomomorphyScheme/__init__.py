@@ -10,7 +10,7 @@ from Blockchain import Blockchain
 
 # the __all__ should contain all the modules of the package
 __all__ = ['LocalBlockchain', 'GlobalBlockchainNode', 'LocalBlockchainNode']
-__all__ += ['NeighborHoodState', 'GlobalBlockchainNodeState']
+__all__ += ['NeighborHoodState', 'GlobalBlockchainNodeState', 'FacilitatorSession']
 __all__ += ['StreetMapAlreadyInBlockchainError', 'TrafficAlreadyApprovedError', 'IsNotGlobalNodeError',
             'IncorrectStateForAction']
 __all__ += ['Simulation']
@@ -1,9 +1,11 @@
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Optional, List, Union
+from Blockchain.Block import Block
 from Blockchain.Blockchain import Blockchain
 from Blockchain.BlockchainNode import BlockchainNode
+from Blockchain.FacilitatorPool import FacilitatorPool
+from Blockchain.Profiling import default_profiler
 from phe import paillier
 from enum import Enum
-from time import sleep
 import datetime
 import threading
 
@@ -22,14 +24,48 @@ class InvalidStateError(Exception):
         self.message = f'Cannot perform action {action} while in state {state}'
 
 
+class FacilitatorSession:
+    """The state of one facilitating round for one neighborhood."""
+
+    def __init__(self, neighborhood: str, round_number: int):
+        self.neighborhood = neighborhood
+        self.round = round_number
+        self.state = GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC
+        self.f_ab_decrypted_average_traffic: Dict[str, float] = {}
+        self.f_cd_decrypted_average_traffic: Dict[str, float] = {}
+        # set when the aggregators publish only the edges that received logs
+        self.sparse = False
+        self.f_ab_observed_edges: Optional[str] = None
+        self.f_cd_observed_edges: Optional[str] = None
+        # packed edge ordinals of blocks that use the ordinal encoding
+        self.f_ab_edges: Optional[str] = None
+        self.f_cd_edges: Optional[str] = None
+        self.first_decryption_time: Optional[datetime.timedelta] = None
+        self.second_decryption_time: Optional[datetime.timedelta] = None
+        self.decryption_block_size = 0
+        # the trace id carried by the request of this round
+        self.trace_id: Optional[str] = None
+
+    def __str__(self):
+        return f"Session for neighborhood {self.neighborhood} round {self.round} in state {self.state}"
+
+
 class GlobalBlockchainNode(BlockchainNode):
+    role = "facilitator"
+
     def __init__(self, blockchain: Blockchain, sleep_time: float = 0.2, traffic_update_interval_in_seconds: int = 10,
                  quiet=False, key_size=2048):
         super().__init__(blockchain)
-        self.f_ab_decrypted_average_traffic: Dict[str, float] = {}
-        self.f_cd_decrypted_average_traffic: Dict[str, float] = {}
         self.key_pair = paillier.generate_paillier_keypair(n_length=key_size)
-        self.state = GlobalBlockchainNodeState.IDLE
+        # sessions are keyed by neighborhood, each session carries its own round number
+        self.sessions: Dict[str, FacilitatorSession] = {}
+        self.rounds: Dict[str, int] = {}
+        self.last_processed_block: Block = blockchain.tail
+        self.pool = FacilitatorPool("decrypted_average_traffic")
+        self.pool.replay(blockchain.head, self.last_processed_block)
+        self.in_pool = False
+        self.decrypted_value_count = 0
+        self.total_decryption_time = datetime.timedelta(0)
         self.current_neighborhood = None
         self.thread = threading.Thread(target=self.run_service)
         self.system_running = True
@@ -41,109 +77,214 @@ class GlobalBlockchainNode(BlockchainNode):
         self.traffic_update_interval_in_seconds = traffic_update_interval_in_seconds
 
     def run_threaded(self):
+        self.join_pool()
+        self.clock.add_participant()
         self.thread.start()
         return self.thread
 
-    def get_node_state(self):
-        return self.state
+    def join_pool(self):
+        if self.in_pool:
+            return
+        self.blockchain.add_block({
+            "type": "facilitator_joined",
+            "facilitator": self.node_id
+        })
+        self.in_pool = True
+
+    def leave_pool(self):
+        if not self.in_pool:
+            return
+        self.blockchain.add_block({
+            "type": "facilitator_left",
+            "facilitator": self.node_id
+        })
+        self.in_pool = False
+
+    def get_decryption_throughput(self) -> float:
+        # decrypted values per second of decryption work
+        seconds = self.total_decryption_time.total_seconds()
+        if seconds == 0:
+            return 0
+        return self.decrypted_value_count / seconds
+
+    def get_session(self, neighborhood: str) -> Optional[FacilitatorSession]:
+        return self.sessions.get(neighborhood)
+
+    def get_node_state(self, neighborhood: Optional[str] = None):
+        if neighborhood is None:
+            neighborhood = self.current_neighborhood
+        session = self.sessions.get(neighborhood)
+        if session is None:
+            return GlobalBlockchainNodeState.IDLE
+        return session.state
+
+    @property
+    def state(self):
+        return self.get_node_state()
+
+    def active_sessions(self):
+        return [session for session in self.sessions.values() if session.state != GlobalBlockchainNodeState.IDLE]
 
     def run_service(self):
-        while self.system_running:
-            if self.state == GlobalBlockchainNodeState.IDLE:
-                self.check_and_answer_facilitating_request()
-            elif self.state == GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC:
-                self.check_for_first_encrypted_average_traffic()
-            elif self.state == GlobalBlockchainNodeState.WAITING_FOR_SECOND_ENCRYPTED_AVERAGE_TRAFFIC:
-                self.check_for_second_encrypted_average_traffic()
-            elif self.state == GlobalBlockchainNodeState.WAITING_FOR_DECRYPTION_REQUEST:
-                self.check_and_answer_decryption_request()
-            else:
-                raise InvalidStateError(self.state, "run_server")
-            sleep(self.sleep_time)
+        try:
+            while self.system_running:
+                self.process_new_blocks()
+                self.clock.sleep(self.sleep_time)
+            self.leave_pool()
+        finally:
+            self.clock.remove_participant()
 
-    def get_latest_block_of_type_for_current_neighborhood(self, block_type: str):
+    def process_new_blocks(self):
+        # blocks added while processing (our own answers included) are picked up by the same loop
+        while self.last_processed_block.next_block is not None:
+            block = self.last_processed_block.next_block
+            noticed = self.clock.now() if self.tracer.enabled else None
+            with self.metrics.timer("block_processing", scheme="partial"):
+                self.pool.apply(block)
+                handled = self.handle_block(block)
+            if handled:
+                self.trace_wait(block, noticed=noticed)
+            self.last_processed_block = block
+
+    def handle_block(self, block: Block):
+        block_type = block.data["type"]
+        if block_type == "request_facilitator":
+            return self.check_and_answer_facilitating_request(block)
+        session = self.sessions.get(block.data.get("neighborhood"))
+        if session is None:
+            return False
+        if session.state == GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC:
+            return self.check_for_first_encrypted_average_traffic(session, block)
+        elif session.state == GlobalBlockchainNodeState.WAITING_FOR_SECOND_ENCRYPTED_AVERAGE_TRAFFIC:
+            return self.check_for_second_encrypted_average_traffic(session, block)
+        elif session.state == GlobalBlockchainNodeState.WAITING_FOR_DECRYPTION_REQUEST:
+            return self.check_and_answer_decryption_request(session, block)
+        elif session.state == GlobalBlockchainNodeState.IDLE:
+            return False
+        else:
+            raise InvalidStateError(session.state, "handle_block")
+
+    def get_latest_block_of_type_for_neighborhood(self, neighborhood: str, block_type: str):
         latest_block = self.blockchain.tail
-        while latest_block.data["neighborhood"] != self.current_neighborhood or latest_block.data["type"] != block_type:
+        while latest_block is not None and (latest_block.data.get("neighborhood") != neighborhood or
+                                            latest_block.data["type"] != block_type):
             latest_block = latest_block.previous_block
         return latest_block
 
-    def check_and_answer_facilitating_request(self):
-        if self.state != GlobalBlockchainNodeState.IDLE:
-            raise InvalidStateError(self.state, "check_answer_facilitating_request")
-        latest_block = self.blockchain.tail
-        if latest_block.data["type"] == "request_facilitator":
-            self.blockchain.add_block({
+    def get_latest_block_of_type_for_current_neighborhood(self, block_type: str):
+        return self.get_latest_block_of_type_for_neighborhood(self.current_neighborhood, block_type)
+
+    def check_and_answer_facilitating_request(self, block: Block):
+        if block.data["type"] != "request_facilitator":
+            return False
+        neighborhood = block.data["neighborhood"]
+        if self.pool.get_owner(neighborhood) != self.node_id:
+            # another facilitator owns this round, so an unfinished session of ours is stale
+            self.sessions.pop(neighborhood, None)
+            return False
+        self.rounds[neighborhood] = self.rounds.get(neighborhood, 0) + 1
+        session = FacilitatorSession(neighborhood, self.rounds[neighborhood])
+        session.trace_id = block.data.get("trace_id")
+        self.sessions[neighborhood] = session
+        self.current_neighborhood = neighborhood
+        self.metrics.counter("facilitator_sessions", scheme="partial").inc()
+        with self.trace_span("2 accept request", session.trace_id):
+            self.blockchain.add_block(self.tag_trace({
                 "type": "facilitator_accepted_request",
-                "neighborhood": latest_block.data["neighborhood"],
+                "neighborhood": neighborhood,
+                "facilitator": self.node_id,
                 "public_key": str(self.key_pair[0].n)
-            })
-            self.state = GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC
-            self.current_neighborhood = latest_block.data["neighborhood"]
-            if not self.quiet:
-                print(f'global node {self.node_id} accepted request for neighborhood {self.current_neighborhood}')
-            return True
-        return False
+            }, session.trace_id))
+        if not self.quiet:
+            print(f'global node {self.node_id} accepted request for neighborhood {neighborhood}')
+        return True
+
+    def decrypt_value(self, value: Tuple[int, int]) -> int:
+        ciphertext, exponent = value
+        public_key = self.key_pair[0]
+        encrypted_speed = paillier.EncryptedNumber(public_key, ciphertext, exponent)
+        return self.key_pair[1].decrypt(encrypted_speed)
 
-    def get_decryption(self, average_encrypted: Dict[str, Tuple[int, int]]) -> Dict[str, int]:
+    def get_decryption(self, average_encrypted: Union[Dict[str, Tuple[int, int]], List[Tuple[int, int]]]):
+        # sparse blocks carry a list parallel to their observed edges bitmap
+        if isinstance(average_encrypted, list):
+            return [self.decrypt_value(value) for value in average_encrypted]
         average_traffic = {}
         for key, value in average_encrypted.items():
-            ciphertext, exponent = value
-            public_key = self.key_pair[0]
-            encrypted_speed = paillier.EncryptedNumber(public_key, ciphertext, exponent)
-            average_traffic[key] = self.key_pair[1].decrypt(encrypted_speed)
+            average_traffic[key] = self.decrypt_value(value)
         return average_traffic
 
-    def calculate_average_traffic_decryption(self, first: bool):
-        latest_block = self.blockchain.tail
-        if latest_block.data["neighborhood"] != self.current_neighborhood:
-            return False
+    def calculate_average_traffic_decryption(self, session: FacilitatorSession, block: Block, first: bool):
         checkingType = "f_ab_encrypted_average_traffic" if first else "f_cd_encrypted_average_traffic"
-        if latest_block.data["type"] == checkingType:
+        if block.data["type"] == checkingType:
+            if block.data.get("sparse"):
+                session.sparse = True
+                if first:
+                    session.f_ab_observed_edges = block.data["observed_edges"]
+                else:
+                    session.f_cd_observed_edges = block.data["observed_edges"]
+            if "edges" in block.data:
+                if first:
+                    session.f_ab_edges = block.data["edges"]
+                else:
+                    session.f_cd_edges = block.data["edges"]
             start = datetime.datetime.now()
-            if first:
-                self.f_ab_decrypted_average_traffic = self.get_decryption(latest_block.data["average_traffic"])
-            else:
-                self.f_cd_decrypted_average_traffic = self.get_decryption(latest_block.data["average_traffic"])
+            with self.metrics.timer("decryption", scheme="partial"), default_profiler.phase("decrypt"), \
+                    self.trace_span("9 decrypt f_ab" if first else "9 decrypt f_cd", session.trace_id):
+                if first:
+                    session.f_ab_decrypted_average_traffic = self.get_decryption(block.data["average_traffic"])
+                else:
+                    session.f_cd_decrypted_average_traffic = self.get_decryption(block.data["average_traffic"])
             end = datetime.datetime.now()
             runtime = end - start
+            self.total_decryption_time += runtime
+            self.decrypted_value_count += len(block.data["average_traffic"])
             if first:
+                session.first_decryption_time = runtime
                 self.first_decryption_time = runtime
             else:
+                session.second_decryption_time = runtime
                 self.second_decryption_time = runtime
-            self.state = GlobalBlockchainNodeState.WAITING_FOR_SECOND_ENCRYPTED_AVERAGE_TRAFFIC if first \
+            session.state = GlobalBlockchainNodeState.WAITING_FOR_SECOND_ENCRYPTED_AVERAGE_TRAFFIC if first \
                 else GlobalBlockchainNodeState.WAITING_FOR_DECRYPTION_REQUEST
             if not self.quiet:
-                print(f"global node {self.node_id} received {self.node_id}")
+                print(f"global node {self.node_id} received {checkingType} for neighborhood {session.neighborhood}")
             return True
         return False
 
-    def check_for_first_encrypted_average_traffic(self):
-        if self.state != GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC:
-            raise InvalidStateError(self.state, "checkForFirstEncryptedAverageTraffic")
-        return self.calculate_average_traffic_decryption(True)
-
-    def check_for_second_encrypted_average_traffic(self):
-        if self.state != GlobalBlockchainNodeState.WAITING_FOR_SECOND_ENCRYPTED_AVERAGE_TRAFFIC:
-            raise InvalidStateError(self.state, "checkForSecondEncryptedAverageTraffic")
-        return self.calculate_average_traffic_decryption(False)
+    def check_for_first_encrypted_average_traffic(self, session: FacilitatorSession, block: Block):
+        if session.state != GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC:
+            raise InvalidStateError(session.state, "checkForFirstEncryptedAverageTraffic")
+        return self.calculate_average_traffic_decryption(session, block, True)
 
-    def check_and_answer_decryption_request(self):
-        if self.state != GlobalBlockchainNodeState.WAITING_FOR_DECRYPTION_REQUEST:
-            raise InvalidStateError(self.state, "check_and_answer_decryption_request")
+    def check_for_second_encrypted_average_traffic(self, session: FacilitatorSession, block: Block):
+        if session.state != GlobalBlockchainNodeState.WAITING_FOR_SECOND_ENCRYPTED_AVERAGE_TRAFFIC:
+            raise InvalidStateError(session.state, "checkForSecondEncryptedAverageTraffic")
+        return self.calculate_average_traffic_decryption(session, block, False)
 
-        latest_block = self.blockchain.tail
-        if latest_block.data["neighborhood"] != self.current_neighborhood:
-            return False
+    def check_and_answer_decryption_request(self, session: FacilitatorSession, block: Block):
+        if session.state != GlobalBlockchainNodeState.WAITING_FOR_DECRYPTION_REQUEST:
+            raise InvalidStateError(session.state, "check_and_answer_decryption_request")
 
-        if latest_block.data["type"] == "send_decryption":
-            self.blockchain.add_block({
+        if block.data["type"] == "send_decryption":
+            decrypted_block = {
                 "type": "decrypted_average_traffic",
-                "neighborhood": self.current_neighborhood,
-                "f_ab_decrypted_average_traffic": self.f_ab_decrypted_average_traffic,
-                "f_cd_decrypted_average_traffic": self.f_cd_decrypted_average_traffic
-            })
-            self.state = GlobalBlockchainNodeState.IDLE
-            size = len(str(self.blockchain.tail.data))
+                "neighborhood": session.neighborhood,
+                "f_ab_decrypted_average_traffic": session.f_ab_decrypted_average_traffic,
+                "f_cd_decrypted_average_traffic": session.f_cd_decrypted_average_traffic
+            }
+            if session.sparse:
+                decrypted_block["sparse"] = True
+                decrypted_block["f_ab_observed_edges"] = session.f_ab_observed_edges
+                decrypted_block["f_cd_observed_edges"] = session.f_cd_observed_edges
+            elif session.f_ab_edges is not None:
+                decrypted_block["f_ab_edges"] = session.f_ab_edges
+                decrypted_block["f_cd_edges"] = session.f_cd_edges
+            with self.trace_span("9 send decryption", session.trace_id):
+                self.blockchain.add_block(self.tag_trace(decrypted_block, session.trace_id))
+            session.state = GlobalBlockchainNodeState.IDLE
+            size = len(str(decrypted_block))
+            session.decryption_block_size = size
             self.decryption_block_size = size
             return True
         return False
@@ -1,15 +1,16 @@
 from tqdm import tqdm
 from Blockchain import Blockchain, LocalBlockchain
 import networkx.readwrite.gml as gml
-from typing import Dict
+from typing import Dict, List, Tuple
 from typing import Optional
-from utils import calc_edge_hash
+from utils import calc_edge_hash, encode_edge_bitmap, decode_edge_bitmap, \
+    encode_ordinal_traffic, decode_ordinal_traffic
 import datetime
 from Blockchain.BlockchainNode import BlockchainNode
+from Blockchain.Profiling import default_profiler, progress_disabled
 from PartialHomomorphyScheme.GlobalBlockchainNode import GlobalBlockchainNode
 from phe import paillier
 from enum import Enum
-from time import sleep
 import threading
 import random
 
@@ -27,6 +28,11 @@ class NeighborHoodState(Enum):
     DECRYPTION_RESULT_RECEIVED = 10
 
 
+def encrypt_speed(public_key: paillier.PaillierPublicKey, speed: int) -> Tuple[int, int]:
+    encrypted_speed = public_key.encrypt(speed)
+    return encrypted_speed.ciphertext(), encrypted_speed.exponent
+
+
 class StreetMapAlreadyInBlockchainError(Exception):
     def __init__(self, block_index: int):
         message = "Street map is already in the blockchain at block with index " + str(block_index)
@@ -55,9 +61,12 @@ class IncorrectStateForAction(Exception):
 
 
 class LocalBlockchainNode(BlockchainNode):
+    role = "local node"
+
     def __init__(self, local_blockchain: LocalBlockchain, neighborhood_graph_path: str = "",
                  global_blockchain: Optional[Blockchain] = None,
-                 sleep_time: float = 0.2, traffic_update_interval_in_seconds: int = 10, quiet=False):
+                 sleep_time: float = 0.2, traffic_update_interval_in_seconds: int = 10, quiet=False,
+                 sparse: bool = False, ordinal_encoding: bool = False):
         # local blockchain node is primarily a local blockchain node, but it can also be a global blockchain node too
         neighborhood = local_blockchain.neighborhood
         BlockchainNode.__init__(self, local_blockchain)
@@ -69,14 +78,16 @@ class LocalBlockchainNode(BlockchainNode):
         self.street_graph = gml.read_gml(neighborhood_graph_path)
         self.street_graph_edges_forward: Dict = {}
         self.street_graph_edges_backward: Dict = {}
+        self.street_graph_edge_ordinals: Dict[str, int] = {}
         self.add_street_data_to_node()
         self.state: NeighborHoodState = NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT
         self.state_lock = threading.Lock()
-        self.last_state_update: datetime.datetime = datetime.datetime.now()
+        self.last_state_update: datetime.datetime = self.clock.now()
         self.facilitator_pubkey = None
         self.facilitator_response_time = None
         self.neighborhood_encrypted_traffic = None
         self.state_thread = threading.Thread(target=self.update_state_periodically)
+        self.last_forwarded_global_block = global_blockchain.tail if global_blockchain is not None else None
         self.forward_related_blocks_thread = threading.Thread(target=self.forward_related_blocks_periodically)
         self.system_running = True
         self.debug = False
@@ -97,32 +108,49 @@ class LocalBlockchainNode(BlockchainNode):
         self.calculating_encrypted_average_time = None
         self.sleep_time = sleep_time
         self.traffic_update_interval_in_seconds = traffic_update_interval_in_seconds
+        # in sparse mode only edges that received logs are encrypted and published
+        self.sparse = sparse
+        # traffic blocks refer to edges by their ordinal in the street_graph block instead of their hash
+        self.ordinal_encoding = ordinal_encoding
+        self.default_average_speed: int = 100
 
     def run_threaded(self):
         if self.global_node is not None:
+            self.clock.add_participant()
             self.forward_related_blocks_thread.start()
+            self.clock.add_participant()
             self.state_thread.start()
             return [self.state_thread, self.forward_related_blocks_thread]
         else:
+            self.clock.add_participant()
             self.state_thread.start()
             return self.state_thread
 
     def update_state_periodically(self):
-        while self.system_running:
-            self.update_state()
-            sleep(self.sleep_time)
+        try:
+            while self.system_running:
+                self.update_state()
+                self.clock.sleep(self.sleep_time)
+        finally:
+            self.clock.remove_participant()
 
     def forward_related_blocks_periodically(self):
-        while self.system_running:
-            self.forward_global_related_blocks()
-            sleep(self.sleep_time)
+        try:
+            while self.system_running:
+                self.forward_global_related_blocks()
+                self.clock.sleep(self.sleep_time)
+        finally:
+            self.clock.remove_participant()
 
     def update_state(self):
         self.state_lock.acquire()
+        previous_state = self.state
         block = self.blockchain.tail
         if block is None:
             self.state = NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT
         block_type = block.data["type"]
+        if block.data.get("trace_id") is not None:
+            self.trace_id = block.data["trace_id"]
         if block_type == "request_facilitator":
             if self.state == NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT:
                 if not self.quiet:
@@ -137,7 +165,7 @@ class LocalBlockchainNode(BlockchainNode):
             self.update_facilitator_data(block)
         elif self.state == NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
             if self.facilitator_response_time + datetime.timedelta(
-                    seconds=self.traffic_update_interval_in_seconds) < datetime.datetime.now():
+                    seconds=self.traffic_update_interval_in_seconds) < self.clock.now():
                 if self.state == NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
                     if not self.quiet:
                         print(
@@ -195,13 +223,22 @@ class LocalBlockchainNode(BlockchainNode):
                 if not self.quiet:
                     print(f"Local node {self.node_id}: Results {block_type}.")
             self.state = NeighborHoodState.FACILITATOR_REQUEST_NOT_SENT
+        if self.state != previous_state:
+            self.metrics.counter("state_transitions", scheme="partial", state=self.state.name).inc()
+            if self.state == NeighborHoodState.ENC_AVERAGE_TRAFFIC_CALCULATION_TIME_REACHED:
+                # step 3 has no block of its own, its span is the window the logs were taken in
+                self.tracer.record("3 traffic logs", self.trace_id, self.facilitator_response_time, self.clock.now(),
+                                   f"{self.role} {self.node_id}", self.blockchain.name)
+            else:
+                self.trace_wait(block)
         self.state_lock.release()
 
     def forward_raw_traffic(self, data):
         if self.global_node is None:
             raise IsNotGlobalNodeError
         data["neighborhood"] = self.neighborhood
-        self.global_blockchain.add_block(data)
+        with self.trace_span("forward_raw_traffic", chain=self.global_blockchain.name, kind="hop"):
+            self.global_blockchain.add_block(data)
 
     def forward_global_block(self, block):
         if self.global_node is None:
@@ -211,20 +248,32 @@ class LocalBlockchainNode(BlockchainNode):
     def forward_global_related_blocks(self):
         if self.global_node is None:
             raise IsNotGlobalNodeError
-        block = self.global_node.blockchain.tail
+        # walk every global block added since the last call so blocks of other neighborhoods cannot hide ours
+        while self.last_forwarded_global_block.next_block is not None:
+            block = self.last_forwarded_global_block.next_block
+            self.last_forwarded_global_block = block
+            self.forward_global_related_block(block)
+
+    def forward_global_related_block(self, block):
         global_block_type = block["type"]
         if "neighborhood" not in block.data or block.data["neighborhood"] != self.neighborhood:
             return
         self.update_state()
         state = self.state
         if state == NeighborHoodState.FACILITATOR_REQUEST_SENT and global_block_type == "facilitator_accepted_request":
-            self.forward_global_block(block.data)
+            self.forward_traced_global_block(block)
         elif state == NeighborHoodState.DECRYPTION_REQUEST_SENT and global_block_type == "decrypted_average_traffic":
-            self.forward_global_block(block.data)
+            self.forward_traced_global_block(block)
         else:
             return
         self.update_state()
 
+    def forward_traced_global_block(self, block):
+        self.trace_wait(block, chain=self.global_blockchain.name)
+        with self.trace_span("forward_global_related_blocks", block.data.get("trace_id"), kind="hop",
+                             block_type=block.data["type"]):
+            self.forward_global_block(block.data)
+
     def __str__(self):
         if self.global_node is None:
             return f"Local Node {self.node_id}"
@@ -247,6 +296,9 @@ class LocalBlockchainNode(BlockchainNode):
             "edges": list(self.street_graph_edges_forward.keys())
         }
         self.blockchain.add_block(street_graph_edges_block)
+        if self.global_node is not None:
+            # the approved blocks forwarded to the global chain refer to these edges by ordinal
+            self.forward_raw_traffic(dict(street_graph_edges_block))
         return street_graph_edges_block
 
     def add_street_data_to_node(self):
@@ -255,6 +307,8 @@ class LocalBlockchainNode(BlockchainNode):
             edge_hash = calc_edge_hash(edge)
             self.street_graph_edges_forward[edge_hash] = edge
             self.street_graph_edges_backward[edge] = edge_hash
+        self.street_graph_edge_ordinals = {edge_hash: ordinal
+                                           for ordinal, edge_hash in enumerate(self.street_graph_edges_forward)}
 
     # step 1
     def request_facilitating(self):
@@ -263,12 +317,16 @@ class LocalBlockchainNode(BlockchainNode):
             raise IncorrectStateForAction(self.state, "request_facilitating")
         if self.global_node is None:
             raise
-        request_facilitator_block = {
+        # every round gets its own trace id, carried by all of its blocks
+        self.trace_id = self.tracer.new_trace_id()
+        request_facilitator_block = self.tag_trace({
             "type": "request_facilitator",
             "neighborhood": self.neighborhood
-        }
-        self.global_node.blockchain.add_block(request_facilitator_block)
-        self.blockchain.add_block(request_facilitator_block)
+        })
+        with self.trace_span("1 request facilitator"):
+            # the local chain has to know about the request before the facilitator can answer it
+            self.blockchain.add_block(request_facilitator_block)
+            self.global_node.blockchain.add_block(request_facilitator_block)
         return request_facilitator_block
 
     # step 2 is handled by the facilitator
@@ -281,18 +339,20 @@ class LocalBlockchainNode(BlockchainNode):
         if edge not in self.street_graph_edges_backward:
             print(f'edge {edge} not in street graph')
             return
-        edge_hash = self.street_graph_edges_backward[edge]
         start = datetime.datetime.now()
-        encrypted_speed = self.facilitator_pubkey.encrypt(speed)
-        ciphertext = encrypted_speed.ciphertext()
-        exponent = encrypted_speed.exponent
+        with self.metrics.timer("log_encryption", scheme="partial"):
+            encrypted_speed = encrypt_speed(self.facilitator_pubkey, speed)
+        end = datetime.datetime.now()
+        self.calculating_traffic_log_encryption_time = end - start
+        return self.add_encrypted_traffic_log(edge, encrypted_speed)
+
+    def add_encrypted_traffic_log(self, edge, encrypted_speed: Tuple[int, int]):
+        # the speed is encrypted by the caller, e.g. in another process
         traffic_speed_block = {
             "type": "encrypted_traffic_log",
-            "edge_hash": edge_hash,
-            "speed": (ciphertext, exponent)
+            "edge_hash": self.street_graph_edges_backward[edge],
+            "speed": encrypted_speed
         }
-        end = datetime.datetime.now()
-        self.calculating_traffic_log_encryption_time = end - start
         self.blockchain.add_block(traffic_speed_block)
         self.traffic_log_size = len(str(traffic_speed_block))
         return traffic_speed_block
@@ -315,7 +375,7 @@ class LocalBlockchainNode(BlockchainNode):
                 count += 1
             block = block.previous_block
         if count == 0:
-            raw_average = self.facilitator_pubkey.encrypt(100)
+            raw_average = self.facilitator_pubkey.encrypt(self.default_average_speed)
         else:
             raw_average = speeds / count
         f_average_edge_speed = raw_average * self.slope + self.bias
@@ -323,13 +383,53 @@ class LocalBlockchainNode(BlockchainNode):
 
     def _calculate_neighborhood_encrypted_average_traffic(self):
         traffic = {}
-        for edge in tqdm(self.street_graph.edges):
+        for edge in tqdm(self.street_graph.edges, disable=progress_disabled()):
             edge_average_speed = self._get_edge_average_speed(edge)
             ciphertext = edge_average_speed.ciphertext()
             exponent = edge_average_speed.exponent
             traffic[calc_edge_hash(edge)] = (ciphertext, exponent)
         return traffic
 
+    def _collect_encrypted_speeds(self) -> Dict[str, List[paillier.EncryptedNumber]]:
+        # a single pass over the logs of this round, grouped by edge hash
+        speeds: Dict[str, List[paillier.EncryptedNumber]] = {}
+        block = self.blockchain.tail
+        while block is not None and block.timestamp > self.facilitator_response_time:
+            if block.data["type"] == "encrypted_traffic_log":
+                ciphertext, exponent = block.data["speed"]
+                speed = paillier.EncryptedNumber(self.facilitator_pubkey, ciphertext, exponent)
+                speeds.setdefault(block.data["edge_hash"], []).append(speed)
+            block = block.previous_block
+        return speeds
+
+    def _calculate_neighborhood_sparse_encrypted_average_traffic(self):
+        speeds = self._collect_encrypted_speeds()
+        observed_edges = []
+        traffic = []
+        for ordinal, edge in enumerate(self.street_graph.edges):
+            edge_speeds = speeds.get(self.street_graph_edges_backward[edge])
+            if edge_speeds is None:
+                continue
+            total = edge_speeds[0]
+            for speed in edge_speeds[1:]:
+                total += speed
+            f_average_edge_speed = (total / len(edge_speeds)) * self.slope + self.bias
+            observed_edges.append(ordinal)
+            traffic.append((f_average_edge_speed.ciphertext(), f_average_edge_speed.exponent))
+        return observed_edges, traffic
+
+    def decode_traffic(self, data: Dict, traffic_key: str = "traffic") -> Dict:
+        # readers get an edge hash keyed map whatever encoding the block uses
+        if "edges" in data:
+            return decode_ordinal_traffic(data["edges"], data[traffic_key], list(self.street_graph_edges_forward))
+        if data.get("sparse") and "observed_edges" in data:
+            return self._expand_sparse_traffic(data["observed_edges"], data[traffic_key])
+        return data[traffic_key]
+
+    def _expand_sparse_traffic(self, observed_edges: str, values: List) -> Dict[str, int]:
+        edge_hashes = list(self.street_graph_edges_forward.keys())
+        return {edge_hashes[ordinal]: value for ordinal, value in zip(decode_edge_bitmap(observed_edges), values)}
+
     def add_traffic_to_chains(self):
         self.update_state()
         if self.state == NeighborHoodState.ENC_AVERAGE_TRAFFIC_CALCULATION_TIME_REACHED:
@@ -339,18 +439,32 @@ class LocalBlockchainNode(BlockchainNode):
         else:
             raise IncorrectStateForAction(self.state, "add_traffic_to_localchain")
 
+        with self.trace_span("4 first aggregation" if self.first_node else "5 second aggregation"):
+            self._aggregate_traffic_to_chains()
+
+    def _aggregate_traffic_to_chains(self):
         self.generate_parameters()
 
         start = datetime.datetime.now()
-        traffic = self._calculate_neighborhood_encrypted_average_traffic()
+        with self.metrics.timer("aggregation", scheme="partial"), default_profiler.phase("aggregate"):
+            if self.sparse:
+                observed_edges, traffic = self._calculate_neighborhood_sparse_encrypted_average_traffic()
+            else:
+                traffic = self._calculate_neighborhood_encrypted_average_traffic()
         end = datetime.datetime.now()
         self.calculating_encrypted_average_time = end - start
         if not self.quiet:
             print(f"Local node {self.node_id}: Calculated encrypted average traffic in {end - start} seconds")
-        traffic_block = {
+        traffic_block = self.tag_trace({
             "type": "f_ab_encrypted_average_traffic" if self.first_node else "f_cd_encrypted_average_traffic",
             "average_traffic": traffic
-        }
+        })
+        if self.sparse:
+            traffic_block["sparse"] = True
+            traffic_block["observed_edges"] = encode_edge_bitmap(observed_edges, len(self.street_graph_edges_forward))
+        elif self.ordinal_encoding:
+            traffic_block["edges"], traffic_block["average_traffic"] = encode_ordinal_traffic(traffic,
+                                                                                     self.street_graph_edge_ordinals)
         self.blockchain.add_block(traffic_block)
         traffic_block["neighborhood"] = self.neighborhood
         length = len(str(traffic_block))
@@ -364,18 +478,19 @@ class LocalBlockchainNode(BlockchainNode):
         self.update_state()
         if self.state != NeighborHoodState.SECOND_NODE_AGGREGATED_DATA and self.state != NeighborHoodState.FIRST_NODE_PARAMETERS_SENT:
             raise IncorrectStateForAction(self.state, "approve_traffic_encrypted")
-        if self.first_node:
-            self.blockchain.add_block({
-                "type": "first_node_parameters",
-                "a": self.slope,
-                "b": self.bias
-            })
-        else:
-            self.blockchain.add_block({
-                "type": "second_node_parameters",
-                "c": self.slope,
-                "d": self.bias
-            })
+        with self.trace_span("6 first parameters" if self.first_node else "7 second parameters"):
+            if self.first_node:
+                self.blockchain.add_block(self.tag_trace({
+                    "type": "first_node_parameters",
+                    "a": self.slope,
+                    "b": self.bias
+                }))
+            else:
+                self.blockchain.add_block(self.tag_trace({
+                    "type": "second_node_parameters",
+                    "c": self.slope,
+                    "d": self.bias
+                }))
 
     # ============== end of step 6&7 ==============
 
@@ -386,12 +501,13 @@ class LocalBlockchainNode(BlockchainNode):
         self.update_state()
         if self.state != NeighborHoodState.SECOND_NODE_PARAMETERS_SENT:
             raise IncorrectStateForAction(self.state, "send_decryption_request")
-        data = {
+        data = self.tag_trace({
             "type": "send_decryption",
-        }
-        self.blockchain.add_block(data)
-        data["neighborhood"] = self.neighborhood
-        self.global_node.blockchain.add_block(data)
+        })
+        with self.trace_span("8 decryption request"):
+            self.blockchain.add_block(data)
+            data["neighborhood"] = self.neighborhood
+            self.global_node.blockchain.add_block(data)
 
     # ============== end of step 8 ==============
 
@@ -404,15 +520,18 @@ class LocalBlockchainNode(BlockchainNode):
         self.update_state()
         if self.state != NeighborHoodState.DECRYPTION_RESULT_RECEIVED:
             raise IncorrectStateForAction(self.state, "approve_results")
+        with self.trace_span("10 approve"), default_profiler.phase("approve"):
+            return self._approve_decrypted_traffic()
 
+    def _approve_decrypted_traffic(self):
         raw_decrypted_traffic = {}
-        for key, value in tqdm(self.f_ab_average_traffic.items()):
+        for key, value in tqdm(self.f_ab_average_traffic.items(), disable=progress_disabled()):
             if key not in self.f_cd_average_traffic:
                 if not self.quiet:
                     print(f'key {key} not in f_cd_average_traffic')
-                self.blockchain.add_block({
+                self.blockchain.add_block(self.tag_trace({
                     "type": "disapproved"
-                })
+                }))
                 return False
             raw_node_one = (value - self.b) / self.a
             node_two_value = self.f_cd_average_traffic[key]
@@ -420,24 +539,34 @@ class LocalBlockchainNode(BlockchainNode):
             if not raw_node_one-0.1 < raw_node_two < raw_node_two + 0.1:
                 if not self.quiet:
                     print(f'raw_node_one {raw_node_one} != raw_node_two {raw_node_two}')
-                self.blockchain.add_block({
+                self.blockchain.add_block(self.tag_trace({
                     "type": "disapproved"
-                })
+                }))
                 return False
             raw_decrypted_traffic[key] = raw_node_one
 
-        for key, value in tqdm(self.f_cd_average_traffic.items()):
+        for key, value in tqdm(self.f_cd_average_traffic.items(), disable=progress_disabled()):
             if key not in self.f_ab_average_traffic:
                 print(f'key {key} not in f_ab_average_traffic')
-                self.blockchain.add_block({
+                self.blockchain.add_block(self.tag_trace({
                     "type": "disapproved"
-                })
+                }))
                 return False
 
-        self.blockchain.add_block({
+        if self.sparse:
+            # edges without logs were never encrypted, their default is filled in plaintext
+            for key in self.street_graph_edges_forward:
+                if key not in raw_decrypted_traffic:
+                    raw_decrypted_traffic[key] = self.default_average_speed
+
+        approved_block = {
             "type": "approved",
             "traffic": raw_decrypted_traffic
-        })
+        }
+        if self.ordinal_encoding:
+            approved_block["edges"], approved_block["traffic"] = encode_ordinal_traffic(raw_decrypted_traffic,
+                                                                                        self.street_graph_edge_ordinals)
+        self.blockchain.add_block(self.tag_trace(approved_block))
         self.raw_decrypted_traffic = raw_decrypted_traffic
         return raw_decrypted_traffic
 
@@ -448,7 +577,14 @@ class LocalBlockchainNode(BlockchainNode):
         self.facilitator_response_time = block.timestamp
 
     def save_average_traffic(self, block):
-        for key, value in block.data["f_ab_decrypted_average_traffic"].items():
-            self.f_ab_average_traffic[key] = int(value)
-        for key, value in block.data["f_cd_decrypted_average_traffic"].items():
-            self.f_cd_average_traffic[key] = int(value)
+        f_ab_average_traffic = block.data["f_ab_decrypted_average_traffic"]
+        f_cd_average_traffic = block.data["f_cd_decrypted_average_traffic"]
+        if block.data.get("sparse"):
+            f_ab_average_traffic = self._expand_sparse_traffic(block.data["f_ab_observed_edges"], f_ab_average_traffic)
+            f_cd_average_traffic = self._expand_sparse_traffic(block.data["f_cd_observed_edges"], f_cd_average_traffic)
+        elif "f_ab_edges" in block.data:
+            edge_hashes = list(self.street_graph_edges_forward)
+            f_ab_average_traffic = decode_ordinal_traffic(block.data["f_ab_edges"], f_ab_average_traffic, edge_hashes)
+            f_cd_average_traffic = decode_ordinal_traffic(block.data["f_cd_edges"], f_cd_average_traffic, edge_hashes)
+        self.f_ab_average_traffic = {key: int(value) for key, value in f_ab_average_traffic.items()}
+        self.f_cd_average_traffic = {key: int(value) for key, value in f_cd_average_traffic.items()}
@@ -1,12 +1,15 @@
 import datetime
 import random
 import string
-from time import sleep
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 
 from tqdm import tqdm
 
 from Blockchain import Blockchain
+from Blockchain.Clock import Clock, VirtualClock
+from Blockchain.Metrics import MetricsRegistry, default_registry
+from Blockchain.Profiling import default_profiler, progress_disabled
+from Blockchain.Tracing import Tracer, default_tracer
 from Blockchain.LocalBlockchain import LocalBlockchain
 from PartialHomomorphyScheme.GlobalBlockchainNode import GlobalBlockchainNode, GlobalBlockchainNodeState
 from PartialHomomorphyScheme.LocalBlockchainNode import LocalBlockchainNode, NeighborHoodState
@@ -17,34 +20,49 @@ class Simulation:
     def __init__(self, map_name: str, graph_path: str, quiet: bool, random_speed_log_count: int = 100,
                  sleep_time: float = 0.2,
                  traffic_update_interval_in_seconds: int = 10, sumo_edge_ids: List[Tuple[int, int, string]] = None,
-                 key_size: int = 2048):
-        self.localBlockChain = LocalBlockchain(map_name)
-        self.globalBlockChain = Blockchain.Blockchain()
-        self.facilitator = GlobalBlockchainNode(self.globalBlockChain, sleep_time=sleep_time, quiet=quiet,
-                                                traffic_update_interval_in_seconds=traffic_update_interval_in_seconds,
-                                                key_size=key_size)
+                 key_size: int = 2048, facilitator_count: int = 1, sparse: bool = False,
+                 ordinal_encoding: bool = False, virtual_time: bool = False, workload=None,
+                 metrics: Optional[MetricsRegistry] = None, tracer: Optional[Tracer] = None):
+        # with virtual time the waits of the nodes and of the simulation cost no real time
+        self.clock = VirtualClock() if virtual_time else Clock()
+        # the metrics of all nodes of this simulation, the shared default registry is disabled until enabled
+        self.metrics = metrics if metrics is not None else default_registry
+        # spans of every round across both chains, the shared default tracer is disabled until enabled
+        self.tracer = tracer if tracer is not None else default_tracer
+        self.localBlockChain = LocalBlockchain(map_name, self.clock, self.metrics, self.tracer)
+        self.globalBlockChain = Blockchain.Blockchain(self.clock, self.metrics, self.tracer)
+        self.facilitators = [GlobalBlockchainNode(self.globalBlockChain, sleep_time=sleep_time, quiet=quiet,
+                                                  traffic_update_interval_in_seconds=traffic_update_interval_in_seconds,
+                                                  key_size=key_size) for _ in range(facilitator_count)]
+        self.facilitator = self.facilitators[0]
         self.localBlockChainNode = LocalBlockchainNode(self.localBlockChain, graph_path, sleep_time=sleep_time,
                                                        traffic_update_interval_in_seconds=traffic_update_interval_in_seconds,
-                                                       quiet=quiet)  # local node 0
+                                                       quiet=quiet, sparse=sparse,
+                                                       ordinal_encoding=ordinal_encoding)  # local node 0
         self.bridgeLocalToGlobal = LocalBlockchainNode(self.localBlockChain, graph_path, self.globalBlockChain,
                                                        traffic_update_interval_in_seconds=traffic_update_interval_in_seconds,
-                                                       quiet=quiet, sleep_time=sleep_time)  # local node 1
+                                                       quiet=quiet, sleep_time=sleep_time, sparse=sparse,
+                                                       ordinal_encoding=ordinal_encoding)  # local node 1
         self.secondBridgeLocalToGlobal = LocalBlockchainNode(self.localBlockChain, graph_path,
                                                              self.globalBlockChain,
                                                              sleep_time=sleep_time,
                                                              traffic_update_interval_in_seconds=traffic_update_interval_in_seconds,
-                                                             quiet=quiet)  # local node 2
+                                                             quiet=quiet, sparse=sparse,
+                                                             ordinal_encoding=ordinal_encoding)  # local node 2
         self.neighborhood_map = self.localBlockChainNode.street_graph
         self.edges = list(self.neighborhood_map.edges)
 
         self.time_unit = 0.5
 
         self.threads = []
-        self.nodes = [self.facilitator, self.localBlockChainNode, self.bridgeLocalToGlobal,
-                      self.secondBridgeLocalToGlobal]
+        self.nodes = self.facilitators + [self.localBlockChainNode, self.bridgeLocalToGlobal,
+                                          self.secondBridgeLocalToGlobal]
 
         self.quiet = quiet
+        self.ordinal_encoding = ordinal_encoding
         self.random_speed_log_count = random_speed_log_count
+        # a workload.Workload over self.edges replaces the uniform random logs
+        self.workload = workload
         self.sending_traffic_logs_time: datetime.timedelta = None
         self.edge_to_sumo_id: Dict[Tuple[int, int], string] = None
         self.sumo_id_to_edge: Dict[string, Tuple[int, int]] = None
@@ -59,6 +77,19 @@ class Simulation:
             self.edge_to_sumo_id[(start, end)] = id
             self.sumo_id_to_edge[id] = (start, end)
 
+    def get_serving_facilitator(self) -> GlobalBlockchainNode:
+        # the pool hands the neighborhood to exactly one facilitator, which keeps the session afterwards
+        for facilitator in self.facilitators:
+            if facilitator.get_session(self.localBlockChain.neighborhood) is not None:
+                return facilitator
+        return self.facilitator
+
+    def get_facilitator_state(self) -> GlobalBlockchainNodeState:
+        return self.get_serving_facilitator().get_node_state(self.localBlockChain.neighborhood)
+
+    def get_facilitators_decryption_throughput(self) -> Dict[int, float]:
+        return {facilitator.node_id: facilitator.get_decryption_throughput() for facilitator in self.facilitators}
+
     def runServers(self):
         for node in self.nodes:
             if hasattr(node, 'run_threaded'):
@@ -68,7 +99,8 @@ class Simulation:
     def send_traffic_log(self, edge, speed):
         if self.localBlockChainNode.get_node_state() != NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
             return
-        self.localBlockChainNode.send_encrypted_traffic_log(edge, speed)
+        with default_profiler.phase("ingest"):
+            self.localBlockChainNode.send_encrypted_traffic_log(edge, speed)
         if not self.quiet:
             print(f"Sent traffic log for edge {edge} with speed {speed}")
 
@@ -80,7 +112,7 @@ class Simulation:
         if self.send_traffic_state is not True:
             return
         # select a random edge
-        edge = random.choice(list(self.edges))
+        edge = random.choice(self.edges)
         # edge = self.edges[0]
         # select a random speed
         speed = random.randint(0, 100)
@@ -88,10 +120,14 @@ class Simulation:
 
     def send_traffic_random(self):
         start = datetime.datetime.now()
-        for _ in tqdm(range(self.random_speed_log_count)):
-            if self.localBlockChainNode.get_node_state() == NeighborHoodState.ENC_AVERAGE_TRAFFIC_CALCULATION_TIME_REACHED:
-                break
-            self.send_random_traffic_log()
+        if self.workload is not None:
+            # logs that arrive after the update interval was reached are dropped by send_traffic_log
+            self.workload.stream(self, self.workload.generate_count(self.random_speed_log_count))
+        else:
+            for _ in tqdm(range(self.random_speed_log_count), disable=progress_disabled()):
+                if self.localBlockChainNode.get_node_state() == NeighborHoodState.ENC_AVERAGE_TRAFFIC_CALCULATION_TIME_REACHED:
+                    break
+                self.send_random_traffic_log()
         end = datetime.datetime.now()
         self.sending_traffic_logs_time = end - start
 
@@ -101,27 +137,31 @@ class Simulation:
     def simulation(self):
         # request facilitator until the answer
         if not self.quiet:
-            print(f'facilitator: {self.facilitator.get_node_state()} {inspect.currentframe().f_lineno}')
+            print(f'facilitator: {self.get_facilitator_state()} {inspect.currentframe().f_lineno}')
         if not self.quiet:
             print("Requesting to be a facilitator")
+        if self.ordinal_encoding:
+            # edge ordinals in the traffic blocks refer to this block
+            self.bridgeLocalToGlobal.add_street_graph_edges_to_blockchain()
         self.bridgeLocalToGlobal.request_facilitating()
-        while self.facilitator.get_node_state() != GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC:
-            sleep(self.time_unit)
+        while self.get_facilitator_state() != GlobalBlockchainNodeState.WAITING_FOR_FIRST_ENCRYPTED_AVERAGE_TRAFFIC:
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
-            print(f'facilitator: {self.facilitator.get_node_state()} {inspect.currentframe().f_lineno}')
+            print(f'facilitator: {self.get_facilitator_state()} {inspect.currentframe().f_lineno}')
         while self.localBlockChainNode.get_node_state() != NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(f'localBlockChainNode {self.localBlockChainNode.get_node_state()} {inspect.currentframe().f_lineno}')
         while self.secondBridgeLocalToGlobal.get_node_state() != NeighborHoodState.FACILITATOR_REQUEST_ANSWERED:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(
                 f'secondBridgeLocalToGlobal {self.secondBridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
         # authentication with facilitator completed
 
         self.send_traffic_state = True
-        if self.sumo_id_to_edge is None:
+        # a workload, fcd.FcdReplay among them, sends the logs of the round even with sumo edge ids
+        if self.sumo_id_to_edge is None or self.workload is not None:
             self.send_traffic_random()
         else:
             print("Now the sumo traffic should be sent by calling the send_sumo_traffic method")
@@ -129,7 +169,7 @@ class Simulation:
         # wait for traffic update interval to be reached
         self.localBlockChainNode.debug = True
         while self.localBlockChainNode.get_node_state() != NeighborHoodState.ENC_AVERAGE_TRAFFIC_CALCULATION_TIME_REACHED:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
 
         self.send_traffic_state = False
         if not self.quiet:
@@ -143,7 +183,7 @@ class Simulation:
 
         # wait for second node to get updated
         while self.secondBridgeLocalToGlobal.get_node_state() != NeighborHoodState.FIRST_NODE_AGGREGATED_DATA:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(
                 f'secondBridgeLocalToGlobal {self.secondBridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
@@ -151,14 +191,14 @@ class Simulation:
 
         # wait for the first node to get updated
         while self.bridgeLocalToGlobal.get_node_state() != NeighborHoodState.SECOND_NODE_AGGREGATED_DATA:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(f'bridgeLocalToGlobal {self.bridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
         self.bridgeLocalToGlobal.send_parameters()
 
         # wait for the second node to get updated
         while self.secondBridgeLocalToGlobal.get_node_state() != NeighborHoodState.FIRST_NODE_PARAMETERS_SENT:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(
                 f'secondBridgeLocalToGlobal {self.secondBridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
@@ -166,7 +206,7 @@ class Simulation:
 
         # wait for the first node to get updated
         while self.bridgeLocalToGlobal.get_node_state() != NeighborHoodState.SECOND_NODE_PARAMETERS_SENT:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(f'bridgeLocalToGlobal {self.bridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
 
@@ -176,22 +216,22 @@ class Simulation:
         self.bridgeLocalToGlobal.send_decryption_request()
 
         # wait for the facilitator to send the decrypted average traffic
-        while self.facilitator.get_node_state() != GlobalBlockchainNodeState.IDLE:
-            sleep(self.time_unit)
+        while self.get_facilitator_state() != GlobalBlockchainNodeState.IDLE:
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
-            print(f'facilitator {self.facilitator.get_node_state()} {inspect.currentframe().f_lineno}')
+            print(f'facilitator {self.get_facilitator_state()} {inspect.currentframe().f_lineno}')
 
         # wait for the first node to get updated
         if not self.quiet:
             print(f'bridgeLocalToGlobal {self.bridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
         while self.bridgeLocalToGlobal.get_node_state() != NeighborHoodState.DECRYPTION_RESULT_RECEIVED:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(f'bridgeLocalToGlobal {self.bridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
 
         # wait for the second node to get updated
         while self.secondBridgeLocalToGlobal.get_node_state() != NeighborHoodState.DECRYPTION_RESULT_RECEIVED:
-            sleep(self.time_unit)
+            self.clock.sleep(self.time_unit)
         if not self.quiet:
             print(
                 f'secondBridgeLocalToGlobal {self.secondBridgeLocalToGlobal.get_node_state()} {inspect.currentframe().f_lineno}')
@@ -203,6 +243,7 @@ class Simulation:
         self.bridgeLocalToGlobal.forward_raw_traffic(self.localBlockChain.tail.data)
 
     def run(self):
+        self.clock.add_participant()
         self.runServers()
         self.simulation()
         if not self.quiet:
@@ -218,7 +259,7 @@ class Simulation:
         calculating_traffic_log_encryption_time = (
             self.localBlockChainNode.calculating_traffic_log_encryption_time.total_seconds())
         calculating_encrypted_average_time = self.bridgeLocalToGlobal.calculating_encrypted_average_time.total_seconds()
-        calculating_decryption_time = self.facilitator.first_decryption_time.total_seconds()
+        calculating_decryption_time = self.get_serving_facilitator().first_decryption_time.total_seconds()
         data = {
             "global_blockchain_size": global_blockchain_size,
             "local_blockchain_size": local_blockchain_size,
@@ -235,5 +276,6 @@ class Simulation:
         # stop all other threads here
         for n in self.nodes:
             n.system_running = False
+        self.clock.remove_participant()
         if not self.quiet:
             print(f'after simulation')
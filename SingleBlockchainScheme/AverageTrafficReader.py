@@ -0,0 +1,68 @@
+from typing import Dict, List, Optional
+
+from Blockchain import Blockchain
+from Blockchain.Block import Block
+from utils import decode_ordinal_traffic
+
+
+class AverageTrafficReader:
+    """
+    Follows a chain of average_traffic keyframes and average_traffic_delta blocks and keeps the current map.
+
+    The first call walks back from the tail to the latest keyframe only, later calls only look at the blocks
+    added since the previous call.
+    """
+
+    def __init__(self, blockchain: Blockchain, neighborhood: Optional[str] = None, edges: Optional[List] = None):
+        self.blockchain = blockchain
+        self.neighborhood = neighborhood
+        # edges in street_graph order, needed for blocks that use the ordinal encoding
+        self.edges = edges
+        self.traffic: Dict = {}
+        self.last_block: Optional[Block] = None
+
+    def _is_traffic_block(self, block: Block):
+        if block.data["type"] not in ("average_traffic", "average_traffic_delta"):
+            return False
+        return self.neighborhood is None or block.data.get("neighborhood", self.neighborhood) == self.neighborhood
+
+    def _decode(self, data: Dict) -> Dict:
+        if "edges" in data:
+            if self.edges is None:
+                raise ValueError("edges are needed to read blocks with edge ordinals")
+            return decode_ordinal_traffic(data["edges"], data["average_traffic"], self.edges)
+        return data["average_traffic"]
+
+    def _apply(self, block: Block):
+        if block.data["type"] == "average_traffic":
+            self.traffic = dict(self._decode(block.data))
+        else:
+            self.traffic.update(self._decode(block.data))
+
+    def _catch_up(self):
+        tail = self.blockchain.tail
+        deltas = []
+        block = tail
+        while block is not None:
+            if self._is_traffic_block(block):
+                deltas.append(block)
+                if block.data["type"] == "average_traffic":
+                    break
+            block = block.previous_block
+        for block in reversed(deltas):
+            self._apply(block)
+        self.last_block = tail
+
+    def update(self):
+        if self.last_block is None:
+            self._catch_up()
+            return
+        while self.last_block.next_block is not None:
+            block = self.last_block.next_block
+            if self._is_traffic_block(block):
+                self._apply(block)
+            self.last_block = block
+
+    def get_current_traffic(self) -> Dict:
+        self.update()
+        return self.traffic
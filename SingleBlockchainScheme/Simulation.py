@@ -2,27 +2,39 @@ import datetime
 
 from .SingleBlockchainNode import SingleBlockchainNode
 from Blockchain import Blockchain
+from Blockchain.Clock import Clock, VirtualClock
+from Blockchain.Metrics import MetricsRegistry, default_registry
+from Blockchain.Profiling import default_profiler
 import random
-from time import sleep
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 import string
 
 
 class Simulation:
     def __init__(self, neighborhood: str, quiet: bool, random_speed_log_count: int = 100, sleep_time: float = 0.2,
-                 traffic_update_interval_in_seconds: int = 10, sumo_edge_ids=None, gml_file: str = ""):
+                 traffic_update_interval_in_seconds: int = 10, sumo_edge_ids=None, gml_file: str = "",
+                 ordinal_encoding: bool = False, keyframe_interval: int = 0, delta_threshold: float = 0,
+                 virtual_time: bool = False, workload=None, metrics: Optional[MetricsRegistry] = None):
         if gml_file == "":
             gml_file = './graphs/' + neighborhood + '.gml'
-        self.blockchain = Blockchain.Blockchain()
+        # with virtual time the waits of the nodes and of the simulation cost no real time
+        self.clock = VirtualClock() if virtual_time else Clock()
+        # the metrics of all nodes of this simulation, the shared default registry is disabled until enabled
+        self.metrics = metrics if metrics is not None else default_registry
+        self.blockchain = Blockchain.Blockchain(self.clock, self.metrics)
         self.node = SingleBlockchainNode(self.blockchain, neighborhood, sleep_time=sleep_time,
                                          traffic_update_interva_in_seconds=traffic_update_interval_in_seconds,
-                                         quiet=quiet, gml_file=gml_file)
+                                         quiet=quiet, gml_file=gml_file, ordinal_encoding=ordinal_encoding,
+                                         keyframe_interval=keyframe_interval, delta_threshold=delta_threshold)
         self.neighborhood = neighborhood
         self.quiet = quiet
         self.neighborhood_map = self.node.street_graph
         self.edges = list(self.neighborhood_map.edges)
         self.random_speed_log_count = random_speed_log_count
+        # a workload.Workload over self.edges replaces the uniform random logs
+        self.workload = workload
         self.sending_traffic_logs_time: datetime.timedelta = None
+        self.street_graph_added = False
         self.edge_to_sumo_id: Dict[Tuple[int, int], string] = None
         self.sumo_id_to_edge: Dict[string, Tuple[int, int]] = None
         if sumo_edge_ids is not None:
@@ -41,25 +53,35 @@ class Simulation:
         if not self.quiet:
             print(f"Sent traffic log for edge {edge} with speed {speed}")
 
-    def send_random_traffic_log(self):
-        edge = random.choice(list(self.edges))
-        speed = random.randint(0, 100)
-        self.node.send_traffic_log(edge, speed)
+    def send_traffic_log(self, edge, speed):
+        with default_profiler.phase("ingest"):
+            self.node.send_traffic_log(edge, speed)
         if not self.quiet:
             print(f"Sent traffic log for edge {edge} with speed {speed}")
 
+    def send_random_traffic_log(self):
+        edge = random.choice(self.edges)
+        speed = random.randint(0, 100)
+        self.send_traffic_log(edge, speed)
+
     def simulation(self):
         if not self.quiet:
             print("Starting simulation")
 
-        self.node.add_street_graph_edges_to_blockchain()
+        # the street graph goes on the chain in the first round, later rounds only send logs
+        if not self.street_graph_added:
+            self.node.add_street_graph_edges_to_blockchain()
+            self.street_graph_added = True
 
-        if not self.quiet:
-            print("Added street graph edges to blockchain")
+            if not self.quiet:
+                print("Added street graph edges to blockchain")
 
         start = datetime.datetime.now()
-        for _ in range(self.random_speed_log_count):
-            self.send_random_traffic_log()
+        if self.workload is not None:
+            self.workload.stream(self, self.workload.generate_count(self.random_speed_log_count))
+        else:
+            for _ in range(self.random_speed_log_count):
+                self.send_random_traffic_log()
         end = datetime.datetime.now()
         self.sending_traffic_logs_time = end - start
 
@@ -68,19 +90,21 @@ class Simulation:
 
         # wait for average traffic data to be sent
         while True:
-            if self.blockchain.tail.data["neighborhood"] != self.neighborhood:
+            # the street graph block has no neighborhood, it is the tail until the first log arrives
+            if self.blockchain.tail.data.get("neighborhood") != self.neighborhood:
                 if not self.quiet:
                     print(
-                        f"neighborhood not matching\tself.blockchain.tail.data[\"neighborhood\"] = {self.blockchain.tail.data['neighborhood']}\tself.neighborhood = {self.neighborhood}")
+                        f"neighborhood not matching\tself.blockchain.tail.data[\"neighborhood\"] = {self.blockchain.tail.data.get('neighborhood')}\tself.neighborhood = {self.neighborhood}")
             else:
-                if self.blockchain.tail.data["type"] == "average_traffic":
+                if self.blockchain.tail.data["type"] in ("average_traffic", "average_traffic_delta"):
                     break
-            sleep(0.5)
+            self.clock.sleep(0.5)
 
         if not self.quiet:
             print("Received average traffic data")
 
     def run(self):
+        self.clock.add_participant()
         self.node.run_threaded()
         self.simulation()
 
@@ -96,6 +120,7 @@ class Simulation:
 
     def end_run(self):
         self.node.system_running = False
+        self.clock.remove_participant()
         self.node.thread.join()
         if not self.quiet:
             print("Simulation ended")
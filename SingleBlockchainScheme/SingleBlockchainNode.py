@@ -2,11 +2,15 @@ import os
 
 from Blockchain import Blockchain
 from Blockchain.BlockchainNode import BlockchainNode
+from Blockchain.Profiling import default_profiler
 import datetime
 from tqdm import tqdm
 import networkx.readwrite.gml as gml
-from time import sleep
 import threading
+from typing import Dict
+
+from utils import calc_edge_hash, encode_ordinal_traffic, decode_ordinal_traffic
+from .AverageTrafficReader import AverageTrafficReader
 
 
 class StreetMapAlreadyInBlockchainError(Exception):
@@ -17,14 +21,34 @@ class StreetMapAlreadyInBlockchainError(Exception):
 
 
 class SingleBlockchainNode(BlockchainNode):
+    # the scheme label of the metrics of this node
+    scheme = "single"
+
     def __init__(self, blockchain: Blockchain, neighborhood: str, gml_file: str, sleep_time=0.2,
-                 traffic_update_interva_in_seconds=10, quiet=False):
+                 traffic_update_interva_in_seconds=10, quiet=False, ordinal_encoding: bool = False,
+                 keyframe_interval: int = 0, delta_threshold: float = 0):
         super().__init__(blockchain)
         self.quiet = False
-        self.last_update_time = datetime.datetime.now()
+        self.last_update_time = self.clock.now()
         self.latest_average_block = blockchain.head
         self.neighborhood = neighborhood
         self.street_graph = gml.read_gml(gml_file)
+        # ordinals follow the edges of the street_graph block
+        self.edge_ordinals: Dict = {edge: ordinal for ordinal, edge in enumerate(self.street_graph.edges)}
+        self.ordinal_encoding = ordinal_encoding
+        if ordinal_encoding:
+            # only the encoded blocks refer to the edge list, the default street_graph block stays empty
+            for edge in self.street_graph.edges:
+                edge_hash = calc_edge_hash(edge)
+                self.hash_to_edge[edge_hash] = edge
+                self.edge_to_hash[edge] = edge_hash
+        # with a keyframe interval, full maps are published every keyframe_interval rounds and in between only
+        # the edges whose average moved more than delta_threshold
+        self.keyframe_interval = keyframe_interval
+        self.delta_threshold = delta_threshold
+        self.published_traffic: Dict = {}
+        self.rounds_since_keyframe = 0
+        self.traffic_reader: AverageTrafficReader = None
         self.average_traffic_block_size = 0
         self.log_size = 0
         self.calculating_sum_time: datetime.timedelta = None
@@ -35,13 +59,17 @@ class SingleBlockchainNode(BlockchainNode):
         self.traffic_update_interval_in_seconds = traffic_update_interva_in_seconds
 
     def run_threaded(self):
+        self.clock.add_participant()
         self.thread.start()
         return self.thread
 
     def run_service(self):
-        while self.system_running:
-            self.check_average_calculation_time()
-            sleep(self.sleep_time)
+        try:
+            while self.system_running:
+                self.check_average_calculation_time()
+                self.clock.sleep(self.sleep_time)
+        finally:
+            self.clock.remove_participant()
 
     def send_traffic_log(self, edge, speed):
         block_to_send = {
@@ -56,9 +84,9 @@ class SingleBlockchainNode(BlockchainNode):
 
     def check_average_calculation_time(self):
         if self.last_update_time + datetime.timedelta(
-                seconds=self.traffic_update_interval_in_seconds) < datetime.datetime.now():
+                seconds=self.traffic_update_interval_in_seconds) < self.clock.now():
             self.add_average_traffic_to_blockchain()
-            self.last_update_time = datetime.datetime.now()
+            self.last_update_time = self.clock.now()
 
     def add_street_graph_edges_to_blockchain(self):
         index = 0
@@ -70,7 +98,10 @@ class SingleBlockchainNode(BlockchainNode):
             "type": "street_graph",
             "edges": list(self.hash_to_edge.keys()),
         }
-        self.last_update_time = datetime.datetime.now()
+        if self.ordinal_encoding:
+            # readers of a chain shared by several neighborhoods find the edges the ordinals refer to by neighborhood
+            street_graph_edges_block["neighborhood"] = self.neighborhood
+        self.last_update_time = self.clock.now()
         self.blockchain.add_block(street_graph_edges_block)
         self.latest_average_block = self.blockchain.tail
         return street_graph_edges_block
@@ -98,17 +129,47 @@ class SingleBlockchainNode(BlockchainNode):
             traffic[edge] = self._get_edge_average_speed(edge)
         return traffic
 
+    def decode_average_traffic(self, data: Dict) -> Dict:
+        # readers get an edge keyed map whatever encoding the block uses
+        if "edges" in data:
+            return decode_ordinal_traffic(data["edges"], data["average_traffic"], list(self.street_graph.edges))
+        return data["average_traffic"]
+
+    def get_current_average_traffic(self) -> Dict:
+        if self.traffic_reader is None:
+            self.traffic_reader = AverageTrafficReader(self.blockchain, self.neighborhood, list(self.street_graph.edges))
+        return self.traffic_reader.get_current_traffic()
+
+    def _get_average_traffic_block(self, traffic: Dict) -> Dict:
+        if self.keyframe_interval <= 0 or self.rounds_since_keyframe % self.keyframe_interval == 0:
+            block_type = "average_traffic"
+            self.published_traffic = dict(traffic)
+            self.rounds_since_keyframe = 0
+        else:
+            block_type = "average_traffic_delta"
+            traffic = {edge: speed for edge, speed in traffic.items()
+                       if edge not in self.published_traffic
+                       or abs(speed - self.published_traffic[edge]) > self.delta_threshold}
+            self.published_traffic.update(traffic)
+        self.rounds_since_keyframe += 1
+        block_to_send = {
+            "type": block_type,
+            "average_traffic": traffic,
+        }
+        if self.ordinal_encoding:
+            block_to_send["edges"], block_to_send["average_traffic"] = encode_ordinal_traffic(traffic,
+                                                                                              self.edge_ordinals)
+        return block_to_send
+
     def add_average_traffic_to_blockchain(self):
         start = datetime.datetime.now()
-        traffic = self._calculate_neighborhood_average_traffic()
+        with self.metrics.timer("aggregation", scheme=self.scheme), default_profiler.phase("aggregate"):
+            traffic = self._calculate_neighborhood_average_traffic()
         end = datetime.datetime.now()
         self.calculating_sum_time = end - start
-        block_to_send = {
-            "type": "average_traffic",
-            "average_traffic": traffic,
-            "neighborhood": self.neighborhood
-        }
+        block_to_send = self._get_average_traffic_block(traffic)
+        block_to_send["neighborhood"] = self.neighborhood
         self.average_traffic_block_size = len(str(block_to_send))
         self.blockchain.add_block(block_to_send)
         self.latest_average_block = self.blockchain.tail
-        self.last_update_time = datetime.datetime.now()
+        self.last_update_time = self.clock.now()
@@ -1,6 +1,7 @@
 from .SingleBlockchainNode import SingleBlockchainNode
+from .AverageTrafficReader import AverageTrafficReader
 from .Simulation import Simulation
 
-__all__ = ["SingleBlockchainNode", "Simulation"]
+__all__ = ["SingleBlockchainNode", "AverageTrafficReader", "Simulation"]
 
 version = "1.0"
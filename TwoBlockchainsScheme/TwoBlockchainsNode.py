@@ -1,4 +1,5 @@
 from Blockchain import Blockchain, LocalBlockchain
+from Blockchain.Profiling import default_profiler
 import datetime
 
 import SingleBlockchainScheme
@@ -12,12 +13,24 @@ class StreetMapAlreadyInBlockchainError(Exception):
 
 
 class TwoBlockchainsNode(SingleBlockchainScheme.SingleBlockchainNode):
+    scheme = "two"
+
     def __init__(self, localBlockchain: LocalBlockchain, globalBlockchain: Blockchain, neighborhood: str, gml_file: str,
-                 quiet=False, sleep_time=0.2, traffic_update_interval_in_seconds=10):
+                 quiet=False, sleep_time=0.2, traffic_update_interval_in_seconds=10, ordinal_encoding: bool = False,
+                 keyframe_interval: int = 0, delta_threshold: float = 0):
         super().__init__(localBlockchain, neighborhood, gml_file, sleep_time=sleep_time,
-                         traffic_update_interva_in_seconds=traffic_update_interval_in_seconds, quiet=quiet)
+                         traffic_update_interva_in_seconds=traffic_update_interval_in_seconds, quiet=quiet,
+                         ordinal_encoding=ordinal_encoding, keyframe_interval=keyframe_interval,
+                         delta_threshold=delta_threshold)
         self.globalBlockchain = globalBlockchain
 
+    def add_street_graph_edges_to_blockchain(self):
+        street_graph_edges_block = super().add_street_graph_edges_to_blockchain()
+        if self.ordinal_encoding:
+            # the averages forwarded to the global chain refer to these edges by ordinal
+            self.globalBlockchain.add_block(dict(street_graph_edges_block))
+        return street_graph_edges_block
+
     def send_traffic_log(self, edge, speed):
         block_to_send = {
             "type": "traffic_speed",
@@ -45,16 +58,14 @@ class TwoBlockchainsNode(SingleBlockchainScheme.SingleBlockchainNode):
 
     def add_average_traffic_to_blockchain(self):
         start = datetime.datetime.now()
-        traffic = self._calculate_neighborhood_average_traffic()
+        with self.metrics.timer("aggregation", scheme=self.scheme), default_profiler.phase("aggregate"):
+            traffic = self._calculate_neighborhood_average_traffic()
         end = datetime.datetime.now()
         self.calculating_sum_time = end - start
-        block_to_send = {
-            "type": "average_traffic",
-            "average_traffic": traffic,
-        }
+        block_to_send = self._get_average_traffic_block(traffic)
         self.average_traffic_block_size = len(str(block_to_send))
         self.blockchain.add_block(block_to_send)
         self.latest_average_block = self.blockchain.tail
-        self.last_update_time = datetime.datetime.now()
+        self.last_update_time = self.clock.now()
         block_to_send["neighborhood"] = self.neighborhood
         self.globalBlockchain.add_block(block_to_send)
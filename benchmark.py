@@ -0,0 +1,376 @@
+import argparse
+import json
+import math
+import os
+import queue
+import statistics
+import sys
+import time
+import traceback
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not recorded there
+    resource = None
+
+from Blockchain.Blockchain import Blockchain
+from Blockchain.Profiling import MODES, PHASES, default_profiler
+
+REPOSITORY_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+SCHEMES = ["single", "two", "partial", "fully"]
+
+# file names of the result sets that are already in the repository (results/, labresults/, ...)
+RESULT_FILE_NAMES = {
+    "single": "single_blockchain_scheme_results.json",
+    "two": "two_blockchains_scheme_results.json",
+    "partial": "partially_homomorphic_encryption_scheme_results.json",
+    "fully": "fully_homomorphic_encryption_scheme_results.json",
+}
+
+# the traffic update interval the notebooks used, as a function of the log count
+UPDATE_INTERVAL_FACTORS = {
+    "single": 1 / 10,
+    "two": 1 / 10,
+    "partial": 1 / 1.5,
+    "fully": 1 / 1.5,
+}
+
+DEFAULT_KEY_SIZE = 2048
+DEFAULT_POLY_MODULUS_DEGREE = 4096
+
+
+class Cell:
+    def __init__(self, scheme: str, neighborhood: str, log_count: int, parameter: Optional[int], repetition: int):
+        self.scheme = scheme
+        self.neighborhood = neighborhood
+        self.log_count = log_count
+        # key size for the partial scheme, poly modulus degree for the fully homomorphic scheme
+        self.parameter = parameter
+        self.repetition = repetition
+
+    def key(self) -> Tuple:
+        return self.scheme, self.neighborhood, self.log_count, self.parameter, self.repetition
+
+    def group_key(self) -> Tuple:
+        return self.scheme, self.neighborhood, self.log_count, self.parameter
+
+    def to_dict(self) -> Dict:
+        return {
+            "scheme": self.scheme,
+            "neighborhood": self.neighborhood,
+            "log_count": self.log_count,
+            "parameter": self.parameter,
+            "repetition": self.repetition,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict) -> 'Cell':
+        return Cell(data["scheme"], data["neighborhood"], data["log_count"], data["parameter"], data["repetition"])
+
+    def file_name(self) -> str:
+        return f"{self.scheme}_{self.neighborhood}_{self.log_count}_{self.parameter}_{self.repetition}"
+
+    def __str__(self):
+        return f"{self.scheme} {self.neighborhood} logs={self.log_count} parameter={self.parameter} " \
+               f"repetition={self.repetition}"
+
+
+def expand_grid(schemes: List[str], neighborhoods: List[str], log_counts: List[int], key_sizes: List[int],
+                poly_modulus_degrees: List[int], repetitions: int) -> List[Cell]:
+    cells = []
+    for scheme in schemes:
+        if scheme == "partial":
+            parameters = key_sizes
+        elif scheme == "fully":
+            parameters = poly_modulus_degrees
+        else:
+            parameters = [None]
+        for neighborhood in neighborhoods:
+            for log_count in log_counts:
+                for parameter in parameters:
+                    for repetition in range(repetitions):
+                        cells.append(Cell(scheme, neighborhood, log_count, parameter, repetition))
+    return cells
+
+
+def create_simulation(cell: Cell, sleep_time: float, interval: Optional[float], virtual_time: bool = False):
+    update_interval = interval if interval is not None else cell.log_count * UPDATE_INTERVAL_FACTORS[cell.scheme]
+    if cell.scheme == "single":
+        import SingleBlockchainScheme
+        sim = SingleBlockchainScheme.Simulation(cell.neighborhood, quiet=True, random_speed_log_count=cell.log_count,
+                                                sleep_time=sleep_time,
+                                                traffic_update_interval_in_seconds=update_interval,
+                                                virtual_time=virtual_time)
+    elif cell.scheme == "two":
+        import TwoBlockchainsScheme
+        sim = TwoBlockchainsScheme.Simulation(cell.neighborhood, quiet=True, random_speed_log_count=cell.log_count,
+                                              sleep_time=sleep_time,
+                                              traffic_update_interval_in_seconds=update_interval,
+                                              virtual_time=virtual_time)
+    elif cell.scheme == "partial":
+        import PartialHomomorphyScheme
+        sim = PartialHomomorphyScheme.Simulation(cell.neighborhood, './graphs/' + cell.neighborhood + '.gml',
+                                                 quiet=True, random_speed_log_count=cell.log_count,
+                                                 sleep_time=sleep_time,
+                                                 traffic_update_interval_in_seconds=update_interval,
+                                                 key_size=cell.parameter, virtual_time=virtual_time)
+    elif cell.scheme == "fully":
+        import FullyHomomorphyScheme
+        sim = FullyHomomorphyScheme.Simulation(cell.neighborhood, quiet=True, random_speed_log_count=cell.log_count,
+                                               sleep_time=sleep_time, update_interval=update_interval,
+                                               poly_modulus_degree=cell.parameter, virtual_time=virtual_time)
+    else:
+        raise ValueError(f"unknown scheme {cell.scheme}")
+    return sim
+
+
+def run_cell(cell: Cell, sleep_time: float, interval: Optional[float], virtual_time: bool = False) -> Dict:
+    sim = create_simulation(cell, sleep_time, interval, virtual_time)
+    sim.run()
+    data = sim.get_simulation_data()
+    sim.end_run()
+    if "validate" in default_profiler.phases:
+        # after the measurements, so validating the chains does not add to the times of the cell. only the cost is
+        # of interest, some blocks of the homomorphic schemes do not validate
+        for chain in simulation_chains(sim):
+            chain.validate_chain()
+    return data
+
+
+def simulation_chains(sim) -> List[Blockchain]:
+    # the single chain, or the local and the global chain of the other schemes
+    return [value for value in vars(sim).values() if isinstance(value, Blockchain)]
+
+
+def peak_memory_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _cell_worker(cell_data: Dict, sleep_time: float, interval: Optional[float], virtual_time: bool, verbose: bool,
+                 results: multiprocessing.Queue):
+    os.chdir(REPOSITORY_ROOT)
+    if REPOSITORY_ROOT not in sys.path:
+        sys.path.insert(0, REPOSITORY_ROOT)
+    if not verbose:
+        # the simulations print progress bars and state changes
+        devnull = open(os.devnull, 'w')
+        sys.stdout = devnull
+        sys.stderr = devnull
+    cell = Cell.from_dict(cell_data)
+    start = time.perf_counter()
+    try:
+        data = run_cell(cell, sleep_time, interval, virtual_time)
+        results.put((cell_data, data, None, time.perf_counter() - start, peak_memory_kb()))
+    except Exception:
+        results.put((cell_data, None, traceback.format_exc(), time.perf_counter() - start, peak_memory_kb()))
+    # the profiler of a worker is configured from VANET_PROFILE, which main sets
+    if default_profiler.enabled:
+        default_profiler.write(os.path.join(os.environ.get("VANET_PROFILE_DIR", "profiles"), cell.file_name()))
+    results.close()
+    results.join_thread()
+    # node threads of a finished simulation are not needed anymore
+    os._exit(0)
+
+
+def load_finished_cells(results_path: str) -> Dict[Tuple, Dict]:
+    finished = {}
+    if not os.path.exists(results_path):
+        return finished
+    with open(results_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line can be cut short when a run is interrupted
+                continue
+            if record.get("error") is None:
+                finished[Cell.from_dict(record).key()] = record
+    return finished
+
+
+def append_record(results_path: str, record: Dict):
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def estimated_cost(cell: Cell, neighborhoods_data: Dict) -> Tuple[float, int]:
+    # cells mostly wait for their update interval, the edge count breaks ties
+    edge_count = neighborhoods_data.get(cell.neighborhood, {}).get("edge_count", 1)
+    return cell.log_count * UPDATE_INTERVAL_FACTORS[cell.scheme], edge_count
+
+
+def run_grid(cells: List[Cell], results_path: str, jobs: int, timeout: Optional[float], sleep_time: float,
+             interval: Optional[float], virtual_time: bool = False, verbose: bool = False):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    pending = list(cells)
+    running: Dict[Tuple, Tuple[multiprocessing.Process, float, Cell]] = {}
+    done = 0
+
+    def record(cell: Cell, data: Optional[Dict], error: Optional[str], seconds: float,
+               memory_kb: Optional[int] = None):
+        nonlocal done
+        done += 1
+        entry = cell.to_dict()
+        entry["data"] = data
+        entry["error"] = error
+        entry["wall_time"] = seconds
+        # peak resident memory of the worker process
+        entry["peak_memory_kb"] = memory_kb
+        append_record(results_path, entry)
+        status = "failed" if error is not None else f"done in {seconds:.1f}s"
+        print(f"[{done}/{len(cells)}] {cell} {status}", flush=True)
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            cell = pending.pop(0)
+            process = ctx.Process(target=_cell_worker, args=(cell.to_dict(), sleep_time, interval, virtual_time,
+                                                                      verbose, results))
+            process.start()
+            running[cell.key()] = (process, time.perf_counter(), cell)
+        try:
+            cell_data, data, error, seconds, memory_kb = results.get(timeout=0.5)
+            cell = Cell.from_dict(cell_data)
+            entry = running.pop(cell.key(), None)
+            # a cell that already timed out has been recorded
+            if entry is not None:
+                entry[0].join()
+                record(cell, data, error, seconds, memory_kb)
+        except queue.Empty:
+            pass
+        now = time.perf_counter()
+        for key, (process, started, cell) in list(running.items()):
+            if timeout is not None and now - started > timeout:
+                process.terminate()
+                process.join()
+                del running[key]
+                record(cell, None, f"timed out after {timeout} seconds", now - started)
+            elif not process.is_alive() and process.exitcode not in (0, None):
+                del running[key]
+                record(cell, None, f"worker exited with code {process.exitcode}", now - started)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    # nearest rank
+    index = max(0, math.ceil(fraction * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize(records: List[Dict]) -> Dict:
+    groups: Dict[Tuple, List[Dict]] = {}
+    for record in records:
+        if record.get("error") is not None or record.get("data") is None:
+            continue
+        groups.setdefault(Cell.from_dict(record).group_key(), []).append(record["data"])
+    summary = {}
+    for (scheme, neighborhood, log_count, parameter), runs in sorted(groups.items(), key=lambda item: str(item[0])):
+        metrics = {}
+        for metric in runs[0]:
+            values = [run[metric] for run in runs if isinstance(run.get(metric), (int, float))]
+            if not values:
+                continue
+            metrics[metric] = {
+                "median": statistics.median(values),
+                "p95": percentile(values, 0.95),
+                "stdev": statistics.stdev(values) if len(values) > 1 else 0.0,
+                "count": len(values),
+            }
+        parameter_key = "default" if parameter is None else str(parameter)
+        summary.setdefault(scheme, {}).setdefault(parameter_key, {}).setdefault(neighborhood, {})[str(log_count)] = \
+            metrics
+    return summary
+
+
+def export_result_files(summary: Dict, output_folder: str):
+    # the medians in the same shape as results/*.json so the notebooks keep working
+    for scheme, parameters in summary.items():
+        for parameter, neighborhoods in parameters.items():
+            file_name = RESULT_FILE_NAMES[scheme]
+            if parameter not in ("default", str(DEFAULT_KEY_SIZE), str(DEFAULT_POLY_MODULUS_DEGREE)):
+                file_name = file_name.replace("_results.json", f"_{parameter}_results.json")
+            results = {neighborhood: {log_count: {metric: stats["median"] for metric, stats in metrics.items()}
+                                      for log_count, metrics in log_counts.items()}
+                       for neighborhood, log_counts in neighborhoods.items()}
+            with open(os.path.join(output_folder, file_name), 'w') as f:
+                json.dump(results, f)
+
+
+def default_neighborhoods(neighborhoods_data: Dict) -> List[str]:
+    # generated neighborhoods are for the scaling benchmark, the default grid keeps to the hand made ones
+    return [neighborhood for neighborhood, data in neighborhoods_data.items() if "generator" not in data]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run the scheme comparison grid in parallel worker processes.")
+    parser.add_argument("--schemes", nargs="+", default=["single", "two", "partial"], choices=SCHEMES)
+    parser.add_argument("--neighborhoods", nargs="+", default=None,
+                        help="defaults to every neighborhood in graphs/neighborhoods_data.json that was not generated")
+    parser.add_argument("--log-counts", nargs="+", type=int, default=[1, 5, 10, 20, 30, 40, 60, 80, 100, 150, 200])
+    parser.add_argument("--key-sizes", nargs="+", type=int, default=[DEFAULT_KEY_SIZE])
+    parser.add_argument("--poly-modulus-degrees", nargs="+", type=int, default=[DEFAULT_POLY_MODULUS_DEGREE])
+    parser.add_argument("--repetitions", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--timeout", type=float, default=None, help="seconds before a cell is killed")
+    parser.add_argument("--sleep-time", type=float, default=0.2)
+    parser.add_argument("--interval", type=float, default=None,
+                        help="traffic update interval in seconds, defaults to the notebooks' log count factors")
+    parser.add_argument("--virtual-time", action="store_true",
+                        help="run the simulations on a virtual clock, so waiting for the update interval is free")
+    parser.add_argument("--profile", nargs="+", default=None, choices=PHASES + ["all"],
+                        help="profile these phases of every cell, the profiles are written to OUTPUT/profiles")
+    parser.add_argument("--profile-mode", default="sampling", choices=MODES)
+    parser.add_argument("--profile-interval", type=float, default=0.005, help="seconds between stack samples")
+    parser.add_argument("--output", default="benchmark_results")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        # the spawned workers configure their profiler from the environment
+        os.environ["VANET_PROFILE"] = ",".join(args.profile)
+        os.environ["VANET_PROFILE_MODE"] = args.profile_mode
+        os.environ["VANET_PROFILE_INTERVAL"] = str(args.profile_interval)
+        os.environ["VANET_PROFILE_DIR"] = os.path.abspath(os.path.join(args.output, "profiles"))
+
+    with open(os.path.join(REPOSITORY_ROOT, 'graphs', 'neighborhoods_data.json'), 'r') as f:
+        neighborhoods_data = json.load(f)
+    neighborhoods = args.neighborhoods if args.neighborhoods is not None else default_neighborhoods(neighborhoods_data)
+
+    os.makedirs(args.output, exist_ok=True)
+    results_path = os.path.join(args.output, "benchmark_results.jsonl")
+
+    cells = expand_grid(args.schemes, neighborhoods, args.log_counts, args.key_sizes, args.poly_modulus_degrees,
+                        args.repetitions)
+    finished = load_finished_cells(results_path)
+    remaining = [cell for cell in cells if cell.key() not in finished]
+    # longest cells first, so the grid does not wait on one slow cell started last
+    remaining.sort(key=lambda cell: estimated_cost(cell, neighborhoods_data), reverse=True)
+    print(f"{len(cells)} cells in the grid, {len(cells) - len(remaining)} already finished", flush=True)
+
+    run_grid(remaining, results_path, args.jobs, args.timeout, args.sleep_time, args.interval, args.virtual_time,
+             args.verbose)
+
+    cell_keys = {cell.key() for cell in cells}
+    records = [record for key, record in load_finished_cells(results_path).items() if key in cell_keys]
+    summary = summarize(records)
+    with open(os.path.join(args.output, "benchmark_summary.json"), 'w') as f:
+        json.dump(summary, f, indent=2)
+    export_result_files(summary, args.output)
+    print(f"summary written to {os.path.join(args.output, 'benchmark_summary.json')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,479 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+import traceback
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+import networkx as nx
+import numpy as np
+from networkx.algorithms.community import kernighan_lin_bisection
+
+from benchmark import DEFAULT_KEY_SIZE, REPOSITORY_ROOT, peak_memory_kb
+from Blockchain import Blockchain
+from Blockchain.Clock import VirtualClock
+from workload import Workload, WorkloadBatch
+
+CITY_SCHEMES = ["single", "two", "partial"]
+
+# the blocks of the single scheme that would go on a global chain if it had one
+FORWARDED_BLOCK_TYPES = ("average_traffic", "average_traffic_delta")
+
+
+class PartitionWorkerError(Exception):
+    def __init__(self, name: str, error: str):
+        self.message = f"The round of partition {name} failed:\n{error}"
+        super().__init__(self.message)
+
+
+def ordered_subgraph(graph: nx.Graph, nodes: Set) -> nx.Graph:
+    # graph.subgraph iterates a set of nodes in hash order, which would make a partition differ from run to run
+    subgraph = nx.Graph()
+    subgraph.add_nodes_from(node for node in graph if node in nodes)
+    subgraph.add_edges_from((start, end) for start, end in graph.edges if start in nodes and end in nodes)
+    return subgraph
+
+
+def grow_side(graph: nx.Graph, nodes: Set, weights: Dict, target: float, rng: random.Random) -> Set:
+    # breadth first from a far away node until the side holds the target weight, components one after another
+    start = rng.choice(sorted(nodes, key=str))
+    start = list(nx.bfs_tree(graph, start))[-1]
+    side, weight = set(), 0.0
+    remaining = sorted(nodes, key=str)
+    frontier = deque([start])
+    while weight < target and len(side) < len(nodes):
+        if not frontier:
+            frontier.append(next(node for node in remaining if node not in side))
+        node = frontier.popleft()
+        if node in side:
+            continue
+        side.add(node)
+        weight += weights[node]
+        frontier.extend(neighbor for neighbor in graph.neighbors(node) if neighbor not in side)
+    return side
+
+
+def rebalance(graph: nx.Graph, first: Set, second: Set, weights: Dict, target: float):
+    # moves single nodes across the cut while that brings the first side closer to its target weight, nodes on the
+    # boundary with the most neighbors on the other side first so the cut stays small
+    weight = sum(weights[node] for node in first)
+    while True:
+        source, destination = (first, second) if weight > target else (second, first)
+        sign = -1 if source is first else 1
+
+        def cost(node):
+            across = sum(1 for neighbor in graph.neighbors(node) if neighbor in destination)
+            return -across, str(node)
+
+        moved = None
+        for node in sorted((node for node in source if weights[node] > 0), key=cost):
+            if abs(weight + sign * weights[node] - target) < abs(weight - target):
+                moved = node
+                break
+        if moved is None:
+            return
+        source.remove(moved)
+        destination.add(moved)
+        weight += sign * weights[moved]
+
+
+def bisect(graph: nx.Graph, nodes: Set, weights: Dict, fraction: float, rng: random.Random) -> Tuple[Set, Set]:
+    """Splits nodes into a side of about fraction of their weight and the rest, with few edges between them."""
+    total = sum(weights[node] for node in nodes)
+    graph = ordered_subgraph(graph, nodes)
+    first = grow_side(graph, nodes, weights, fraction * total, rng)
+    second = nodes - first
+    if not first or not second:
+        return first, second
+    # kernighan lin swaps pairs of nodes to lower the cut, it returns its sides in any order and ignores the weights
+    sides = [set(side) for side in kernighan_lin_bisection(graph, (first, second), seed=rng.randrange(2 ** 32))]
+    if len(sides[1] & first) > len(sides[0] & first):
+        sides.reverse()
+    first, second = sides
+    rebalance(graph, first, second, weights, fraction * total)
+    return first, second
+
+
+def merge_empty_parts(graph: nx.Graph, parts: List[Set], weights: Dict) -> List[Set]:
+    # a part that owns no edges would still get a simulation of its own, its junctions join a neighboring part
+    kept = [part for part in parts if sum(weights[node] for node in part) > 0]
+    if not kept:
+        return [set().union(*parts)]
+    for part in parts:
+        if sum(weights[node] for node in part) > 0:
+            continue
+        neighbors = [neighbor for node in sorted(part, key=str) for neighbor in graph.neighbors(node)]
+        owner = next((other for neighbor in neighbors for other in kept if neighbor in other), kept[0])
+        owner |= part
+    return kept
+
+
+class CityPartition:
+    """
+    A street graph cut into neighborhoods, every edge owned by the neighborhood of the junction it starts at.
+
+    from_graph cuts the graph by recursive bisection: a side is grown breadth first to its share of the edges and
+    the cut is refined with Kernighan-Lin, and parts over max_edges are cut again. The neighborhood of a part is the
+    subgraph of the edges it owns, the edges across the cut reach into junctions of the neighbors.
+    """
+
+    def __init__(self, graph: nx.Graph, parts: List[Set]):
+        self.graph = graph
+        self.parts = parts
+        self.names = [f"part{index}" for index in range(len(parts))]
+        self.node_part = {node: index for index, part in enumerate(parts) for node in part}
+        self.edge_owner = {edge: self.node_part[edge[0]] for edge in graph.edges}
+
+    @staticmethod
+    def from_graph(graph: nx.Graph, max_edges: Optional[int] = None, parts: Optional[int] = None,
+                   seed: int = 0) -> 'CityPartition':
+        if max_edges is None and parts is None:
+            raise ValueError("a partition needs a part count or a maximum edge count")
+        rng = random.Random(seed)
+        undirected = nx.Graph(graph)
+        # a junction weighs the edges it owns
+        weights = {node: (graph.out_degree(node) if graph.is_directed() else 0) for node in graph.nodes}
+        if not graph.is_directed():
+            for start, _ in graph.edges:
+                weights[start] += 1
+        if parts is None:
+            parts = max(1, math.ceil(graph.number_of_edges() / max_edges))
+
+        def split(nodes: Set, count: int) -> List[Set]:
+            if count == 1 or len(nodes) < 2:
+                return [nodes]
+            first, second = bisect(undirected, nodes, weights, (count // 2) / count, rng)
+            return split(first, count // 2) + split(second, count - count // 2)
+
+        result = split(set(graph.nodes), parts)
+        if max_edges is not None:
+            oversized = deque(part for part in result if sum(weights[node] for node in part) > max_edges)
+            while oversized:
+                part = oversized.popleft()
+                if len(part) < 2:
+                    continue
+                result.remove(part)
+                for side in bisect(undirected, part, weights, 0.5, rng):
+                    result.append(side)
+                    if sum(weights[node] for node in side) > max_edges:
+                        oversized.append(side)
+        return CityPartition(graph, merge_empty_parts(undirected, result, weights))
+
+    def owner(self, edge) -> Optional[int]:
+        owner = self.edge_owner.get(edge)
+        if owner is None and not self.graph.is_directed():
+            owner = self.edge_owner.get((edge[1], edge[0]))
+        return owner
+
+    def owned_edges(self, index: int) -> List[Tuple]:
+        return [edge for edge, owner in self.edge_owner.items() if owner == index]
+
+    def subgraph(self, index: int) -> nx.Graph:
+        return self.graph.edge_subgraph(self.owned_edges(index)).copy()
+
+    def edge_counts(self) -> List[int]:
+        return np.bincount(list(self.edge_owner.values()), minlength=len(self.parts)).tolist()
+
+    def cut_edges(self) -> int:
+        return sum(1 for start, end in self.graph.edges if self.node_part[start] != self.node_part[end])
+
+    def write(self, folder: str) -> List[str]:
+        """Writes the neighborhood of every part as a GML file and a summary of the partition, returns the paths."""
+        os.makedirs(folder, exist_ok=True)
+        paths = []
+        for index, name in enumerate(self.names):
+            path = os.path.join(folder, f"{name}.gml")
+            nx.write_gml(self.subgraph(index), path)
+            paths.append(path)
+        with open(os.path.join(folder, "partition.json"), 'w') as f:
+            json.dump({"edge_counts": dict(zip(self.names, self.edge_counts())), "cut_edges": self.cut_edges(),
+                       "node_parts": {str(node): self.names[part] for node, part in self.node_part.items()}}, f)
+        return paths
+
+    def __str__(self):
+        counts = self.edge_counts()
+        return f"City partition of {self.graph.number_of_edges()} edges into {len(self.parts)} parts of " \
+               f"{min(counts)} to {max(counts)} edges, {self.cut_edges()} edges cut"
+
+
+class RoutedReports:
+    """The reports routed to one partition for a round, sent by its simulation like a workload."""
+
+    def __init__(self, edges: List[Tuple], reports: List[Tuple[Tuple, int]]):
+        edge_index = {edge: index for index, edge in enumerate(edges)}
+        # an undirected neighborhood can read its edges back the other way around
+        edge_index.update({(end, start): index for (start, end), index in list(edge_index.items())
+                           if (end, start) not in edge_index})
+        reports = [(edge_index[edge], speed) for edge, speed in reports if edge in edge_index]
+        self.edges = edges
+        self.edge_indices = np.array([index for index, _ in reports], dtype=np.int64)
+        self.speeds = np.array([speed for _, speed in reports], dtype=np.int64)
+
+    def generate_count(self, count: int) -> WorkloadBatch:
+        count = min(count, len(self.speeds))
+        return WorkloadBatch(self.edges, self.edge_indices[:count], self.speeds[:count], np.zeros(count),
+                             np.zeros(count, dtype=np.int64))
+
+    def stream(self, simulation, batch: WorkloadBatch, tick: float = 0.05) -> int:
+        return Workload.stream(self, simulation, batch, rate=math.inf, tick=tick)
+
+
+def create_partition_simulation(scheme: str, name: str, graph_path: str, interval: float, sleep_time: float,
+                                virtual_time: bool, key_size: int):
+    if scheme == "single":
+        import SingleBlockchainScheme
+        return SingleBlockchainScheme.Simulation(name, quiet=True, gml_file=graph_path, sleep_time=sleep_time,
+                                                 traffic_update_interval_in_seconds=interval,
+                                                 virtual_time=virtual_time)
+    if scheme == "two":
+        import TwoBlockchainsScheme
+        return TwoBlockchainsScheme.Simulation(name, quiet=True, gml_file=graph_path, sleep_time=sleep_time,
+                                               traffic_update_interval_in_seconds=interval, virtual_time=virtual_time)
+    if scheme == "partial":
+        import PartialHomomorphyScheme
+        return PartialHomomorphyScheme.Simulation(name, graph_path, quiet=True, sleep_time=sleep_time,
+                                                  traffic_update_interval_in_seconds=interval, key_size=key_size,
+                                                  virtual_time=virtual_time)
+    raise ValueError(f"the city mode does not run the {scheme} scheme")
+
+
+def forwarded_blocks(simulation, start: int) -> Tuple[List[Dict], int]:
+    # the blocks a neighborhood put on its global chain since start, the aggregates of the single scheme
+    chain = getattr(simulation, "globalBlockChain", None) or getattr(simulation, "globalBlockchain", None)
+    block_types = None
+    if chain is None:
+        chain, block_types = simulation.blockchain, FORWARDED_BLOCK_TYPES
+    blocks = []
+    block = chain[start] if start < chain.length else None
+    while block is not None:
+        if block.index > 0 and (block_types is None or block.data.get("type") in block_types):
+            blocks.append(dict(block.data))
+        block = block.next_block
+    return blocks, chain.length
+
+
+def _partition_worker(scheme: str, partitions: List[Tuple[str, str]], options: Dict, verbose: bool,
+                      requests: multiprocessing.Queue, results: multiprocessing.Queue):
+    os.chdir(REPOSITORY_ROOT)
+    if REPOSITORY_ROOT not in sys.path:
+        sys.path.insert(0, REPOSITORY_ROOT)
+    if not verbose:
+        # the simulations print progress bars and state changes
+        devnull = open(os.devnull, 'w')
+        sys.stdout = devnull
+        sys.stderr = devnull
+    simulations = {}
+    forwarded = {name: 0 for name, _ in partitions}
+    graph_paths = dict(partitions)
+    while True:
+        routed = requests.get()
+        if routed is None:
+            break
+        for name, reports in routed.items():
+            start = time.perf_counter()
+            try:
+                simulation = simulations.get(name)
+                first_round = simulation is None
+                if first_round:
+                    simulation = create_partition_simulation(scheme, name, graph_paths[name], **options)
+                    simulations[name] = simulation
+                simulation.workload = RoutedReports(simulation.edges, reports)
+                simulation.random_speed_log_count = len(reports)
+                if first_round:
+                    simulation.run()
+                else:
+                    simulation.simulation()
+                data = simulation.get_simulation_data()
+                blocks, forwarded[name] = forwarded_blocks(simulation, forwarded[name])
+                results.put((name, data, blocks, None, time.perf_counter() - start, peak_memory_kb()))
+            except Exception:
+                results.put((name, None, [], traceback.format_exc(), time.perf_counter() - start, peak_memory_kb()))
+    for simulation in simulations.values():
+        simulation.end_run()
+    results.close()
+    results.join_thread()
+    # node threads of the finished simulations are not needed anymore
+    os._exit(0)
+
+
+class CitySimulation:
+    """
+    Runs every neighborhood of a city partition as a simulation of its own, with its own local chain and nodes, in
+    jobs worker processes against one global chain of the city.
+
+    Reports sent with send_traffic_log or send_sumo_traffic are routed to the neighborhood that owns their edge and
+    sent in its next round. A round runs the neighborhoods of every worker in parallel and appends the blocks they
+    put on their global chain to the city global chain, tagged with their neighborhood. The protocol between a
+    neighborhood and its facilitator stays inside the worker, so the city chain is the union of the neighborhood
+    chains in the order their rounds finished.
+    """
+
+    def __init__(self, partition: CityPartition, scheme: str = "single", folder: str = "graphs/city",
+                 jobs: Optional[int] = None, interval: float = 10, sleep_time: float = 0.2,
+                 virtual_time: bool = False, key_size: int = DEFAULT_KEY_SIZE, sumo_edge_ids=None,
+                 random_speed_log_count: int = 100, workload=None, verbose: bool = False):
+        if scheme not in CITY_SCHEMES:
+            raise ValueError(f"the city mode does not run the {scheme} scheme")
+        self.partition = partition
+        self.scheme = scheme
+        self.graph_paths = [os.path.abspath(path) for path in partition.write(folder)]
+        self.jobs = min(jobs if jobs is not None else multiprocessing.cpu_count(), len(partition.parts))
+        self.options = {"interval": interval, "sleep_time": sleep_time, "virtual_time": virtual_time,
+                        "key_size": key_size}
+        self.verbose = verbose
+        self.globalBlockchain = Blockchain.Blockchain()
+        # reports are only routed here and reach the neighborhoods with their next round, a stream need not wait
+        self.clock = VirtualClock()
+        self.edges = list(partition.graph.edges)
+        self.random_speed_log_count = random_speed_log_count
+        # a workload.Workload over self.edges sends the logs of a round that has no routed reports
+        self.workload = workload
+        self.pending: List[List[Tuple[Tuple, int]]] = [[] for _ in partition.parts]
+        self.dropped = 0
+        self.rounds: List[Dict] = []
+        self.sumo_id_to_edge: Optional[Dict[str, Tuple]] = None
+        if sumo_edge_ids is not None:
+            self.sumo_id_to_edge = {sumo_id: (start, end) for start, end, sumo_id in sumo_edge_ids}
+        self.context = multiprocessing.get_context("spawn")
+        self.results = None
+        self.requests: List[multiprocessing.Queue] = []
+        self.processes: List[multiprocessing.Process] = []
+        self.worker_partitions: List[List[int]] = []
+
+    def assign(self) -> List[List[int]]:
+        # the largest neighborhoods first, each to the worker with the fewest edges so far
+        loads = [0] * self.jobs
+        assignment: List[List[int]] = [[] for _ in range(self.jobs)]
+        counts = self.partition.edge_counts()
+        for index in sorted(range(len(counts)), key=lambda part: -counts[part]):
+            worker = loads.index(min(loads))
+            assignment[worker].append(index)
+            loads[worker] += counts[index]
+        return assignment
+
+    def start(self):
+        self.results = self.context.Queue()
+        self.worker_partitions = self.assign()
+        for indices in self.worker_partitions:
+            requests = self.context.Queue()
+            partitions = [(self.partition.names[index], self.graph_paths[index]) for index in indices]
+            process = self.context.Process(target=_partition_worker, args=(self.scheme, partitions, self.options,
+                                                                           self.verbose, requests, self.results))
+            process.start()
+            self.requests.append(requests)
+            self.processes.append(process)
+
+    def send_traffic_log(self, edge, speed):
+        owner = self.partition.owner(edge)
+        if owner is None:
+            self.dropped += 1
+            return
+        self.pending[owner].append((edge, speed))
+
+    def send_sumo_traffic(self, sumo_edge_id, speed):
+        self.send_traffic_log(self.sumo_id_to_edge[sumo_edge_id], speed)
+
+    def run_round(self) -> Dict:
+        """Sends the routed reports of every neighborhood to its worker and waits until all rounds are finished."""
+        if not self.processes:
+            self.start()
+        if self.workload is not None and not any(self.pending):
+            self.workload.stream(self, self.workload.generate_count(self.random_speed_log_count))
+        pending, self.pending = self.pending, [[] for _ in self.partition.parts]
+        start = time.perf_counter()
+        for requests, indices in zip(self.requests, self.worker_partitions):
+            requests.put({self.partition.names[index]: pending[index] for index in indices})
+        partitions = {}
+        while len(partitions) < len(self.partition.parts):
+            try:
+                name, data, blocks, error, seconds, memory_kb = self.results.get(timeout=1)
+            except queue.Empty:
+                for process, indices in zip(self.processes, self.worker_partitions):
+                    if not process.is_alive():
+                        names = ", ".join(self.partition.names[index] for index in indices)
+                        raise PartitionWorkerError(names, f"the worker exited with code {process.exitcode}")
+                continue
+            if error is not None:
+                raise PartitionWorkerError(name, error)
+            for block in blocks:
+                block["neighborhood"] = name
+                self.globalBlockchain.add_block(block)
+            partitions[name] = {"reports": len(pending[self.partition.names.index(name)]), "seconds": seconds,
+                                "blocks": len(blocks), "peak_memory_kb": memory_kb, "data": data}
+        seconds = time.perf_counter() - start
+        partition_seconds = sum(partition["seconds"] for partition in partitions.values())
+        report = {
+            "round": len(self.rounds) + 1,
+            "seconds": seconds,
+            "partition_seconds": partition_seconds,
+            "parallel_speedup": partition_seconds / seconds if seconds else None,
+            "reports": sum(len(reports) for reports in pending),
+            "global_blocks": self.globalBlockchain.length,
+            "partitions": partitions,
+        }
+        self.rounds.append(report)
+        return report
+
+    def end_run(self):
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join()
+        for requests in self.requests:
+            requests.close()
+        if self.results is not None:
+            self.results.close()
+        self.processes = []
+        self.requests = []
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Partition a city street graph into neighborhoods and run a scheme "
+                                                 "on all of them in parallel against one global chain.")
+    parser.add_argument("--graph", default="BerlinSumo/osm.net.gml", help="street graph of the city")
+    parser.add_argument("--max-edges", type=int, default=None, help="most edges of a neighborhood")
+    parser.add_argument("--parts", type=int, default=None, help="number of neighborhoods")
+    parser.add_argument("--scheme", default="single", choices=CITY_SCHEMES)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--log-count", type=int, default=1000, help="reports of the whole city per round")
+    parser.add_argument("--jobs", type=int, default=None, help="worker processes, defaults to the CPU count")
+    parser.add_argument("--interval", type=float, default=10, help="traffic update interval in seconds")
+    parser.add_argument("--sleep-time", type=float, default=0.2)
+    parser.add_argument("--key-size", type=int, default=DEFAULT_KEY_SIZE)
+    parser.add_argument("--virtual-time", action="store_true")
+    parser.add_argument("--folder", default="graphs/city", help="where the neighborhood graphs are written")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the round reports as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="let the workers print")
+    args = parser.parse_args(argv)
+
+    if args.max_edges is None and args.parts is None:
+        parser.error("pass --max-edges or --parts")
+    graph = nx.read_gml(args.graph)
+    start = time.perf_counter()
+    partition = CityPartition.from_graph(graph, args.max_edges, args.parts, args.seed)
+    print(f"{partition} in {time.perf_counter() - start:.3f}s")
+    city = CitySimulation(partition, args.scheme, args.folder, args.jobs, args.interval, args.sleep_time,
+                          args.virtual_time, args.key_size, random_speed_log_count=args.log_count,
+                          workload=Workload(list(graph.edges), seed=args.seed), verbose=args.verbose)
+    try:
+        for _ in range(args.rounds):
+            report = city.run_round()
+            print(f"round {report['round']}: {report['reports']} reports over {len(report['partitions'])} "
+                  f"neighborhoods in {report['seconds']:.2f}s on {city.jobs} workers, "
+                  f"x{report['parallel_speedup']:.2f} parallel, {report['global_blocks']} global blocks")
+    finally:
+        city.end_run()
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(city.rounds, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
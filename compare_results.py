@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from benchmark import DEFAULT_KEY_SIZE, DEFAULT_POLY_MODULUS_DEGREE, RESULT_FILE_NAMES, SCHEMES
+
+# every metric of the result files is a time or a size, lower is better for all of them
+DEFAULT_TIME_THRESHOLD = 0.10
+DEFAULT_SIZE_THRESHOLD = 0.05
+
+
+def default_parameter(scheme: str) -> Optional[int]:
+    if scheme == "partial":
+        return DEFAULT_KEY_SIZE
+    if scheme == "fully":
+        return DEFAULT_POLY_MODULUS_DEGREE
+    return None
+
+
+def load_results(path: str, scheme: str, parameter: Optional[int] = None) -> Dict[Tuple[str, int], Dict[str, List]]:
+    """
+    The samples of every metric per cell, a cell being a neighborhood and a log count.
+
+    path is a result folder (results/, labresults/, a benchmark output folder), which has one value per cell, or the
+    benchmark_results.jsonl of a benchmark run, which has a value per repetition.
+    """
+    cells: Dict[Tuple[str, int], Dict[str, List]] = {}
+    if os.path.isdir(path):
+        file_path = os.path.join(path, RESULT_FILE_NAMES[scheme])
+        if not os.path.exists(file_path):
+            return cells
+        with open(file_path, 'r') as f:
+            results = json.load(f)
+        for neighborhood, log_counts in results.items():
+            for log_count, metrics in log_counts.items():
+                cells[(neighborhood, int(log_count))] = {metric: [value] for metric, value in metrics.items()
+                                                         if isinstance(value, (int, float))}
+        return cells
+    if parameter is None:
+        parameter = default_parameter(scheme)
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("error") is not None or record.get("data") is None or record["scheme"] != scheme or \
+                    record["parameter"] != parameter:
+                continue
+            metrics = dict(record["data"])
+            metrics["wall_time"] = record.get("wall_time")
+            metrics["peak_memory_kb"] = record.get("peak_memory_kb")
+            cell = cells.setdefault((record["neighborhood"], record["log_count"]), {})
+            for metric, value in metrics.items():
+                if isinstance(value, (int, float)):
+                    cell.setdefault(metric, []).append(value)
+    return cells
+
+
+def ratio(candidate: float, baseline: float) -> Optional[float]:
+    if baseline == 0:
+        return None if candidate != 0 else 1.0
+    return candidate / baseline
+
+
+def cell_ratio_ci(baseline: List[float], candidate: List[float], rng: random.Random, resamples: int,
+                  confidence: float) -> Optional[Tuple[float, float]]:
+    # with repetitions on both sides the ratio of the medians gets its own interval
+    if len(baseline) < 2 or len(candidate) < 2:
+        return None
+    ratios = []
+    for _ in range(resamples):
+        value = ratio(statistics.median(rng.choices(candidate, k=len(candidate))),
+                      statistics.median(rng.choices(baseline, k=len(baseline))))
+        if value is not None:
+            ratios.append(value)
+    if not ratios:
+        return None
+    ratios.sort()
+    tail = (1 - confidence) / 2
+    return ratios[int(tail * (len(ratios) - 1))], ratios[int((1 - tail) * (len(ratios) - 1))]
+
+
+def resampled_median(values: List[float], rng: random.Random) -> float:
+    if len(values) < 2:
+        return values[0]
+    return statistics.median(rng.choices(values, k=len(values)))
+
+
+def pooled_ratio_ci(samples: List[Tuple[List[float], List[float]]], rng: random.Random, resamples: int,
+                    confidence: float) -> Tuple[float, float]:
+    """
+    Bootstrap interval of the median over the cells of candidate median / baseline median. Every resample draws the
+    cells and then the repetitions inside every drawn cell, so both the spread across cells and the noise of the
+    repetitions widen the interval.
+    """
+    estimates = []
+    for _ in range(resamples):
+        ratios = [ratio(resampled_median(candidate, rng), resampled_median(baseline, rng))
+                  for baseline, candidate in rng.choices(samples, k=len(samples))]
+        ratios = [value for value in ratios if value is not None]
+        if ratios:
+            estimates.append(statistics.median(ratios))
+    estimates.sort()
+    tail = (1 - confidence) / 2
+    return estimates[int(tail * (len(estimates) - 1))], estimates[int((1 - tail) * (len(estimates) - 1))]
+
+
+def metric_threshold(metric: str, thresholds: Dict[str, float], time_threshold: float, size_threshold: float) -> float:
+    if metric in thresholds:
+        return thresholds[metric]
+    return time_threshold if metric.endswith("_time") else size_threshold
+
+
+def compare_scheme(baseline: Dict[Tuple[str, int], Dict[str, List]], candidate: Dict[Tuple[str, int], Dict[str, List]],
+                   thresholds: Dict[str, float], time_threshold: float, size_threshold: float,
+                   metrics: Optional[List[str]] = None, resamples: int = 2000, confidence: float = 0.95,
+                   seed: int = 0) -> Dict[str, Dict]:
+    """
+    Compares every metric the aligned cells of both sides have.
+
+    The change of a metric is the median over the cells of candidate median / baseline median, with a bootstrap
+    interval that resamples the cells and the repetitions inside them. It is a regression when the whole interval lies
+    above 1 + the threshold of the metric and an improvement when it lies below 1 - the threshold. A single cell with
+    a single value on each side has insufficient data for a verdict. Cells with repetitions on both sides also get an
+    interval of their own ratio.
+    """
+    rng = random.Random(seed)
+    aligned = sorted(set(baseline) & set(candidate), key=lambda cell: (cell[0], cell[1]))
+    names = sorted({metric for cell in aligned for metric in baseline[cell] if metric in candidate[cell]})
+    if metrics is not None:
+        names = [metric for metric in names if metric in metrics]
+    comparison = {}
+    for metric in names:
+        cells = {}
+        ratios = []
+        samples = []
+        for cell in aligned:
+            if metric not in baseline[cell] or metric not in candidate[cell]:
+                continue
+            baseline_median = statistics.median(baseline[cell][metric])
+            candidate_median = statistics.median(candidate[cell][metric])
+            cell_ratio = ratio(candidate_median, baseline_median)
+            if cell_ratio is None:
+                continue
+            ratios.append(cell_ratio)
+            samples.append((baseline[cell][metric], candidate[cell][metric]))
+            cells[f"{cell[0]}/{cell[1]}"] = {
+                "baseline": baseline_median,
+                "candidate": candidate_median,
+                "ratio": cell_ratio,
+                "ci": cell_ratio_ci(baseline[cell][metric], candidate[cell][metric], rng, resamples, confidence),
+            }
+        if not ratios:
+            continue
+        low, high = pooled_ratio_ci(samples, rng, resamples, confidence)
+        threshold = metric_threshold(metric, thresholds, time_threshold, size_threshold)
+        if len(samples) == 1 and len(samples[0][0]) < 2 and len(samples[0][1]) < 2:
+            # one value against one value says nothing about the noise of the metric
+            verdict = "insufficient data"
+        elif low > 1 + threshold:
+            verdict = "regression"
+        elif high < 1 - threshold:
+            verdict = "improvement"
+        else:
+            verdict = "unchanged"
+        comparison[metric] = {
+            "cells": cells,
+            "aligned_cells": len(ratios),
+            "median_ratio": statistics.median(ratios),
+            "ci": [low, high],
+            "threshold": threshold,
+            "verdict": verdict,
+        }
+    return comparison
+
+
+def parse_thresholds(values: List[str]) -> Dict[str, float]:
+    thresholds = {}
+    for value in values:
+        metric, _, threshold = value.partition("=")
+        thresholds[metric] = float(threshold)
+    return thresholds
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compare a candidate result set against a baseline and fail on "
+                                                 "significant regressions.")
+    parser.add_argument("baseline", help="a result folder such as results/, or a benchmark_results.jsonl")
+    parser.add_argument("candidate", help="a result folder such as benchmark_results/, or a benchmark_results.jsonl")
+    parser.add_argument("--schemes", nargs="+", default=SCHEMES, choices=SCHEMES)
+    parser.add_argument("--parameter", type=int, default=None,
+                        help="key size or poly modulus degree of the jsonl records, defaults to the benchmark defaults")
+    parser.add_argument("--metrics", nargs="+", default=None, help="defaults to every metric both sides have")
+    parser.add_argument("--time-threshold", type=float, default=DEFAULT_TIME_THRESHOLD,
+                        help="relative slowdown of a *_time metric that fails the comparison")
+    parser.add_argument("--size-threshold", type=float, default=DEFAULT_SIZE_THRESHOLD,
+                        help="relative growth of a size metric that fails the comparison")
+    parser.add_argument("--threshold", nargs="+", default=[], metavar="METRIC=FRACTION",
+                        help="thresholds of single metrics, e.g. traffic_block_size=0.01")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--resamples", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the comparison as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="print every aligned cell")
+    args = parser.parse_args(argv)
+
+    thresholds = parse_thresholds(args.threshold)
+    report = {}
+    regressions = []
+    for scheme in args.schemes:
+        baseline = load_results(args.baseline, scheme, args.parameter)
+        candidate = load_results(args.candidate, scheme, args.parameter)
+        if not baseline or not candidate:
+            continue
+        comparison = compare_scheme(baseline, candidate, thresholds, args.time_threshold, args.size_threshold,
+                                    args.metrics, args.resamples, args.confidence, args.seed)
+        if not comparison:
+            continue
+        report[scheme] = comparison
+        for metric, result in comparison.items():
+            low, high = result["ci"]
+            print(f"{scheme:<8} {metric:<42} x{result['median_ratio']:.3f} [{low:.3f}, {high:.3f}] "
+                  f"over {result['aligned_cells']} cells, threshold {result['threshold']:.0%}: {result['verdict']}")
+            if args.verbose:
+                for cell, values in result["cells"].items():
+                    interval = "" if values["ci"] is None else f" [{values['ci'][0]:.3f}, {values['ci'][1]:.3f}]"
+                    print(f"    {cell:<12} {values['baseline']:>14.6g} -> {values['candidate']:<14.6g} "
+                          f"x{values['ratio']:.3f}{interval}")
+            if result["verdict"] == "regression":
+                regressions.append(f"{scheme} {metric} is x{result['median_ratio']:.3f} of the baseline, "
+                                   f"more than {result['threshold']:.0%} over it")
+
+    if not report:
+        print("no cells to compare, the baseline and the candidate share no scheme, neighborhood and log count")
+        sys.exit(2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    for regression in regressions:
+        print(f"regression: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+import argparse
+import heapq
+import math
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+import networkx as nx
+
+from benchmark import DEFAULT_KEY_SIZE
+from Blockchain import Blockchain
+from Blockchain.Metrics import MetricsRegistry, default_registry
+from routing import RoutingEngine
+
+
+def node_coordinates(graph: nx.Graph) -> Optional[Dict]:
+    """
+    The position of every junction, from x and y node attributes or from the lane shapes of a directed SUMO import,
+    None when the graph carries no geometry like the neighborhood graphs.
+    """
+    if all("x" in data and "y" in data for _, data in graph.nodes(data=True)):
+        return {node: (float(data["x"]), float(data["y"])) for node, data in graph.nodes(data=True)}
+    if not graph.is_directed():
+        # an undirected graph does not keep which end of a shape is which junction
+        return None
+    coordinates = {}
+    for start, end, data in graph.edges(data=True):
+        if "shape" not in data:
+            return None
+        points = data["shape"].split()
+        coordinates.setdefault(start, tuple(map(float, points[0].split(","))))
+        coordinates.setdefault(end, tuple(map(float, points[-1].split(","))))
+    return coordinates if len(coordinates) == len(graph) else None
+
+
+def solve_assignment(costs: List[Dict[int, float]], unassigned_cost: Optional[float] = None) -> List[int]:
+    """
+    The column assigned to every row minimizing the total cost, -1 for rows left without one. costs holds the
+    allowed columns of every row with their cost, at least 0, and a row left without a column costs unassigned_cost.
+    Without it as many rows as possible get a column.
+
+    Every row is inserted along a shortest augmenting path, the Hungarian method in the form of Jonker and
+    Volgenant, run as a Dijkstra over the allowed pairs only with potentials that keep the reduced costs at least 0.
+    Leaving a row unassigned is a column of its own, -1 - row. A row with a free candidate nearby mostly reaches it
+    after a handful of pops, and no search goes farther than unassigned_cost.
+    """
+    if unassigned_cost is None:
+        # more than any assignment of allowed pairs, so leaving a row out only pays when nothing else is possible
+        largest = max((cost for allowed in costs for cost in allowed.values()), default=0.0)
+        unassigned_cost = (largest + 1) * (len(costs) + 1)
+    row_potentials = [0.0] * len(costs)
+    column_potentials: Dict[int, float] = defaultdict(float)
+    column_rows: Dict[int, int] = {}
+    row_columns = [-1] * len(costs)
+    for row in range(len(costs)):
+        distances = {}
+        previous_rows = {}
+        settled = {}
+        heap = []
+
+        def relax(holder: int, base: float):
+            for neighbor, cost in list(costs[holder].items()) + [(-1 - holder, unassigned_cost)]:
+                if neighbor in settled:
+                    continue
+                candidate = base + cost - column_potentials[neighbor]
+                if candidate < distances.get(neighbor, math.inf):
+                    distances[neighbor] = candidate
+                    previous_rows[neighbor] = holder
+                    heapq.heappush(heap, (candidate, neighbor))
+
+        relax(row, -row_potentials[row])
+        while True:
+            distance, column = heapq.heappop(heap)
+            if column in settled:
+                continue
+            settled[column] = distance
+            if column not in column_rows:
+                break
+            # a matched pair has reduced cost 0, the search goes on from the row holding the column
+            holder = column_rows[column]
+            relax(holder, distance - row_potentials[holder])
+        total = settled[column]
+        for settled_column, distance in settled.items():
+            column_potentials[settled_column] -= total - distance
+            if settled_column in column_rows:
+                row_potentials[column_rows[settled_column]] += total - distance
+        row_potentials[row] += total
+        while True:
+            holder = previous_rows[column]
+            previous_column = row_columns[holder]
+            row_columns[holder] = column
+            column_rows[column] = holder
+            if holder == row:
+                break
+            column = previous_column
+    return [column if column >= 0 else -1 for column in row_columns]
+
+
+def greedy_assignment(costs: List[Dict[int, float]]) -> List[int]:
+    """Every row in turn takes its cheapest free column, what dispatching the requests one by one would do."""
+    taken = set()
+    assignment = []
+    for allowed in costs:
+        free = [(cost, column) for column, cost in allowed.items() if column not in taken]
+        column = min(free)[1] if free else -1
+        if column >= 0:
+            taken.add(column)
+        assignment.append(column)
+    return assignment
+
+
+class TaxiIndex:
+    """
+    A uniform grid over the positions of the available taxis. Taxis are added and removed as they are booked and
+    set free, and nearest walks the rings of cells around a point until no unvisited cell can be closer than the
+    k-th taxi found.
+    """
+
+    def __init__(self, cell_size: float = 250):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], Set] = defaultdict(set)
+        self.positions: Dict[Hashable, Tuple[float, float]] = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell(self, position: Tuple[float, float]) -> Tuple[int, int]:
+        return int(math.floor(position[0] / self.cell_size)), int(math.floor(position[1] / self.cell_size))
+
+    def add(self, taxi: Hashable, position: Tuple[float, float]):
+        self.remove(taxi)
+        self.positions[taxi] = position
+        self.cells[self.cell(position)].add(taxi)
+
+    def remove(self, taxi: Hashable):
+        position = self.positions.pop(taxi, None)
+        if position is None:
+            return
+        cell = self.cell(position)
+        self.cells[cell].discard(taxi)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def nearest(self, position: Tuple[float, float], k: int) -> List:
+        if not self.positions:
+            return []
+        x, y = position
+        center_x, center_y = self.cell(position)
+        found = []
+        ring = 0
+        while True:
+            cells = [(center_x + dx, center_y + dy) for dx in range(-ring, ring + 1) for dy in range(-ring, ring + 1)
+                     if max(abs(dx), abs(dy)) == ring]
+            for cell in cells:
+                for taxi in self.cells.get(cell, ()):
+                    taxi_x, taxi_y = self.positions[taxi]
+                    found.append(((taxi_x - x) ** 2 + (taxi_y - y) ** 2, taxi))
+            if len(found) == len(self.positions):
+                break
+            # every taxi outside the rings walked so far is at least ring cells away
+            if len(found) >= k:
+                found.sort(key=lambda item: item[0])
+                if found[k - 1][0] <= (ring * self.cell_size) ** 2:
+                    break
+            ring += 1
+        found.sort(key=lambda item: item[0])
+        return [taxi for _, taxi in found[:k]]
+
+
+class DispatchEngine:
+    """
+    Matches ride requests to available taxis in batch windows, by the pickup time at the approved traffic speeds.
+
+    Requests are collected until dispatch is called at the end of a window. For every pickup junction the k nearest
+    available taxis are candidates, from a grid over the junction positions when the graph has them and otherwise
+    from a search backwards from the pickup over the current travel times. The pickup times of the candidates come
+    from one many to one search per pickup junction, and the batch is assigned to minimize their total instead of
+    giving every request in turn its closest taxi. Requests that get no taxi wait for the next window, for at most
+    max_wait seconds when it is set. With max_pickup no taxi farther away than that is sent, and leaving a request
+    waiting counts as a pickup of max_pickup seconds, otherwise as many requests as possible get a taxi.
+    """
+
+    def __init__(self, engine: RoutingEngine, coordinates: Optional[Dict] = None, k: int = 8, cell_size: float = 250,
+                 max_wait: Optional[float] = None, max_pickup: Optional[float] = None,
+                 metrics: Optional[MetricsRegistry] = None):
+        self.engine = engine
+        self.k = k
+        self.max_wait = max_wait
+        self.max_pickup = max_pickup
+        self.coordinates = coordinates
+        self.index = TaxiIndex(cell_size) if coordinates is not None else None
+        self.metrics = metrics if metrics is not None else default_registry
+        self.taxi_nodes: Dict[Hashable, Hashable] = {}
+        # the available taxis waiting at every junction
+        self.node_taxis: Dict[int, Set] = defaultdict(set)
+        self.pending: List[Tuple[Hashable, Hashable, float]] = []
+        self.stats = {"requests": 0, "assigned": 0, "expired": 0, "batches": 0, "pickup_seconds": 0.0,
+                      "candidate_seconds": 0.0, "eta_seconds": 0.0, "assignment_seconds": 0.0}
+
+    @staticmethod
+    def from_graph(graph: nx.Graph, **kwargs) -> 'DispatchEngine':
+        routing_kwargs = {name: kwargs.pop(name) for name in ("landmark_count", "seed") if name in kwargs}
+        return DispatchEngine(RoutingEngine(graph, **routing_kwargs), node_coordinates(graph), **kwargs)
+
+    def add_taxi(self, taxi: Hashable, node: Hashable):
+        """Adds an available taxi at a junction, or moves it there."""
+        self.remove_taxi(taxi)
+        self.taxi_nodes[taxi] = node
+        self.node_taxis[self.engine.node_index[node]].add(taxi)
+        if self.index is not None:
+            self.index.add(taxi, self.coordinates[node])
+
+    def remove_taxi(self, taxi: Hashable):
+        """Takes a taxi out of dispatch, when it is booked or goes off duty."""
+        node = self.taxi_nodes.pop(taxi, None)
+        if node is None:
+            return
+        self.node_taxis[self.engine.node_index[node]].discard(taxi)
+        if self.index is not None:
+            self.index.remove(taxi)
+
+    def available(self) -> int:
+        return len(self.taxi_nodes)
+
+    def request(self, request: Hashable, pickup: Hashable, submitted: float = 0.0):
+        self.pending.append((request, pickup, submitted))
+        self.stats["requests"] += 1
+
+    def nearest_taxis(self, pickup: int, count: int) -> Dict:
+        """
+        The count closest taxis by travel time and their pickup times, searching backwards from the pickup no farther
+        than max_pickup.
+        """
+        backward, weights, node_taxis = self.engine.backward, self.engine.weights, self.node_taxis
+        distances = {pickup: 0.0}
+        settled = set()
+        found = {}
+        limit = self.max_pickup if self.max_pickup is not None else math.inf
+        heap = [(0.0, pickup)]
+        while heap and len(found) < count:
+            distance, node = heapq.heappop(heap)
+            if distance > limit:
+                break
+            if node in settled:
+                continue
+            settled.add(node)
+            for taxi in node_taxis.get(node, ()):
+                found[taxi] = distance
+            for neighbor, arc in backward[node]:
+                candidate = distance + weights[arc]
+                if candidate < distances.get(neighbor, math.inf):
+                    distances[neighbor] = candidate
+                    heapq.heappush(heap, (candidate, neighbor))
+        return found
+
+    def candidate_etas(self, pickups: Dict[Hashable, int]) -> Dict[Hashable, Dict]:
+        """The candidate taxis of every pickup junction with their pickup times, for count requests there."""
+        etas = {}
+        if not self.taxi_nodes:
+            return {pickup: {} for pickup in pickups}
+        for pickup, count in pickups.items():
+            # the requests at one junction share their candidates, so every one of them can still get a taxi
+            wanted = self.k + count - 1
+            if self.index is None:
+                etas[pickup] = self.nearest_taxis(self.engine.node_index[pickup], wanted)
+                continue
+            start = time.perf_counter()
+            taxis = self.index.nearest(self.coordinates[pickup], wanted)
+            self.stats["candidate_seconds"] += time.perf_counter() - start
+            start = time.perf_counter()
+            node_etas = self.engine.etas_to(pickup, {self.taxi_nodes[taxi] for taxi in taxis})
+            self.stats["eta_seconds"] += time.perf_counter() - start
+            etas[pickup] = {taxi: node_etas[self.taxi_nodes[taxi]] for taxi in taxis}
+        return etas
+
+    def candidate_costs(self, requests: List[Tuple]) -> Tuple[List[Dict[int, float]], List]:
+        """The pickup times of every request from its candidate taxis by taxi column, and the taxi of every column."""
+        pickups = defaultdict(int)
+        for _, pickup, _ in requests:
+            pickups[pickup] += 1
+        start = time.perf_counter()
+        etas = self.candidate_etas(pickups)
+        if self.index is None:
+            self.stats["candidate_seconds"] += time.perf_counter() - start
+        taxis = list(dict.fromkeys(taxi for pickup in pickups for taxi in etas[pickup]))
+        columns = {taxi: column for column, taxi in enumerate(taxis)}
+        limit = self.max_pickup if self.max_pickup is not None else math.inf
+        pickup_costs = {pickup: {columns[taxi]: eta for taxi, eta in taxi_etas.items() if eta <= limit}
+                        for pickup, taxi_etas in etas.items()}
+        return [pickup_costs[pickup] for _, pickup, _ in requests], taxis
+
+    def dispatch(self, now: Optional[float] = None, solver=solve_assignment) -> List[Tuple[Hashable, Hashable, float]]:
+        """
+        Assigns the requests of the window, returns (request, taxi, pickup seconds) for every match and takes the
+        matched taxis out of dispatch. Requests without a taxi stay pending, until they waited max_wait at now.
+        """
+        requests, self.pending = self.pending, []
+        if now is not None and self.max_wait is not None:
+            waiting = [request for request in requests if now - request[2] <= self.max_wait]
+            self.stats["expired"] += len(requests) - len(waiting)
+            self.metrics.counter("dispatch_requests", result="expired").inc(len(requests) - len(waiting))
+            requests = waiting
+        if not requests:
+            return []
+        with self.metrics.timer("dispatch_batch"):
+            costs, taxis = self.candidate_costs(requests)
+            start = time.perf_counter()
+            assignment = solver(costs, self.max_pickup)
+            self.stats["assignment_seconds"] += time.perf_counter() - start
+        matches = []
+        for row, column in enumerate(assignment):
+            if column < 0:
+                self.pending.append(requests[row])
+                continue
+            matches.append((requests[row][0], taxis[column], costs[row][column]))
+            self.remove_taxi(taxis[column])
+        self.stats["batches"] += 1
+        self.stats["assigned"] += len(matches)
+        self.stats["pickup_seconds"] += sum(eta for _, _, eta in matches)
+        self.metrics.counter("dispatch_requests", result="assigned").inc(len(matches))
+        return matches
+
+    def update_from_chain(self, blockchain: Blockchain) -> int:
+        """Applies the approved averages the chain got since the last update, the next windows route over them."""
+        return len(self.engine.update_from_chain(blockchain))
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["mean_pickup_seconds"] = stats["pickup_seconds"] / stats["assigned"] if stats["assigned"] else None
+        return stats
+
+    def __str__(self):
+        search = "a grid over the junctions" if self.index is not None else "searches over the street graph"
+        return f"Dispatch over {len(self.engine.nodes)} junctions with {self.available()} available taxis, " \
+               f"{self.k} candidates per request from {search}"
+
+
+def benchmark_dispatch(dispatcher: DispatchEngine, taxis: int, rate: float, duration: float, window: float,
+                       trip_seconds: Tuple[float, float], rng: random.Random) -> Dict:
+    """
+    Requests arriving at rate per second for duration seconds of simulated time, dispatched every window seconds.
+    A booked taxi drives to the pickup, is busy for a trip of trip_seconds and comes back free at a random junction.
+    The throughput is the requests over the wall time spent dispatching, and the greedy pickup total is what
+    handing out the same batches request by request would have cost.
+    """
+    nodes = dispatcher.engine.nodes
+    for taxi in range(taxis):
+        dispatcher.add_taxi(taxi, rng.choice(nodes))
+    returning = []
+    totals = {"greedy": 0.0, "greedy_assigned": 0, "greedy_seconds": 0.0}
+
+    def solver(costs: List[Dict[int, float]], unassigned_cost: Optional[float]) -> List[int]:
+        # the greedy total on the same batch, kept out of the timings
+        start = time.perf_counter()
+        greedy = greedy_assignment(costs)
+        totals["greedy"] += sum(costs[row][column] for row, column in enumerate(greedy) if column >= 0)
+        totals["greedy_assigned"] += sum(1 for column in greedy if column >= 0)
+        totals["greedy_seconds"] += time.perf_counter() - start
+        return solve_assignment(costs, unassigned_cost)
+
+    dispatch_seconds = 0.0
+    request = 0
+    now = 0.0
+    while now < duration:
+        now += window
+        while returning and returning[0][0] <= now:
+            _, taxi, node = heapq.heappop(returning)
+            dispatcher.add_taxi(taxi, node)
+        for _ in range(int(rate * window)):
+            dispatcher.request(request, rng.choice(nodes), now)
+            request += 1
+        start = time.perf_counter()
+        matches = dispatcher.dispatch(now, solver)
+        dispatch_seconds += time.perf_counter() - start
+        for _, taxi, eta in matches:
+            heapq.heappush(returning, (now + eta + rng.uniform(*trip_seconds), taxi, rng.choice(nodes)))
+    dispatcher.stats["assignment_seconds"] -= totals["greedy_seconds"]
+    dispatch_seconds -= totals["greedy_seconds"]
+    stats = dispatcher.get_stats()
+    stats["seconds"] = dispatch_seconds
+    stats["requests_per_second"] = stats["requests"] / dispatch_seconds if dispatch_seconds else None
+    stats["greedy_pickup_seconds"] = totals["greedy"]
+    stats["greedy_assigned"] = totals["greedy_assigned"]
+    return stats
+
+
+def load_graph(path: str) -> nx.Graph:
+    # a SUMO net keeps the lane shapes that place the junctions
+    if path.endswith((".net.xml", ".net.xml.gz")):
+        from sumo import SumoNet
+        return SumoNet.from_net_file(path).graph
+    return nx.read_gml(path)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Dispatch a stream of ride requests to a taxi fleet in batch "
+                                                 "windows and measure the throughput and the pickup times.")
+    parser.add_argument("--graph", default="BerlinSumo/osm.net.xml",
+                        help="street graph, a GML graph or a SUMO net whose shapes place the junctions")
+    parser.add_argument("--scheme", default="none", choices=["none", "single", "two", "partial"],
+                        help="run a round of this scheme on the graph and dispatch over its averages")
+    parser.add_argument("--key-size", type=int, default=DEFAULT_KEY_SIZE)
+    parser.add_argument("--taxis", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=2000, help="ride requests per second of simulated time")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of simulated time")
+    parser.add_argument("--window", type=float, default=1, help="seconds a batch collects requests")
+    parser.add_argument("--k", type=int, default=8, help="candidate taxis per request")
+    parser.add_argument("--max-wait", type=float, default=60, help="seconds a request waits for a taxi")
+    parser.add_argument("--max-pickup", type=float, default=600, help="seconds a taxi drives at most to a pickup")
+    parser.add_argument("--trip-seconds", nargs=2, type=float, default=[5, 20])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    graph = load_graph(args.graph)
+    dispatcher = DispatchEngine.from_graph(graph, k=args.k, max_wait=args.max_wait,
+                                          max_pickup=args.max_pickup, seed=args.seed)
+    if args.scheme != "none":
+        from city import create_partition_simulation
+        from routing import traffic_chain
+        with tempfile.TemporaryDirectory() as folder:
+            # the schemes read their street graph from a GML file
+            graph_path = os.path.join(folder, "dispatch.gml")
+            nx.write_gml(graph, graph_path)
+            simulation = create_partition_simulation(args.scheme, "dispatch", graph_path, interval=10,
+                                                     sleep_time=0.2, virtual_time=True, key_size=args.key_size)
+        simulation.run()
+        print(f"{dispatcher.update_from_chain(traffic_chain(simulation))} edges updated from the {args.scheme} "
+              f"scheme")
+        simulation.end_run()
+    stats = benchmark_dispatch(dispatcher, args.taxis, args.rate, args.duration, args.window,
+                               tuple(args.trip_seconds), random.Random(args.seed))
+    print(dispatcher)
+    print(f"{stats['requests']} requests, {stats['assigned']} assigned and {stats['expired']} expired in "
+          f"{stats['batches']} batches, {stats['requests_per_second']:.0f} requests per second")
+    print(f"candidates {stats['candidate_seconds']:.3f}s, ETAs {stats['eta_seconds']:.3f}s, "
+          f"assignment {stats['assignment_seconds']:.3f}s")
+    print(f"batched: {stats['assigned']} pickups in {stats['pickup_seconds']:.0f}s, request by request: "
+          f"{stats['greedy_assigned']} pickups in {stats['greedy_pickup_seconds']:.0f}s")
+
+
+if __name__ == '__main__':
+    main()
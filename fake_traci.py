@@ -0,0 +1,320 @@
+import socket
+import struct
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from fcd import FcdTrace
+
+# the TraCI commands and variables the server answers, as in traci.constants
+TRACI_VERSION = 22
+CMD_GETVERSION = 0x00
+CMD_SIMSTEP = 0x02
+CMD_SETORDER = 0x03
+CMD_CLOSE = 0x7F
+CMD_GET_VEHICLE_VARIABLE = 0xa4
+CMD_GET_SIM_VARIABLE = 0xab
+CMD_SUBSCRIBE_VEHICLE_VARIABLE = 0xd4
+CMD_SUBSCRIBE_SIM_VARIABLE = 0xdb
+CMD_SUBSCRIBE_JUNCTION_CONTEXT = 0x89
+# the response of a get or subscribe command is the command plus 0x10
+RESPONSE_OFFSET = 0x10
+
+TRACI_ID_LIST = 0x00
+ID_COUNT = 0x01
+VAR_SPEED = 0x40
+VAR_ROAD_ID = 0x50
+VAR_TIME = 0x66
+VAR_DEPARTED_VEHICLES_IDS = 0x74
+VAR_ARRIVED_VEHICLES_IDS = 0x7a
+VAR_MIN_EXPECTED_VEHICLES = 0x7d
+
+TYPE_INTEGER = 0x09
+TYPE_DOUBLE = 0x0B
+TYPE_STRING = 0x0C
+TYPE_STRINGLIST = 0x0E
+
+RTYPE_OK = 0x00
+RTYPE_NOTIMPLEMENTED = 0x01
+RTYPE_ERR = 0xFF
+
+
+class TraciProtocolError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(self.message)
+
+
+def pack_string(value: str) -> bytes:
+    encoded = value.encode("utf8")
+    return struct.pack("!i", len(encoded)) + encoded
+
+
+def pack_value(value) -> bytes:
+    # typed values the way SUMO sends them
+    if isinstance(value, str):
+        return struct.pack("!B", TYPE_STRING) + pack_string(value)
+    if isinstance(value, int):
+        return struct.pack("!Bi", TYPE_INTEGER, value)
+    if isinstance(value, float):
+        return struct.pack("!Bd", TYPE_DOUBLE, value)
+    return struct.pack("!Bi", TYPE_STRINGLIST, len(value)) + b"".join(pack_string(item) for item in value)
+
+
+def pack_command(command: int, content: bytes) -> bytes:
+    # the length counts itself, a length above 255 is a zero byte and an int
+    if len(content) + 2 <= 255:
+        return struct.pack("!BB", len(content) + 2, command) + content
+    return struct.pack("!BiB", 0, len(content) + 6, command) + content
+
+
+def pack_status(command: int, result: int = RTYPE_OK, description: str = "") -> bytes:
+    return pack_command(command, struct.pack("!B", result) + pack_string(description))
+
+
+class Reader:
+    def __init__(self, content: bytes, position: int = 0):
+        self.content = content
+        self.position = position
+
+    def read(self, format: str) -> Tuple:
+        values = struct.unpack_from(format, self.content, self.position)
+        self.position += struct.calcsize(format)
+        return values
+
+    def read_string(self) -> str:
+        length = self.read("!i")[0]
+        value = self.content[self.position:self.position + length].decode("utf8")
+        self.position += length
+        return value
+
+
+class FakeTraciServer:
+    """
+    A TraCI server that plays a recorded FCD trace instead of simulating, for the commands ingestion needs.
+
+    Every simulation step moves on to the next step of the trace. It answers the version, step, order and close
+    commands, gets of the vehicle ids, count, speed and road and of the time, departed, arrived and expected vehicles,
+    and vehicle, simulation and junction context subscriptions. The trace has no positions, so a context subscription
+    around any junction sees every vehicle whatever its range. Other commands are answered as not implemented. The
+    traci client connects to it like to SUMO, traci.init(server.port), and it serves one client at a time.
+    """
+
+    def __init__(self, trace: FcdTrace, host: str = "localhost", port: int = 0):
+        self.trace = trace
+        self.steps = list(trace.steps())
+        self.host = host
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.port = self.socket.getsockname()[1]
+        self.thread: Optional[threading.Thread] = None
+        # the last step every vehicle is in, a vehicle is expected until then
+        self.last_steps: Dict[str, int] = {}
+        for index, (_, rows) in enumerate(self.steps):
+            for vehicle in trace.vehicles[rows].tolist():
+                self.last_steps[trace.vehicle_ids[vehicle]] = index
+        self.messages = 0
+        self.commands = 0
+        self.reset()
+
+    def reset(self):
+        self.step_index = -1
+        self.time = self.steps[0][0] - 1 if self.steps else 0.0
+        self.vehicles: Dict[str, Tuple[str, float]] = {}
+        self.departed: List[str] = []
+        self.arrived: List[str] = []
+        self.seen: Set[str] = set()
+        self.vehicle_subscriptions: Dict[str, List[int]] = {}
+        self.simulation_subscription: List[int] = []
+        self.context_subscriptions: Dict[str, Tuple[int, List[int]]] = {}
+
+    def start(self) -> int:
+        self.socket.listen(1)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.socket.close()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with client:
+                self.reset()
+                self.handle(client)
+
+    def handle(self, client: socket.socket):
+        while True:
+            message = self.receive(client)
+            if message is None:
+                return
+            self.messages += 1
+            reader = Reader(message)
+            response = b""
+            closing = False
+            while reader.position < len(message):
+                start = reader.position
+                length = reader.read("!B")[0]
+                if length == 0:
+                    length = reader.read("!i")[0]
+                command = reader.read("!B")[0]
+                self.commands += 1
+                response += self.command(command, Reader(message[:start + length], reader.position))
+                reader.position = start + length
+                closing = closing or command == CMD_CLOSE
+            client.sendall(struct.pack("!i", len(response) + 4) + response)
+            if closing:
+                return
+
+    @staticmethod
+    def receive(client: socket.socket) -> Optional[bytes]:
+        header = b""
+        while len(header) < 4:
+            chunk = client.recv(4 - len(header))
+            if not chunk:
+                return None
+            header += chunk
+        length = struct.unpack("!i", header)[0] - 4
+        message = b""
+        while len(message) < length:
+            chunk = client.recv(length - len(message))
+            if not chunk:
+                return None
+            message += chunk
+        return message
+
+    def command(self, command: int, reader: Reader) -> bytes:
+        try:
+            if command == CMD_GETVERSION:
+                return pack_status(command) + pack_command(command, struct.pack("!i", TRACI_VERSION) +
+                                                           pack_string("fake TraCI server replaying an FCD trace"))
+            if command in (CMD_SETORDER, CMD_CLOSE):
+                return pack_status(command)
+            if command == CMD_SIMSTEP:
+                target = reader.read("!d")[0]
+                self.advance(target)
+                return pack_status(command) + self.subscription_results()
+            if command in (CMD_GET_VEHICLE_VARIABLE, CMD_GET_SIM_VARIABLE):
+                variable = reader.read("!B")[0]
+                object_id = reader.read_string()
+                value = self.vehicle_variable(object_id, variable) if command == CMD_GET_VEHICLE_VARIABLE else \
+                    self.simulation_variable(variable)
+                return pack_status(command) + pack_command(command + RESPONSE_OFFSET, struct.pack("!B", variable) +
+                                                           pack_string(object_id) + pack_value(value))
+            if command in (CMD_SUBSCRIBE_VEHICLE_VARIABLE, CMD_SUBSCRIBE_SIM_VARIABLE):
+                reader.read("!dd")
+                object_id = reader.read_string()
+                variables = list(reader.read(f"!{reader.read('!B')[0]}B"))
+                if command == CMD_SUBSCRIBE_SIM_VARIABLE:
+                    self.simulation_subscription = variables
+                elif not variables:
+                    self.vehicle_subscriptions.pop(object_id, None)
+                elif object_id not in self.vehicles:
+                    raise TraciProtocolError(f"Vehicle '{object_id}' is not known")
+                else:
+                    self.vehicle_subscriptions[object_id] = variables
+                if not variables:
+                    return pack_status(command)
+                return pack_status(command) + self.variable_subscription(command, object_id, variables)
+            if command == CMD_SUBSCRIBE_JUNCTION_CONTEXT:
+                reader.read("!dd")
+                object_id = reader.read_string()
+                domain = reader.read("!B")[0]
+                reader.read("!d")
+                variables = list(reader.read(f"!{reader.read('!B')[0]}B"))
+                if domain != CMD_GET_VEHICLE_VARIABLE:
+                    raise TraciProtocolError("only vehicles can be subscribed around a junction")
+                if not variables:
+                    self.context_subscriptions.pop(object_id, None)
+                    return pack_status(command)
+                self.context_subscriptions[object_id] = (domain, variables)
+                return pack_status(command) + self.context_subscription(object_id, domain, variables)
+            return pack_status(command, RTYPE_NOTIMPLEMENTED, f"command {command:#04x} is not replayed")
+        except TraciProtocolError as error:
+            return pack_status(command, RTYPE_ERR, error.message)
+
+    def advance(self, target: float):
+        # one step, or every step up to target seconds like SUMO
+        self.departed = []
+        self.arrived = []
+        while self.step_index + 1 < len(self.steps):
+            self.step_index += 1
+            self.time, rows = self.steps[self.step_index]
+            previous = self.vehicles
+            self.vehicles = {}
+            for vehicle, edge, speed in zip(self.trace.vehicles[rows].tolist(), self.trace.edges[rows].tolist(),
+                                            self.trace.speeds[rows].tolist()):
+                vehicle_id = self.trace.vehicle_ids[vehicle]
+                self.vehicles[vehicle_id] = (self.trace.edge_ids[edge], speed)
+                if vehicle_id not in self.seen:
+                    self.seen.add(vehicle_id)
+                    self.departed.append(vehicle_id)
+            for vehicle_id in previous:
+                if self.last_steps[vehicle_id] < self.step_index:
+                    self.arrived.append(vehicle_id)
+                    self.vehicle_subscriptions.pop(vehicle_id, None)
+            if target <= self.time or self.step_index + 1 >= len(self.steps) or \
+                    self.steps[self.step_index + 1][0] > target:
+                break
+        if self.step_index + 1 >= len(self.steps) and self.time < target:
+            self.time = target
+
+    def vehicle_variable(self, vehicle_id: str, variable: int):
+        if variable == TRACI_ID_LIST:
+            return list(self.vehicles)
+        if variable == ID_COUNT:
+            return len(self.vehicles)
+        if vehicle_id not in self.vehicles:
+            # a vehicle can sit in a junction between two steps of the trace
+            raise TraciProtocolError(f"Vehicle '{vehicle_id}' is not known")
+        edge, speed = self.vehicles[vehicle_id]
+        if variable == VAR_SPEED:
+            return float(speed)
+        if variable == VAR_ROAD_ID:
+            return edge
+        raise TraciProtocolError(f"vehicle variable {variable:#04x} is not replayed")
+
+    def simulation_variable(self, variable: int):
+        if variable == VAR_TIME:
+            return float(self.time)
+        if variable == VAR_DEPARTED_VEHICLES_IDS:
+            return self.departed
+        if variable == VAR_ARRIVED_VEHICLES_IDS:
+            return self.arrived
+        if variable == VAR_MIN_EXPECTED_VEHICLES:
+            return sum(1 for last in self.last_steps.values() if last > self.step_index)
+        raise TraciProtocolError(f"simulation variable {variable:#04x} is not replayed")
+
+    def variable_subscription(self, command: int, object_id: str, variables: List[int]) -> bytes:
+        content = pack_string(object_id) + struct.pack("!B", len(variables))
+        for variable in variables:
+            value = self.simulation_variable(variable) if command == CMD_SUBSCRIBE_SIM_VARIABLE else \
+                self.vehicle_variable(object_id, variable)
+            content += struct.pack("!BB", variable, RTYPE_OK) + pack_value(value)
+        return pack_command(command + RESPONSE_OFFSET, content)
+
+    def context_subscription(self, object_id: str, domain: int, variables: List[int]) -> bytes:
+        content = pack_string(object_id) + struct.pack("!BBi", domain, len(variables), len(self.vehicles))
+        for vehicle_id in self.vehicles:
+            content += pack_string(vehicle_id)
+            for variable in variables:
+                content += struct.pack("!BB", variable, RTYPE_OK) + pack_value(self.vehicle_variable(vehicle_id,
+                                                                                                      variable))
+        return pack_command(CMD_SUBSCRIBE_JUNCTION_CONTEXT + RESPONSE_OFFSET, content)
+
+    def subscription_results(self) -> bytes:
+        # every subscription answers again with each step
+        results = []
+        if self.simulation_subscription:
+            results.append(self.variable_subscription(CMD_SUBSCRIBE_SIM_VARIABLE, "", self.simulation_subscription))
+        for vehicle_id, variables in self.vehicle_subscriptions.items():
+            if vehicle_id in self.vehicles:
+                results.append(self.variable_subscription(CMD_SUBSCRIBE_VEHICLE_VARIABLE, vehicle_id, variables))
+        for object_id, (domain, variables) in self.context_subscriptions.items():
+            results.append(self.context_subscription(object_id, domain, variables))
+        return struct.pack("!i", len(results)) + b"".join(results)
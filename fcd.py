@@ -0,0 +1,246 @@
+import argparse
+import math
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from lxml import etree
+
+from benchmark import DEFAULT_KEY_SIZE
+from sumo import load_sumo_edge_ids, open_sumo_file
+from workload import Workload, WorkloadBatch
+
+# SUMO reports speeds in m/s, the traffic logs carry km/h like the notebooks sent them
+KMH_PER_MS = 3.6
+
+
+def lane_edge(lane_id: str) -> str:
+    # lane ids are the edge id and the lane index, "-1009114665#1_0"
+    return lane_id.rsplit("_", 1)[0]
+
+
+def iter_fcd_steps(input_path: str) -> Iterator[Tuple[float, List[Tuple[str, str, float]]]]:
+    """
+    Streams the time steps of a SUMO FCD output (sumo --fcd-output), as the step time and the (vehicle, edge, speed
+    in m/s) of every vehicle on a normal edge. Vehicles inside a junction are on an internal edge and are left out.
+    """
+    with open_sumo_file(input_path) as f:
+        for _, element in etree.iterparse(f, events=("end",), tag="timestep"):
+            reports = []
+            for vehicle in element.iter("vehicle", "person"):
+                edge = vehicle.get("edge")
+                if edge is None:
+                    lane = vehicle.get("lane")
+                    if lane is None:
+                        continue
+                    edge = lane_edge(lane)
+                if edge.startswith(":"):
+                    continue
+                reports.append((vehicle.get("id"), edge, float(vehicle.get("speed", 0))))
+            yield float(element.get("time")), reports
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+class FcdTrace:
+    """
+    A recorded FCD trace as columns, one row per report in step order: the step time, the vehicle and the SUMO edge as
+    indices into vehicle_ids and edge_ids, and the speed in m/s. Saved as .npz it is a fraction of the XML.
+    """
+
+    def __init__(self, times: np.ndarray, vehicles: np.ndarray, edges: np.ndarray, speeds: np.ndarray,
+                 vehicle_ids: List[str], edge_ids: List[str]):
+        self.times = times
+        self.vehicles = vehicles
+        self.edges = edges
+        self.speeds = speeds
+        self.vehicle_ids = vehicle_ids
+        self.edge_ids = edge_ids
+
+    @staticmethod
+    def from_xml(input_path: str) -> 'FcdTrace':
+        vehicle_index: Dict[str, int] = {}
+        edge_index: Dict[str, int] = {}
+        times, vehicles, edges, speeds = [], [], [], []
+        for time, reports in iter_fcd_steps(input_path):
+            for vehicle, edge, speed in reports:
+                times.append(time)
+                vehicles.append(vehicle_index.setdefault(vehicle, len(vehicle_index)))
+                edges.append(edge_index.setdefault(edge, len(edge_index)))
+                speeds.append(speed)
+        return FcdTrace(np.array(times, dtype=np.float64), np.array(vehicles, dtype=np.uint32),
+                        np.array(edges, dtype=np.uint32), np.array(speeds, dtype=np.float32),
+                        list(vehicle_index), list(edge_index))
+
+    @staticmethod
+    def load(input_path: str) -> 'FcdTrace':
+        # .npz written by save, anything else is read as FCD XML
+        if not input_path.endswith(".npz"):
+            return FcdTrace.from_xml(input_path)
+        with np.load(input_path) as data:
+            return FcdTrace(data["times"], data["vehicles"], data["edges"], data["speeds"],
+                            data["vehicle_ids"].tolist(), data["edge_ids"].tolist())
+
+    def save(self, output_path: str):
+        np.savez_compressed(output_path, times=self.times, vehicles=self.vehicles, edges=self.edges,
+                            speeds=self.speeds, vehicle_ids=np.array(self.vehicle_ids),
+                            edge_ids=np.array(self.edge_ids))
+
+    def steps(self) -> Iterator[Tuple[float, np.ndarray]]:
+        # the step time and the rows of the step
+        if len(self.times) == 0:
+            return
+        boundaries = np.flatnonzero(np.diff(self.times)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(self.times)]))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield float(self.times[start]), np.arange(start, end)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __str__(self):
+        return f"FCD trace with {len(self)} reports of {len(self.vehicle_ids)} vehicles on {len(self.edge_ids)} edges"
+
+
+class FcdReplay:
+    """
+    Replays a recorded FCD trace into a simulation in simulated time order, without SUMO or traci.
+
+    replay sends every step's reports through simulation.send_sumo_traffic, as fast as possible or paced on the
+    simulation clock at speedup times the recorded time. With the SUMO id map of the street graph of the simulation
+    (sumo.py writes it next to the graph) a replay is also a workload: simulation.workload = FcdReplay(...) streams the
+    next random_speed_log_count reports of the trace every round, through send_traffic_log of any scheme.
+    """
+
+    def __init__(self, trace: FcdTrace, sumo_id_to_edge: Optional[Dict[str, Tuple]] = None,
+                 speedup: Optional[float] = None):
+        self.trace = trace
+        self.sumo_id_to_edge = sumo_id_to_edge
+        self.speedup = speedup
+        # the next report a workload round starts at
+        self.position = 0
+        self.graph_edges: List[Tuple] = []
+        # graph edge index of every trace edge, -1 outside the street graph
+        self.trace_edge_index = np.full(len(trace.edge_ids), -1, dtype=np.int64)
+        if sumo_id_to_edge is not None:
+            self.graph_edges = list(dict.fromkeys(sumo_id_to_edge.values()))
+            graph_edge_index = {edge: index for index, edge in enumerate(self.graph_edges)}
+            self.trace_edge_index = np.array([graph_edge_index.get(sumo_id_to_edge.get(sumo_id), -1)
+                                              for sumo_id in trace.edge_ids], dtype=np.int64)
+
+    @staticmethod
+    def from_files(trace_path: str, ids_path: Optional[str] = None, speedup: Optional[float] = None) -> 'FcdReplay':
+        sumo_id_to_edge = None
+        if ids_path is not None:
+            sumo_id_to_edge = {sumo_id: (start, end) for start, end, sumo_id in load_sumo_edge_ids(ids_path)}
+        return FcdReplay(FcdTrace.load(trace_path), sumo_id_to_edge, speedup)
+
+    def replay(self, simulation, start: float = 0, end: Optional[float] = None) -> int:
+        """Sends the reports of the steps from start to end seconds and returns how many were sent."""
+        known = simulation.sumo_id_to_edge
+        edge_ids = self.trace.edge_ids
+        clock = simulation.clock
+        started = clock.now()
+        first_time = None
+        sent = 0
+        for time, rows in self.trace.steps():
+            if time < start:
+                continue
+            if end is not None and time > end:
+                break
+            if first_time is None:
+                first_time = time
+            if self.speedup is not None:
+                wait = (time - first_time) / self.speedup - (clock.now() - started).total_seconds()
+                if wait > 0:
+                    clock.sleep(wait)
+            for edge, speed in zip(self.trace.edges[rows].tolist(), self.trace.speeds[rows].tolist()):
+                # edges outside the street graph of the simulation
+                if edge_ids[edge] not in known:
+                    continue
+                simulation.send_sumo_traffic(edge_ids[edge], int(speed * KMH_PER_MS))
+                sent += 1
+        return sent
+
+    def generate_count(self, count: int) -> WorkloadBatch:
+        """The next count reports of the trace on the street graph, continuing where the last round stopped."""
+        if self.sumo_id_to_edge is None:
+            raise ValueError("a replay needs the SUMO id map of the street graph to be a workload")
+        rows = np.arange(self.position, len(self.trace))
+        rows = rows[self.trace_edge_index[self.trace.edges[rows]] >= 0][:count]
+        self.position = int(rows[-1]) + 1 if len(rows) else len(self.trace)
+        return WorkloadBatch(self.graph_edges, self.trace_edge_index[self.trace.edges[rows]],
+                             (self.trace.speeds[rows] * KMH_PER_MS).astype(np.int64), self.trace.times[rows],
+                             self.trace.vehicles[rows])
+
+    def stream(self, simulation, batch: WorkloadBatch, tick: float = 0.05) -> int:
+        # paced on the simulation clock like a generated workload, all at once without a speedup
+        if self.speedup is None:
+            return Workload.stream(self, simulation, batch, rate=math.inf, tick=tick)
+        return Workload.stream(self, simulation, batch, speedup=self.speedup, tick=tick)
+
+
+def create_replay_simulation(scheme: str, gml_path: str, ids_path: str, quiet: bool = True, virtual_time: bool = True,
+                             interval: float = 10, key_size: int = DEFAULT_KEY_SIZE):
+    sumo_edge_ids = load_sumo_edge_ids(ids_path)
+    if scheme == "single":
+        import SingleBlockchainScheme
+        return SingleBlockchainScheme.Simulation("sumo", quiet=quiet, gml_file=gml_path, sumo_edge_ids=sumo_edge_ids,
+                                                 traffic_update_interval_in_seconds=interval,
+                                                 virtual_time=virtual_time)
+    if scheme == "two":
+        import TwoBlockchainsScheme
+        return TwoBlockchainsScheme.Simulation("sumo", quiet=quiet, gml_file=gml_path, sumo_edge_ids=sumo_edge_ids,
+                                               traffic_update_interval_in_seconds=interval,
+                                               virtual_time=virtual_time)
+    if scheme == "partial":
+        import PartialHomomorphyScheme
+        return PartialHomomorphyScheme.Simulation("sumo", gml_path, quiet=quiet, sumo_edge_ids=sumo_edge_ids,
+                                                  traffic_update_interval_in_seconds=interval, key_size=key_size,
+                                                  virtual_time=virtual_time)
+    raise ValueError(f"the {scheme} scheme has no SUMO edge ids")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Convert and replay recorded SUMO FCD traces.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="convert an FCD XML trace to the compact .npz form")
+    convert.add_argument("trace", help="sumo --fcd-output file, .xml or .xml.gz")
+    convert.add_argument("output", help=".npz file")
+    replay = subparsers.add_parser("replay", help="replay a trace as the logs of rounds of a scheme")
+    replay.add_argument("trace", help="FCD XML or .npz trace")
+    replay.add_argument("--scheme", default="single", choices=["single", "two", "partial"])
+    replay.add_argument("--gml", default="BerlinSumo/osm.net.directed.gml", help="street graph written by sumo.py")
+    replay.add_argument("--ids", default="BerlinSumo/osm.net.ids.json", help="SUMO id map written by sumo.py")
+    replay.add_argument("--log-count", type=int, default=1000, help="reports of the trace per round")
+    replay.add_argument("--rounds", type=int, default=1)
+    replay.add_argument("--speedup", type=float, default=None,
+                        help="replay at this multiple of the recorded time, as fast as possible by default")
+    replay.add_argument("--interval", type=float, default=10, help="traffic update interval in seconds")
+    replay.add_argument("--key-size", type=int, default=DEFAULT_KEY_SIZE)
+    replay.add_argument("--wall-clock", action="store_true", help="run on the wall clock instead of the virtual one")
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        trace = FcdTrace.from_xml(args.trace)
+        trace.save(args.output)
+        print(f"{trace} written to {args.output}")
+        return
+
+    workload = FcdReplay.from_files(args.trace, args.ids, args.speedup)
+    print(workload.trace)
+    simulation = create_replay_simulation(args.scheme, args.gml, args.ids, virtual_time=not args.wall_clock,
+                                          interval=args.interval, key_size=args.key_size)
+    simulation.random_speed_log_count = args.log_count
+    simulation.workload = workload
+    simulation.run()
+    print(f"round 1: {simulation.get_simulation_data()}")
+    for round_number in range(2, args.rounds + 1):
+        simulation.simulation()
+        print(f"round {round_number}: {simulation.get_simulation_data()}")
+    simulation.end_run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from benchmark import DEFAULT_KEY_SIZE, DEFAULT_POLY_MODULUS_DEGREE, SCHEMES, Cell, create_simulation, percentile
+from Blockchain.Block import Block
+from Blockchain.Clock import VirtualClock
+from utils import b64_dec, b64_enc
+from workload import Workload
+
+# the blocks that close the logs of a round on the local chain
+AGGREGATE_BLOCK_TYPES = {
+    "plain": ("average_traffic", "average_traffic_delta"),
+    "partial": ("f_ab_encrypted_average_traffic",),
+    "fully": ("f_a_encrypted",),
+}
+
+# the encryption key of a worker process, set by _init_encryption_worker
+_worker_scheme: Optional[str] = None
+_worker_key = None
+
+
+class FleetClockError(Exception):
+    def __init__(self):
+        self.message = "The fleet emulator measures real throughput and needs a simulation on the wall clock"
+        super().__init__(self.message)
+
+
+def _init_encryption_worker(scheme: str, key_material: str):
+    global _worker_scheme, _worker_key
+    _worker_scheme = scheme
+    if scheme == "partial":
+        from phe import paillier
+        _worker_key = paillier.PaillierPublicKey(int(key_material))
+    else:
+        import tenseal as ts
+        _worker_key = ts.context_from(b64_dec(key_material))
+
+
+def _encrypt(speed: int):
+    if _worker_scheme == "partial":
+        from PartialHomomorphyScheme.LocalBlockchainNode import encrypt_speed
+    else:
+        from FullyHomomorphyScheme.LocalBlockchainNode import encrypt_speed
+    return encrypt_speed(_worker_key, speed)
+
+
+class FleetEmulator:
+    """
+    Drives vehicle_count vehicles against the local chain of a simulation during one round.
+
+    Every vehicle reports every report_interval seconds from its own coroutine, the speeds are encrypted in a process
+    pool and the encrypted logs are appended by the event loop. The report covers the sustained logs per second and
+    the latency of every log from its submission until it is appended and until it is included in the aggregate of
+    the round.
+    """
+
+    def __init__(self, simulation, vehicle_count: int = 1000, report_interval: float = 1.0,
+                 processes: Optional[int] = None, workload: Optional[Workload] = None, seed: Optional[int] = None):
+        if isinstance(simulation.clock, VirtualClock):
+            raise FleetClockError()
+        self.simulation = simulation
+        self.vehicle_count = vehicle_count
+        self.report_interval = report_interval
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self.workload = workload if workload is not None else Workload(simulation.edges, seed=seed)
+        self.rng = random.Random(seed)
+        if hasattr(simulation, 'localBlockChainNode'):
+            self.node = simulation.localBlockChainNode
+            self.scheme = "partial" if hasattr(self.node, 'add_encrypted_traffic_log') else "fully"
+        else:
+            self.node = simulation.node
+            self.scheme = "plain"
+        self.chain = self.node.blockchain
+        self.scanned_block = self.chain.tail
+        self.aggregate: Optional[Block] = None
+        self.window_opened = False
+        self.window_closed = False
+        self.submitted = 0
+        self.rejected = 0
+        # (submission time, appended block, seconds of encryption)
+        self.logs: List[Tuple[datetime.datetime, Block, float]] = []
+        self.reports: List[Tuple] = []
+
+    def _next_report(self) -> Tuple:
+        if not self.reports:
+            batch = self.workload.generate_count(10000)
+            self.reports = list(zip(batch.edge_indices.tolist(), batch.speeds.tolist()))
+            self.reports.reverse()
+        edge_index, speed = self.reports.pop()
+        return self.workload.edges[edge_index], speed
+
+    def _ingestion_open(self) -> bool:
+        if self.scheme == "plain":
+            # the logs of the first round count from the street graph block on
+            street_graph = self.chain.head.next_block
+            return street_graph is not None and street_graph.data["type"] == "street_graph" and \
+                self._aggregate_block() is None
+        # each homomorphic scheme has its own NeighborHoodState enum
+        return self.node.get_node_state().name == "FACILITATOR_REQUEST_ANSWERED"
+
+    def _update_window(self) -> bool:
+        is_open = self._ingestion_open()
+        if is_open:
+            self.window_opened = True
+        elif self.window_opened:
+            self.window_closed = True
+        return is_open
+
+    def _aggregate_block(self) -> Optional[Block]:
+        # only the blocks added since the last call are scanned
+        while self.aggregate is None and self.scanned_block.next_block is not None:
+            self.scanned_block = self.scanned_block.next_block
+            if self.scanned_block.data["type"] in AGGREGATE_BLOCK_TYPES[self.scheme]:
+                self.aggregate = self.scanned_block
+        return self.aggregate
+
+    def _key_material(self) -> Optional[str]:
+        if self.scheme == "partial":
+            return str(self.node.facilitator_pubkey.n)
+        elif self.scheme == "fully":
+            return b64_enc(self.node.facilitator_ctx.serialize())
+        return None
+
+    def _append(self, edge, encrypted) -> Block:
+        if self.scheme == "partial":
+            self.node.add_encrypted_traffic_log(edge, encrypted)
+        elif self.scheme == "fully":
+            self.node.add_encrypted_log(edge, encrypted)
+        else:
+            self.node.send_traffic_log(edge, encrypted)
+        return self.chain.tail
+
+    async def _vehicle(self, executor: Optional[ProcessPoolExecutor]):
+        loop = asyncio.get_running_loop()
+        # vehicles do not report in lockstep
+        await asyncio.sleep(self.rng.random() * self.report_interval)
+        while self._update_window():
+            started = loop.time()
+            edge, speed = self._next_report()
+            submitted = datetime.datetime.now()
+            self.submitted += 1
+            encryption_seconds = 0.0
+            encrypted = speed
+            if executor is not None:
+                encrypted = await loop.run_in_executor(executor, _encrypt, speed)
+                encryption_seconds = (datetime.datetime.now() - submitted).total_seconds()
+            if not self._update_window():
+                # the round stopped taking logs while this one was encrypted
+                self.rejected += 1
+                return
+            block = self._append(edge, encrypted)
+            self.logs.append((submitted, block, encryption_seconds))
+            await asyncio.sleep(max(0.0, self.report_interval - (loop.time() - started)))
+
+    async def _drive(self):
+        while not self._update_window():
+            await asyncio.sleep(0.05)
+        executor = None
+        if self.scheme != "plain":
+            executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                           initializer=_init_encryption_worker,
+                                           initargs=(self.scheme, self._key_material()))
+            # starting the workers is not part of the ingestion
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(executor, _encrypt, 0) for _ in range(self.processes)))
+        try:
+            await asyncio.gather(*(self._vehicle(executor) for _ in range(self.vehicle_count)))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _round_start(self) -> datetime.datetime:
+        if self.scheme == "plain":
+            return self.chain.head.next_block.timestamp
+        return self.node.facilitator_response_time
+
+    def _interval(self) -> float:
+        if self.scheme == "fully":
+            return self.node.update_interval
+        return self.node.traffic_update_interval_in_seconds
+
+    def run(self) -> Dict:
+        self.simulation.random_speed_log_count = 0
+        self.simulation.workload = None
+        simulation_thread = threading.Thread(target=self.simulation.run)
+        simulation_thread.start()
+        asyncio.run(self._drive())
+        simulation_thread.join()
+        report = self.get_report()
+        self.simulation.end_run()
+        return report
+
+    def get_report(self) -> Dict:
+        aggregate = self._aggregate_block()
+        append_latencies = [(block.timestamp - submitted).total_seconds() for submitted, block, _ in self.logs]
+        encryption_latencies = [seconds for _, _, seconds in self.logs]
+        included = [(aggregate.timestamp - submitted).total_seconds() for submitted, block, _ in self.logs
+                    if aggregate is not None and block.timestamp <= aggregate.timestamp]
+        report = {
+            "scheme": self.scheme,
+            "vehicle_count": self.vehicle_count,
+            "submitted": self.submitted,
+            "appended": len(self.logs),
+            "rejected": self.rejected,
+            "included": len(included),
+            "missed": len(self.logs) - len(included),
+            "logs_per_second": 0.0,
+            "round_delay": None,
+        }
+        if self.logs:
+            first = min(submitted for submitted, _, _ in self.logs)
+            last = max(block.timestamp for _, block, _ in self.logs)
+            seconds = (last - first).total_seconds()
+            report["logs_per_second"] = len(self.logs) / seconds if seconds > 0 else 0.0
+        if aggregate is not None:
+            due = self._round_start() + datetime.timedelta(seconds=self._interval())
+            # how late the aggregate came after the end of the interval, the state threads poll every sleep_time
+            report["round_delay"] = (aggregate.timestamp - due).total_seconds()
+        for name, values in (("encryption_latency", encryption_latencies), ("append_latency", append_latencies),
+                             ("end_to_end_latency", included)):
+            if values:
+                report[name] = {f"p{int(fraction * 100)}": percentile(values, fraction)
+                                for fraction in (0.5, 0.95, 0.99)}
+        return report
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Find how many vehicles the local chain of a neighborhood absorbs.")
+    parser.add_argument("--scheme", default="partial", choices=SCHEMES)
+    parser.add_argument("--neighborhood", default="nh7")
+    parser.add_argument("--vehicle-counts", nargs="+", type=int, default=[100, 1000, 5000])
+    parser.add_argument("--report-interval", type=float, default=1.0, help="seconds between the reports of a vehicle")
+    parser.add_argument("--interval", type=float, default=10, help="traffic update interval in seconds")
+    parser.add_argument("--parameter", type=int, default=None,
+                        help="key size or poly modulus degree, defaults to the benchmark defaults")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--max-round-delay", type=float, default=1.0,
+                        help="seconds a round may finish late before the fleet counts as too large")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    parameter = args.parameter
+    if parameter is None and args.scheme == "partial":
+        parameter = DEFAULT_KEY_SIZE
+    elif parameter is None and args.scheme == "fully":
+        parameter = DEFAULT_POLY_MODULUS_DEGREE
+
+    capacity = None
+    for vehicle_count in sorted(args.vehicle_counts):
+        simulation = create_simulation(Cell(args.scheme, args.neighborhood, 0, parameter, 0), 0.2, args.interval)
+        emulator = FleetEmulator(simulation, vehicle_count, args.report_interval, args.processes, seed=args.seed)
+        report = emulator.run()
+        print(json.dumps(report), flush=True)
+        if report["round_delay"] is None or report["round_delay"] > args.max_round_delay or report["missed"]:
+            break
+        capacity = vehicle_count
+    print(f"largest fleet absorbed within the interval: {capacity}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+from collections import deque
+from typing import Dict, List, Optional
+
+import networkx as nx
+
+REPOSITORY_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+GENERATORS = ["grid", "planar", "barabasi", "osm"]
+
+
+class MissingOsmGraphError(Exception):
+    def __init__(self):
+        self.message = "The osm generator needs a street graph, pass one with --osm-graph"
+        super().__init__(self.message)
+
+
+def trim_edges(graph: nx.Graph, edge_count: int, rng: random.Random) -> nx.Graph:
+    # drops random edges until the graph has edge_count edges
+    excess = graph.number_of_edges() - edge_count
+    if excess > 0:
+        graph.remove_edges_from(rng.sample(list(graph.edges), excess))
+    return graph
+
+
+def grid_dimensions(edge_count: int):
+    # a rows x columns grid has rows * (columns - 1) + columns * (rows - 1) edges
+    rows = max(2, int(math.sqrt(edge_count / 2)))
+    columns = max(2, math.ceil((edge_count + rows) / (2 * rows - 1)))
+    return rows, columns
+
+
+def grid_graph(edge_count: int, rng: random.Random) -> nx.Graph:
+    rows, columns = grid_dimensions(edge_count)
+    graph = nx.convert_node_labels_to_integers(nx.grid_2d_graph(rows, columns))
+    return trim_edges(graph, edge_count, rng)
+
+
+def planar_graph(edge_count: int, rng: random.Random) -> nx.Graph:
+    # a grid where some blocks are crossed by one diagonal street, which keeps the graph planar
+    rows, columns = grid_dimensions(math.ceil(edge_count / 1.25))
+    graph = nx.grid_2d_graph(rows, columns)
+    blocks = [(row, column) for row in range(rows - 1) for column in range(columns - 1)]
+    rng.shuffle(blocks)
+    for row, column in blocks[:max(0, edge_count - graph.number_of_edges())]:
+        if rng.random() < 0.5:
+            graph.add_edge((row, column), (row + 1, column + 1))
+        else:
+            graph.add_edge((row + 1, column), (row, column + 1))
+    return trim_edges(nx.convert_node_labels_to_integers(graph), edge_count, rng)
+
+
+def barabasi_graph(edge_count: int, rng: random.Random, attachments: int = 2) -> nx.Graph:
+    # every new vertex brings attachments edges
+    vertex_count = math.ceil(edge_count / attachments) + attachments
+    graph = nx.barabasi_albert_graph(vertex_count, attachments, seed=rng.randrange(2 ** 32))
+    return trim_edges(graph, edge_count, rng)
+
+
+def osm_subgraph(street_graph: nx.Graph, edge_count: int, rng: random.Random) -> nx.Graph:
+    # grows a connected neighborhood breadth first from a random intersection
+    start = rng.choice(list(street_graph.nodes))
+    visited = {start}
+    queue = deque([start])
+    induced_edges = 0
+    while queue and induced_edges < edge_count:
+        vertex = queue.popleft()
+        for neighbor in street_graph.neighbors(vertex):
+            if neighbor in visited:
+                continue
+            visited.add(neighbor)
+            induced_edges += sum(1 for other in street_graph.neighbors(neighbor) if other in visited and
+                                 other != neighbor)
+            queue.append(neighbor)
+            if induced_edges >= edge_count:
+                break
+    graph = nx.Graph(street_graph.subgraph(visited))
+    return trim_edges(nx.convert_node_labels_to_integers(graph, label_attribute="osm_id"), edge_count, rng)
+
+
+def generate_graph(generator: str, edge_count: int, rng: random.Random,
+                   street_graph: Optional[nx.Graph] = None) -> nx.Graph:
+    if generator == "grid":
+        return grid_graph(edge_count, rng)
+    elif generator == "planar":
+        return planar_graph(edge_count, rng)
+    elif generator == "barabasi":
+        return barabasi_graph(edge_count, rng)
+    elif generator == "osm":
+        if street_graph is None:
+            raise MissingOsmGraphError()
+        return osm_subgraph(street_graph, edge_count, rng)
+    raise ValueError(f"unknown generator {generator}")
+
+
+def load_neighborhoods_data(graphs_folder: str) -> Dict:
+    path = os.path.join(graphs_folder, 'neighborhoods_data.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_neighborhoods_data(graphs_folder: str, neighborhoods_data: Dict):
+    with open(os.path.join(graphs_folder, 'neighborhoods_data.json'), 'w') as f:
+        json.dump(neighborhoods_data, f, indent=2)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Generate synthetic road-like neighborhoods of a given size.")
+    parser.add_argument("--generators", nargs="+", default=["grid", "planar", "barabasi"], choices=GENERATORS)
+    parser.add_argument("--edge-counts", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--osm-graph", default=None,
+                        help="street graph to cut the osm neighborhoods from, e.g. BerlinSumo/osm.net.gml")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--graphs-folder", default=os.path.join(REPOSITORY_ROOT, 'graphs'))
+    args = parser.parse_args(argv)
+
+    street_graph = None
+    if "osm" in args.generators:
+        if args.osm_graph is None:
+            raise MissingOsmGraphError()
+        street_graph = nx.Graph(nx.read_gml(args.osm_graph))
+
+    neighborhoods_data = load_neighborhoods_data(args.graphs_folder)
+    for generator in args.generators:
+        for edge_count in args.edge_counts:
+            # every graph gets its own stream, so adding a size does not change the other graphs
+            rng = random.Random(f"{args.seed}:{generator}:{edge_count}")
+            graph = generate_graph(generator, edge_count, rng, street_graph)
+            # a street graph smaller than the requested size gives a smaller neighborhood, named by what it holds
+            name = f"{generator}{graph.number_of_edges()}"
+            if graph.number_of_edges() < edge_count:
+                print(f"warning: {generator} has only {graph.number_of_edges()} of the {edge_count} edges asked for, "
+                      f"written as {name}", file=sys.stderr)
+            nx.write_gml(graph, os.path.join(args.graphs_folder, name + '.gml'))
+            neighborhoods_data[name] = {
+                'vertex_count': graph.number_of_nodes(),
+                'edge_count': graph.number_of_edges(),
+                'generator': generator,
+                'seed': args.seed
+            }
+            print(f"{name}: {graph.number_of_nodes()} vertices, {graph.number_of_edges()} edges", flush=True)
+    save_neighborhoods_data(args.graphs_folder, neighborhoods_data)
+
+
+if __name__ == '__main__':
+    main()
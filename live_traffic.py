@@ -0,0 +1,324 @@
+import argparse
+import random
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from benchmark import DEFAULT_KEY_SIZE
+from Blockchain import Blockchain
+from Blockchain.Block import Block
+from Blockchain.Metrics import MetricsRegistry, default_registry
+from routing import TRAFFIC_BLOCK_TYPES, traffic_chain
+from utils import calc_edge_hash, unpack_edge_ordinals
+
+# slots the table starts with, it doubles whenever it is full
+INITIAL_CAPACITY = 1024
+
+
+class UnknownStreetGraphError(Exception):
+    def __init__(self, neighborhood: str):
+        self.message = f"Neighborhood {neighborhood} posts ordinal encoded traffic but its street graph is unknown, " \
+                       f"its street_graph block is not on the chain and its edges were not passed with add_street_graph"
+        super().__init__(self.message)
+
+
+def scan_latest(blockchain: Blockchain, edge: Hashable) -> Optional[float]:
+    """The latest speed of edge found walking backwards from the tail, what every reader did before the view."""
+    keys = (edge, calc_edge_hash(edge)) if isinstance(edge, tuple) else (edge,)
+    block = blockchain.tail
+    while block is not None:
+        if block.data.get("type") in TRAFFIC_BLOCK_TYPES and "edges" not in block.data:
+            traffic = block.data["traffic" if block.data["type"] == "approved" else "average_traffic"]
+            for key in keys:
+                if key in traffic:
+                    value = traffic[key]
+                    return float(value[0]) if isinstance(value, (tuple, list)) else float(value)
+        block = block.previous_block
+    return None
+
+
+class LiveTrafficView:
+    """
+    The current traffic of every edge of a city, materialized from the blocks of its global chain.
+
+    Every edge gets a slot in flat arrays of speed, variance, round and timestamp, so a lookup is one dict access
+    and one array read, and a snapshot is a copy of the arrays. refresh applies the traffic blocks appended since
+    the last call: the average_traffic and average_traffic_delta blocks of the single and the two scheme and the
+    approved blocks the homomorphic schemes forward, edge keyed, hash keyed or ordinal encoded. Ordinals refer to the
+    street_graph block every neighborhood that encodes them puts on the chain. The round of an edge counts the
+    traffic blocks of its neighborhood, the variance is nan unless the scheme publishes one. Subscribers are called
+    with the slots every block changed, and changed_since gives pollers the slots changed after a version. Readers
+    like the routing engine and dashboards go through the view and never walk the chain themselves.
+    """
+
+    def __init__(self, blockchain: Blockchain, street_graphs: Optional[Dict[str, List]] = None,
+                 metrics: Optional[MetricsRegistry] = None):
+        self.blockchain = blockchain
+        self.metrics = metrics if metrics is not None else default_registry
+        # the edges of every neighborhood in street graph order, what ordinal encoded blocks refer to
+        self.street_graphs: Dict[str, List] = {}
+        self.edge_hashes: Dict[str, tuple] = {}
+        self.keys: List[Hashable] = []
+        # edge tuples are found by their hash as well, hash keyed traffic by the edge once its graph is known
+        self.slots: Dict[Hashable, int] = {}
+        self.neighborhoods: List[str] = []
+        self.neighborhood_codes: Dict[str, int] = {}
+        self.neighborhood_rounds: Dict[str, int] = {}
+        self.speeds = np.full(INITIAL_CAPACITY, np.nan)
+        self.variances = np.full(INITIAL_CAPACITY, np.nan)
+        self.rounds = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.timestamps = np.full(INITIAL_CAPACITY, np.nan)
+        self.versions = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.owners = np.full(INITIAL_CAPACITY, -1, dtype=np.int32)
+        self.version = 0
+        self.last_block: Optional[Block] = None
+        self.subscribers: List[Callable] = []
+        self.lock = threading.Lock()
+        self.stop_event: Optional[threading.Event] = None
+        self.thread: Optional[threading.Thread] = None
+        for neighborhood, edges in (street_graphs or {}).items():
+            self.add_street_graph(neighborhood, edges)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_street_graph(self, neighborhood: str, edges: List):
+        """The edges of a neighborhood in the order of its street graph, the graph edges or its street_graph block."""
+        self.street_graphs[neighborhood] = list(edges)
+        with self.lock:
+            for edge in edges:
+                if isinstance(edge, tuple):
+                    self.edge_hashes[calc_edge_hash(edge)] = edge
+                    # hash keyed slots seen before the graph was known are found by the edge from now on
+                    slot = self.slots.get(calc_edge_hash(edge))
+                    if slot is not None:
+                        self.slots.setdefault(edge, slot)
+
+    def subscribe(self, callback: Callable[['LiveTrafficView', np.ndarray, str, int], None]):
+        """callback(view, slots, neighborhood, round) runs after every traffic block, in the refreshing thread."""
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable):
+        self.subscribers.remove(callback)
+
+    def slot(self, edge: Hashable) -> Optional[int]:
+        slot = self.slots.get(edge)
+        if slot is None and isinstance(edge, tuple):
+            slot = self.slots.get(calc_edge_hash(edge))
+        return slot
+
+    def lookup(self, edge: Hashable) -> Optional[Tuple[float, float, int, float]]:
+        """The speed in km/h, variance, round and timestamp in seconds of edge, None for an edge without traffic."""
+        slot = self.slot(edge)
+        if slot is None:
+            return None
+        return float(self.speeds[slot]), float(self.variances[slot]), int(self.rounds[slot]), \
+            float(self.timestamps[slot])
+
+    def speed(self, edge: Hashable, default: Optional[float] = None) -> Optional[float]:
+        slot = self.slot(edge)
+        return float(self.speeds[slot]) if slot is not None else default
+
+    def neighborhood(self, edge: Hashable) -> Optional[str]:
+        slot = self.slot(edge)
+        return self.neighborhoods[self.owners[slot]] if slot is not None else None
+
+    def changed_since(self, version: int) -> np.ndarray:
+        """The slots a block after version changed, for readers that poll instead of subscribing."""
+        return np.flatnonzero(self.versions[:len(self.keys)] > version)
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """A consistent copy of the whole table, one entry per edge."""
+        with self.lock:
+            count = len(self.keys)
+            return {
+                "edges": np.array([str(key) for key in self.keys], dtype=str),
+                "neighborhoods": np.array([self.neighborhoods[owner] for owner in self.owners[:count]], dtype=str),
+                "speeds": self.speeds[:count].copy(),
+                "variances": self.variances[:count].copy(),
+                "rounds": self.rounds[:count].copy(),
+                "timestamps": self.timestamps[:count].copy(),
+                "version": np.array(self.version),
+            }
+
+    def write(self, path: str):
+        np.savez_compressed(path, **self.snapshot())
+
+    def grow(self):
+        capacity = 2 * len(self.speeds)
+        for name, fill in (("speeds", np.nan), ("variances", np.nan), ("rounds", 0), ("timestamps", np.nan),
+                           ("versions", 0), ("owners", -1)):
+            array = getattr(self, name)
+            grown = np.full(capacity, fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def add_slot(self, key: Hashable) -> int:
+        if len(self.keys) == len(self.speeds):
+            self.grow()
+        slot = len(self.keys)
+        self.keys.append(key)
+        self.slots[key] = slot
+        if isinstance(key, tuple):
+            self.slots.setdefault(calc_edge_hash(key), slot)
+        return slot
+
+    def decode(self, data: Dict, neighborhood: str) -> Dict:
+        traffic = data["traffic" if data["type"] == "approved" else "average_traffic"]
+        if "edges" not in data:
+            return traffic
+        edges = self.street_graphs.get(neighborhood)
+        if edges is None:
+            raise UnknownStreetGraphError(neighborhood)
+        # approved blocks count the hashes of the graph edges, the averages the edges themselves
+        return {edges[ordinal]: value for ordinal, value in zip(unpack_edge_ordinals(data["edges"]), traffic)}
+
+    def apply_block(self, block: Block) -> np.ndarray:
+        data = block.data
+        if data.get("type") == "street_graph" and data.get("edges"):
+            # the edge hashes the ordinals of the neighborhood refer to, found by the edge once its graph is known
+            self.street_graphs[data.get("neighborhood", "")] = list(data["edges"])
+            return np.empty(0, dtype=np.int64)
+        if data.get("type") not in TRAFFIC_BLOCK_TYPES:
+            return np.empty(0, dtype=np.int64)
+        neighborhood = data.get("neighborhood", "")
+        traffic = self.decode(data, neighborhood)
+        if neighborhood not in self.neighborhood_codes:
+            self.neighborhood_codes[neighborhood] = len(self.neighborhoods)
+            self.neighborhoods.append(neighborhood)
+        round_number = self.neighborhood_rounds.get(neighborhood, 0) + 1
+        self.neighborhood_rounds[neighborhood] = round_number
+        self.version += 1
+        slots = np.empty(len(traffic), dtype=np.int64)
+        speeds = np.empty(len(traffic))
+        variances = np.full(len(traffic), np.nan)
+        for position, (key, value) in enumerate(traffic.items()):
+            key = self.edge_hashes.get(key, key) if isinstance(key, str) else key
+            slot = self.slot(key)
+            slots[position] = slot if slot is not None else self.add_slot(key)
+            if isinstance(value, (tuple, list)):
+                speeds[position], variances[position] = value
+            else:
+                speeds[position] = value
+        self.speeds[slots] = speeds
+        self.variances[slots] = variances
+        self.rounds[slots] = round_number
+        self.timestamps[slots] = block.timestamp.timestamp()
+        self.versions[slots] = self.version
+        self.owners[slots] = self.neighborhood_codes[neighborhood]
+        return slots
+
+    def refresh(self) -> int:
+        """Applies the blocks appended since the last refresh and returns how many edges they updated."""
+        updated = 0
+        notifications = []
+        with self.metrics.timer("live_traffic_refresh"), self.lock:
+            block = self.blockchain.head if self.last_block is None else self.last_block.next_block
+            while block is not None:
+                slots = self.apply_block(block)
+                if len(slots):
+                    updated += len(slots)
+                    neighborhood = block.data.get("neighborhood", "")
+                    notifications.append((slots, neighborhood, self.neighborhood_rounds[neighborhood]))
+                self.last_block = block
+                block = block.next_block
+        self.metrics.counter("live_traffic_updates").inc(updated)
+        # outside the lock, so a subscriber can read the view
+        for slots, neighborhood, round_number in notifications:
+            for callback in list(self.subscribers):
+                callback(self, slots, neighborhood, round_number)
+        return updated
+
+    def start(self, interval: float = 0.5):
+        """Follows the chain from a background thread that refreshes every interval seconds."""
+        if self.thread is not None:
+            return
+        self.stop_event = threading.Event()
+
+        def follow():
+            while not self.stop_event.wait(interval):
+                self.refresh()
+
+        self.thread = threading.Thread(target=follow, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.refresh()
+
+    def __str__(self):
+        return f"Live traffic of {len(self.keys)} edges in {len(self.neighborhoods)} neighborhoods at version " \
+               f"{self.version}"
+
+
+def benchmark_lookups(view: LiveTrafficView, edges: List, lookups: int, rng: random.Random) -> Dict:
+    queries = [rng.choice(edges) for _ in range(lookups)]
+    start = time.perf_counter()
+    for edge in queries:
+        view.speed(edge)
+    view_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    scanned = [scan_latest(view.blockchain, edge) for edge in queries]
+    scan_seconds = time.perf_counter() - start
+    mismatches = sum(1 for edge, speed in zip(queries, scanned) if speed != view.speed(edge))
+    start = time.perf_counter()
+    view.snapshot()
+    snapshot_seconds = time.perf_counter() - start
+    return {
+        "lookups": lookups,
+        "view_microseconds": view_seconds / lookups * 1e6,
+        "scan_microseconds": scan_seconds / lookups * 1e6,
+        "mismatches": mismatches,
+        "snapshot_milliseconds": snapshot_seconds * 1e3,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Follow the global chain of a scheme with a live traffic view and "
+                                                 "compare its lookups with scanning the chain backwards.")
+    parser.add_argument("--graph", default="graphs/nh7.gml")
+    parser.add_argument("--scheme", default="two", choices=["single", "two", "partial"])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--log-count", type=int, default=1000)
+    parser.add_argument("--key-size", type=int, default=DEFAULT_KEY_SIZE)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--output", default=None, help="write the final snapshot to this .npz file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    import networkx as nx
+    from city import create_partition_simulation
+
+    edges = list(nx.read_gml(args.graph).edges)
+    simulation = create_partition_simulation(args.scheme, "live", args.graph, interval=10, sleep_time=0.2,
+                                             virtual_time=True, key_size=args.key_size)
+    simulation.random_speed_log_count = args.log_count
+    view = LiveTrafficView(traffic_chain(simulation), {"live": edges})
+    rounds = []
+    view.subscribe(lambda _, slots, neighborhood, round_number: rounds.append((neighborhood, round_number, len(slots))))
+    for round_number in range(args.rounds):
+        if round_number == 0:
+            simulation.run()
+        else:
+            simulation.simulation()
+        view.refresh()
+    simulation.end_run()
+    for neighborhood, round_number, count in rounds:
+        print(f"{neighborhood} round {round_number}: {count} edges updated")
+    print(view)
+    result = benchmark_lookups(view, edges, args.lookups, random.Random(args.seed))
+    print(f"lookup {result['view_microseconds']:.2f}us from the view against {result['scan_microseconds']:.1f}us "
+          f"scanning {view.blockchain.length} blocks, {result['mismatches']} mismatches, snapshot in "
+          f"{result['snapshot_milliseconds']:.2f}ms")
+    if args.output is not None:
+        view.write(args.output)
+
+
+if __name__ == '__main__':
+    main()
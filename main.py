@@ -1,6 +1,7 @@
 import SingleBlockchainScheme
 import PartialHomomorphyScheme
 import TwoBlockchainsScheme
+import FullyHomomorphyScheme
 
 
 def main():
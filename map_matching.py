@@ -0,0 +1,250 @@
+import argparse
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from fcd import KMH_PER_MS, lane_edge
+from sumo import densify, iter_net_edges, net_file, read_lane_shapes
+
+# positions per batch of candidate pairs, bounds the memory of a match over millions of positions
+CHUNK_SIZE = 1 << 16
+
+
+def sumo_angles(directions: np.ndarray) -> np.ndarray:
+    # the heading SUMO reports, degrees clockwise from north
+    return np.degrees(np.arctan2(directions[:, 0], directions[:, 1])) % 360
+
+
+def angle_differences(angles1: np.ndarray, angles2: np.ndarray) -> np.ndarray:
+    return np.abs((angles1 - angles2 + 180) % 360 - 180)
+
+
+class MapMatcher:
+    """
+    Matches vehicle positions to the nearest lane segment of a SUMO net, many positions at once.
+
+    The lane segments are put into a uniform grid of cell_size meters, every segment into all cells its bounding box
+    grown by max_distance touches, so a position only looks at the segments of its own cell. match projects every
+    position onto all candidates of its cell with numpy and keeps the nearest one within max_distance. With headings
+    (degrees clockwise from north like SUMO's angle) segments pointing more than max_heading_difference away are left
+    out, which tells the two directions of a street and close parallel roads apart. With the edge a vehicle was on
+    before, its edge and the edges leaving the junction it drives to count continuity_bonus meters closer.
+    """
+
+    def __init__(self, lane_ids: List[str], points: np.ndarray, offsets: np.ndarray,
+                 edge_junctions: Optional[Dict[str, Tuple[str, str]]] = None, cell_size: float = 50.0,
+                 max_distance: float = 30.0, max_heading_difference: float = 60.0, continuity_bonus: float = 5.0):
+        self.cell_size = cell_size
+        self.max_distance = max_distance
+        self.max_heading_difference = max_heading_difference
+        self.continuity_bonus = continuity_bonus
+        points = np.asarray(points, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+
+        # the lanes of an edge match as the edge
+        self.edge_ids = list(dict.fromkeys(lane_edge(lane_id) for lane_id in lane_ids))
+        self.edge_index = {edge_id: index for index, edge_id in enumerate(self.edge_ids)}
+        lane_edges = np.array([self.edge_index[lane_edge(lane_id)] for lane_id in lane_ids], dtype=np.int64)
+        point_lanes = np.repeat(np.arange(len(lane_ids)), np.diff(offsets))
+        # a segment from every point to the next one of the same lane
+        first = np.flatnonzero(point_lanes[:-1] == point_lanes[1:])
+        self.starts = points[first]
+        self.ends = points[first + 1]
+        self.segment_edges = lane_edges[point_lanes[first]]
+        self.directions = self.ends - self.starts
+        self.squared_lengths = np.einsum("ij,ij->i", self.directions, self.directions)
+        self.headings = sumo_angles(self.directions)
+
+        # junction ids as numbers, -1 where the net gave none
+        self.edge_from = np.full(len(self.edge_ids), -1, dtype=np.int64)
+        self.edge_to = np.full(len(self.edge_ids), -1, dtype=np.int64)
+        if edge_junctions is not None:
+            junctions: Dict[str, int] = {}
+            for edge_id, (start, end) in edge_junctions.items():
+                index = self.edge_index.get(edge_id)
+                if index is not None:
+                    self.edge_from[index] = junctions.setdefault(start, len(junctions))
+                    self.edge_to[index] = junctions.setdefault(end, len(junctions))
+        self._build_grid()
+
+    def _build_grid(self):
+        low = np.minimum(self.starts, self.ends) - self.max_distance
+        high = np.maximum(self.starts, self.ends) + self.max_distance
+        self.origin = low.min(axis=0) if len(low) else np.zeros(2)
+        first_cells = np.floor((low - self.origin) / self.cell_size).astype(np.int64)
+        last_cells = np.floor((high - self.origin) / self.cell_size).astype(np.int64)
+        self.grid_shape = last_cells.max(axis=0) + 1 if len(last_cells) else np.ones(2, dtype=np.int64)
+        widths = last_cells[:, 0] - first_cells[:, 0] + 1
+        counts = widths * (last_cells[:, 1] - first_cells[:, 1] + 1)
+        # every cell of the box of every segment, row by row
+        segments = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        columns = first_cells[segments, 0] + local % widths[segments]
+        rows = first_cells[segments, 1] + local // widths[segments]
+        cells = rows * self.grid_shape[0] + columns
+        order = np.argsort(cells, kind="stable")
+        self.cell_segments = segments[order]
+        cell_counts = np.bincount(cells, minlength=int(np.prod(self.grid_shape)))
+        self.cell_offsets = np.concatenate(([0], np.cumsum(cell_counts)))
+
+    @staticmethod
+    def from_net_file(input_path: str, max_segment_length: Optional[float] = None, **kwargs) -> 'MapMatcher':
+        """The matcher of the lanes of a SUMO net, long lane segments split to max_segment_length for a tighter grid."""
+        lane_ids, points, offsets = read_lane_shapes(input_path)
+        if max_segment_length is not None:
+            points, offsets = densify(points, offsets, max_segment_length)
+        edge_junctions = {edge["id"]: (edge["from"], edge["to"]) for edge in iter_net_edges(input_path, False)}
+        return MapMatcher(lane_ids, points, offsets, edge_junctions, **kwargs)
+
+    def cells(self, positions: np.ndarray) -> np.ndarray:
+        # the grid cell of every position, -1 outside the grid
+        cells = np.floor((positions - self.origin) / self.cell_size).astype(np.int64)
+        inside = np.all((cells >= 0) & (cells < self.grid_shape), axis=1)
+        return np.where(inside, cells[:, 1] * self.grid_shape[0] + cells[:, 0], -1)
+
+    def match(self, positions: np.ndarray, headings: Optional[np.ndarray] = None,
+              previous: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The edge of every (x, y) position as an index into edge_ids and its distance to the edge in meters, -1 and
+        nan where no segment is within max_distance. headings and the previous edge indices are optional, nan and -1
+        for the positions that have none.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        edges = np.full(len(positions), -1, dtype=np.int64)
+        distances = np.full(len(positions), np.nan)
+        for start in range(0, len(positions), CHUNK_SIZE):
+            chunk = slice(start, start + CHUNK_SIZE)
+            edges[chunk], distances[chunk] = self._match_chunk(
+                positions[chunk], None if headings is None else np.asarray(headings, dtype=np.float64)[chunk],
+                None if previous is None else np.asarray(previous, dtype=np.int64)[chunk])
+        return edges, distances
+
+    def _match_chunk(self, positions: np.ndarray, headings: Optional[np.ndarray],
+                     previous: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        edges = np.full(len(positions), -1, dtype=np.int64)
+        distances = np.full(len(positions), np.nan)
+        cells = self.cells(positions)
+        firsts = np.where(cells >= 0, self.cell_offsets[np.maximum(cells, 0)], 0)
+        counts = np.where(cells >= 0, self.cell_offsets[np.maximum(cells, 0) + 1] - firsts, 0)
+        # one pair per position and candidate segment of its cell
+        pair_positions = np.repeat(np.arange(len(positions)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_segments = self.cell_segments[np.repeat(firsts, counts) + local]
+
+        relative = positions[pair_positions] - self.starts[pair_segments]
+        directions = self.directions[pair_segments]
+        squared_lengths = self.squared_lengths[pair_segments]
+        along = np.einsum("ij,ij->i", relative, directions) / np.where(squared_lengths > 0, squared_lengths, 1)
+        offsets = relative - directions * np.clip(along, 0, 1)[:, None]
+        pair_distances = np.hypot(offsets[:, 0], offsets[:, 1])
+
+        keep = pair_distances <= self.max_distance
+        if headings is not None:
+            pair_headings = headings[pair_positions]
+            keep &= np.isnan(pair_headings) | (angle_differences(pair_headings, self.headings[pair_segments])
+                                               <= self.max_heading_difference)
+        costs = pair_distances.copy()
+        if previous is not None:
+            pair_edges = self.segment_edges[pair_segments]
+            pair_previous = previous[pair_positions]
+            known = pair_previous >= 0
+            previous_to = np.where(known, self.edge_to[np.maximum(pair_previous, 0)], -1)
+            continues = known & ((pair_edges == pair_previous) |
+                                 ((previous_to >= 0) & (self.edge_from[pair_edges] == previous_to)))
+            costs -= np.where(continues, self.continuity_bonus, 0.0)
+
+        pair_positions, pair_segments = pair_positions[keep], pair_segments[keep]
+        costs, pair_distances = costs[keep], pair_distances[keep]
+        # the cheapest candidate of every position comes first in its group
+        order = np.lexsort((costs, pair_positions))
+        sorted_positions = pair_positions[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_positions[1:] != sorted_positions[:-1]
+        best = order[first]
+        matched = sorted_positions[first]
+        edges[matched] = self.segment_edges[pair_segments[best]]
+        distances[matched] = pair_distances[best]
+        return edges, distances
+
+    def sumo_ids(self, edges: np.ndarray) -> List[Optional[str]]:
+        return [self.edge_ids[edge] if edge >= 0 else None for edge in np.asarray(edges).tolist()]
+
+    def send(self, simulation, positions: np.ndarray, speeds: np.ndarray, headings: Optional[np.ndarray] = None,
+             previous: Optional[np.ndarray] = None) -> int:
+        """
+        Matches positional reports, speeds in m/s, and sends the matched ones through simulation.send_sumo_traffic
+        like an FCD replay. Returns how many were sent.
+        """
+        edges, _ = self.match(positions, headings, previous)
+        known = simulation.sumo_id_to_edge
+        sent = 0
+        for sumo_id, speed in zip(self.sumo_ids(edges), np.asarray(speeds).tolist()):
+            # positions off the streets and edges outside the street graph of the simulation
+            if sumo_id is None or sumo_id not in known:
+                continue
+            simulation.send_sumo_traffic(sumo_id, int(speed * KMH_PER_MS))
+            sent += 1
+        return sent
+
+    def sample(self, count: int, noise: float = 5.0, heading_noise: float = 10.0,
+               seed: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Noisy positions and headings of vehicles on random segments, with the edges they were drawn on."""
+        rng = np.random.default_rng(seed)
+        lengths = np.sqrt(self.squared_lengths)
+        segments = rng.choice(len(lengths), size=count, p=lengths / lengths.sum())
+        positions = self.starts[segments] + self.directions[segments] * rng.random(count)[:, None]
+        positions += rng.normal(0, noise, size=(count, 2))
+        headings = (self.headings[segments] + rng.normal(0, heading_noise, size=count)) % 360
+        return positions, headings, self.segment_edges[segments]
+
+    def __str__(self):
+        return f"Map matcher of {len(self.edge_ids)} edges with {len(self.starts)} segments in a " \
+               f"{self.grid_shape[0]}x{self.grid_shape[1]} grid of {self.cell_size} m"
+
+
+def match_accuracy(matcher: MapMatcher, positions: np.ndarray, truth: np.ndarray,
+                   headings: Optional[np.ndarray] = None, previous: Optional[np.ndarray] = None) -> Dict:
+    start = time.perf_counter()
+    edges, distances = matcher.match(positions, headings, previous)
+    seconds = time.perf_counter() - start
+    matched = edges >= 0
+    return {
+        "positions": len(positions),
+        "matched": int(matched.sum()),
+        "correct": int((edges == truth).sum()),
+        "accuracy": float((edges == truth).mean()) if len(positions) else None,
+        "mean_distance": float(distances[matched].mean()) if matched.any() else None,
+        "seconds": seconds,
+        "positions_per_second": len(positions) / seconds if seconds else None,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Match noisy vehicle positions to the edges of a SUMO net and "
+                                                 "report the accuracy and throughput of the matcher.")
+    parser.add_argument("--net", default=net_file, help="osm.net.xml or osm.net.xml.gz")
+    parser.add_argument("--positions", type=int, default=100000)
+    parser.add_argument("--noise", type=float, default=5.0, help="standard deviation of the positions in meters")
+    parser.add_argument("--heading-noise", type=float, default=10.0, help="standard deviation of the headings")
+    parser.add_argument("--cell-size", type=float, default=50.0)
+    parser.add_argument("--max-distance", type=float, default=30.0)
+    parser.add_argument("--max-segment-length", type=float, default=25.0,
+                        help="split longer lane segments before indexing them")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    matcher = MapMatcher.from_net_file(args.net, args.max_segment_length, cell_size=args.cell_size,
+                                       max_distance=args.max_distance)
+    print(f"{matcher} built in {time.perf_counter() - start:.3f}s")
+    positions, headings, truth = matcher.sample(args.positions, args.noise, args.heading_noise, args.seed)
+    for label, result in [("nearest", match_accuracy(matcher, positions, truth)),
+                          ("heading", match_accuracy(matcher, positions, truth, headings)),
+                          ("previous", match_accuracy(matcher, positions, truth, headings, truth))]:
+        print(f"{label:<10} {result['matched']}/{result['positions']} matched, accuracy {result['accuracy']:.3f}, "
+              f"{result['positions_per_second']:.0f} positions per second")
+
+
+if __name__ == '__main__':
+    main()
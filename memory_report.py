@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+from typing import List, Optional
+
+from benchmark import DEFAULT_KEY_SIZE, DEFAULT_POLY_MODULUS_DEGREE, SCHEMES, Cell, create_simulation
+from Blockchain.Memory import MemoryAccountant
+
+
+def print_report(label: str, report: dict):
+    print(f"{label}: chains {report['chains_total_bytes']} bytes, traced {report.get('traced_bytes', '-')} bytes")
+    for name, chain in report["chains"].items():
+        print(f"  {name:<20} {chain['blocks']:6d} blocks {chain['bytes']:12d} bytes "
+              f"({chain['shared_bytes']} shared)")
+        for block_type, entry in sorted(chain["block_types"].items(), key=lambda item: -item[1]["bytes"]):
+            print(f"    {str(block_type):<38} {entry['count']:6d} {entry['bytes']:12d}")
+    for name, node in report["nodes"].items():
+        largest = ", ".join(f"{attribute} {size}" for attribute, size in list(node["attributes"].items())[:3])
+        print(f"  {name:<40} {node['bytes']:12d} bytes  {largest}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run rounds of a scheme and report the memory of its chains, "
+                                                 "block types and nodes after every round.")
+    parser.add_argument("--scheme", default="partial", choices=SCHEMES)
+    parser.add_argument("--neighborhood", default="nh7")
+    parser.add_argument("--log-count", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=4)
+    parser.add_argument("--parameter", type=int, default=None,
+                        help="key size or poly modulus degree, defaults to the benchmark defaults")
+    parser.add_argument("--interval", type=float, default=10, help="traffic update interval in seconds")
+    parser.add_argument("--sleep-time", type=float, default=0.2)
+    parser.add_argument("--virtual-time", action="store_true")
+    parser.add_argument("--leak-window", type=int, default=3,
+                        help="rounds a node attribute has to keep growing to be flagged")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="skip the tracemalloc snapshots")
+    parser.add_argument("--output", default="benchmark_results/memory")
+    args = parser.parse_args(argv)
+
+    parameter = args.parameter
+    if parameter is None:
+        parameter = DEFAULT_KEY_SIZE if args.scheme == "partial" else DEFAULT_POLY_MODULUS_DEGREE
+
+    simulation = create_simulation(Cell(args.scheme, args.neighborhood, args.log_count, parameter, 0),
+                                   args.sleep_time, args.interval, args.virtual_time)
+    accountant = MemoryAccountant(simulation, trace_allocations=not args.no_tracemalloc,
+                                  leak_window=args.leak_window)
+    print_report("start", accountant.snapshot("start"))
+    simulation.run()
+    print_report("round 1", accountant.snapshot("round 1"))
+    for round_number in range(2, args.rounds + 1):
+        simulation.simulation()
+        print_report(f"round {round_number}", accountant.snapshot(f"round {round_number}"))
+    simulation.end_run()
+    accountant.stop()
+
+    for leak in accountant.leaks():
+        print(f"possible leak: {leak}")
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{args.scheme}_{args.neighborhood}_{args.log_count}.memory.json")
+    with open(path, 'w') as f:
+        json.dump(accountant.to_dict(), f, indent=2)
+    print(f"memory report written to {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import heapq
+import math
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from Blockchain import Blockchain
+from Blockchain.Metrics import MetricsRegistry, default_registry
+from routing import RoutingEngine, dijkstra
+
+# entries whose bounds are checked against the faster arcs at once, bounds the memory of the check
+BOUND_CHUNK_SIZE = 256
+
+
+class CachedRoute:
+    def __init__(self, eta: float, nodes: List, arcs: List[int]):
+        self.eta = eta
+        self.nodes = nodes
+        self.arcs = arcs
+        self.stale = False
+
+
+class CachedTree:
+    """The fastest routes from one origin to every node, with the arcs that changed since it was last repaired."""
+
+    def __init__(self, distances: Dict[int, float], parents: Dict[int, int]):
+        self.distances = distances
+        self.parents = parents
+        self.pending: Set[int] = set()
+
+
+class RouteCache:
+    """
+    Routes and ETAs of a RoutingEngine cached by origin and destination, kept valid across traffic rounds.
+
+    Every cached route records the arcs it drives on. When a round changes travel times the routes on a changed arc
+    are invalidated, and a route elsewhere only when an arc that got faster could beat it: the landmark lower bound of
+    origin to arc plus the arc plus arc to destination is below its ETA. Invalidated routes are recomputed lazily,
+    when they are asked for again, so the cost of an update does not grow with the number of cached routes. One to
+    many trees collect the changed arcs and are repaired on their next use: the subtrees hanging below a changed arc
+    are reset and the searches restart only from their boundary and from the heads of the changed arcs.
+    """
+
+    def __init__(self, engine: RoutingEngine, metrics: Optional[MetricsRegistry] = None):
+        self.engine = engine
+        self.metrics = metrics if metrics is not None else default_registry
+        self.routes: Dict[Tuple[int, int], CachedRoute] = {}
+        self.trees: Dict[int, CachedTree] = {}
+        # the cached routes that drive on every arc
+        self.arc_routes: Dict[int, Set[Tuple[int, int]]] = defaultdict(set)
+        # the travel times the cached entries were computed with
+        self.weights = list(engine.weights)
+        self.stats = {"hits": 0, "misses": 0, "invalidated": 0, "recomputed": 0, "recompute_seconds": 0.0,
+                      "tree_hits": 0, "tree_repairs": 0, "repaired_nodes": 0, "update_seconds": 0.0, "updates": 0}
+
+    def hit_rate(self) -> Optional[float]:
+        queries = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / queries if queries else None
+
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["hit_rate"] = self.hit_rate()
+        stats["routes"] = len(self.routes)
+        stats["trees"] = len(self.trees)
+        return stats
+
+    def route(self, source, target) -> Tuple[float, List]:
+        key = (self.engine.node_index[source], self.engine.node_index[target])
+        entry = self.routes.get(key)
+        if entry is not None and not entry.stale:
+            self.stats["hits"] += 1
+            self.metrics.counter("route_cache_queries", result="hit").inc()
+            return entry.eta, entry.nodes
+        self.stats["misses"] += 1
+        self.metrics.counter("route_cache_queries", result="miss").inc()
+        start = time.perf_counter()
+        with self.metrics.timer("route_cache_recompute", kind="route"):
+            eta, nodes = self.engine.route(source, target)
+        self.stats["recompute_seconds"] += time.perf_counter() - start
+        if entry is not None:
+            self.stats["recomputed"] += 1
+            self._forget(key, entry)
+        arcs = [self.engine.arc_index[(self.engine.node_index[start_node], self.engine.node_index[end_node])]
+                for start_node, end_node in zip(nodes, nodes[1:])]
+        self.routes[key] = CachedRoute(eta, nodes, arcs)
+        for arc in arcs:
+            self.arc_routes[arc].add(key)
+        return eta, nodes
+
+    def eta(self, source, target) -> float:
+        return self.route(source, target)[0]
+
+    def etas(self, source, targets: Optional[Sequence] = None) -> Dict:
+        """Travel times from source to the targets, or to every node, from the cached tree of source."""
+        origin = self.engine.node_index[source]
+        tree = self.trees.get(origin)
+        if tree is None:
+            self.stats["misses"] += 1
+            self.metrics.counter("route_cache_queries", result="miss").inc()
+            start = time.perf_counter()
+            with self.metrics.timer("route_cache_recompute", kind="tree"):
+                distances, parents = dijkstra(self.engine.forward, self.engine.weights, origin)
+            self.stats["recompute_seconds"] += time.perf_counter() - start
+            tree = CachedTree(distances, {node: parents[node] for node in distances})
+            self.trees[origin] = tree
+        elif tree.pending:
+            self.stats["misses"] += 1
+            self.metrics.counter("route_cache_queries", result="repair").inc()
+            self.repair(origin, tree)
+        else:
+            self.stats["hits"] += 1
+            self.stats["tree_hits"] += 1
+            self.metrics.counter("route_cache_queries", result="hit").inc()
+        nodes = self.engine.nodes
+        if targets is None:
+            return {nodes[node]: distance for node, distance in tree.distances.items()}
+        return {target: tree.distances.get(self.engine.node_index[target], math.inf) for target in targets}
+
+    def repair(self, origin: int, tree: CachedTree):
+        """
+        Brings a tree up to date with its changed arcs. The nodes below a changed tree arc lose their distance, then
+        a Dijkstra seeded with the best distance every reset node gets from outside its subtree and with the heads of
+        the changed arcs that got faster settles only the nodes whose distance changes.
+        """
+        start = time.perf_counter()
+        weights, arcs = self.engine.weights, self.engine.arcs
+        distances, parents = tree.distances, tree.parents
+        children: Dict[int, List[int]] = defaultdict(list)
+        for node, arc in parents.items():
+            if arc != -1:
+                children[arcs[arc][0]].append(node)
+        reset = set()
+        stack = [arcs[arc][1] for arc in tree.pending if parents.get(arcs[arc][1]) == arc]
+        while stack:
+            node = stack.pop()
+            if node in reset:
+                continue
+            reset.add(node)
+            stack.extend(children[node])
+        for node in reset:
+            del distances[node]
+            del parents[node]
+        heap = []
+        for node in reset:
+            for neighbor, arc in self.engine.backward[node]:
+                if neighbor in distances and distances[neighbor] + weights[arc] < distances.get(node, math.inf):
+                    distances[node] = distances[neighbor] + weights[arc]
+                    parents[node] = arc
+            if node in distances:
+                heapq.heappush(heap, (distances[node], node))
+        for arc in tree.pending:
+            tail, head = arcs[arc]
+            if tail in distances and distances[tail] + weights[arc] < distances.get(head, math.inf):
+                distances[head] = distances[tail] + weights[arc]
+                parents[head] = arc
+                heapq.heappush(heap, (distances[head], head))
+        touched = len(reset)
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances.get(node, math.inf):
+                continue
+            touched += 1
+            for neighbor, arc in self.engine.forward[node]:
+                candidate = distance + weights[arc]
+                if candidate < distances.get(neighbor, math.inf):
+                    distances[neighbor] = candidate
+                    parents[neighbor] = arc
+                    heapq.heappush(heap, (candidate, neighbor))
+        tree.pending = set()
+        seconds = time.perf_counter() - start
+        self.stats["tree_repairs"] += 1
+        self.stats["repaired_nodes"] += touched
+        self.stats["recompute_seconds"] += seconds
+        self.metrics.histogram("route_cache_recompute", kind="repair").record(int(seconds * 1e9))
+
+    def _forget(self, key: Tuple[int, int], entry: CachedRoute):
+        for arc in entry.arcs:
+            self.arc_routes[arc].discard(key)
+
+    @staticmethod
+    def lower_bounds(from_landmarks: np.ndarray, to_landmarks: np.ndarray, sources: np.ndarray,
+                     targets: np.ndarray) -> np.ndarray:
+        # the landmark bound of every source to every target as a len(sources) x len(targets) array
+        with np.errstate(invalid="ignore"):
+            forward = from_landmarks[targets][None, :, :] - from_landmarks[sources][:, None, :]
+            backward = to_landmarks[sources][:, None, :] - to_landmarks[targets][None, :, :]
+            bounds = np.fmax(forward, backward)
+        # inf - inf is no bound at all
+        return np.where(np.isnan(bounds), -math.inf, bounds).max(axis=2, initial=0.0)
+
+    def invalidate(self, changed: Set[int]) -> int:
+        """Marks the cached routes the changed arcs can affect as stale and hands the arcs to the trees."""
+        start = time.perf_counter()
+        weights = self.engine.weights
+        faster = [arc for arc in changed if weights[arc] < self.weights[arc]]
+        for arc in changed:
+            self.weights[arc] = weights[arc]
+        stale = set()
+        for arc in changed:
+            stale |= self.arc_routes.get(arc, set())
+        keys = [key for key, entry in self.routes.items() if not entry.stale and key not in stale]
+        if faster and keys and self.engine.landmarks:
+            from_landmarks = np.array(self.engine.from_landmarks)
+            to_landmarks = np.array(self.engine.to_landmarks)
+            tails = np.array([self.engine.arcs[arc][0] for arc in faster])
+            heads = np.array([self.engine.arcs[arc][1] for arc in faster])
+            arc_weights = np.array([weights[arc] for arc in faster])
+            for chunk in range(0, len(keys), BOUND_CHUNK_SIZE):
+                chunk_keys = keys[chunk:chunk + BOUND_CHUNK_SIZE]
+                origins = np.array([origin for origin, _ in chunk_keys])
+                destinations = np.array([destination for _, destination in chunk_keys])
+                etas = np.array([self.routes[key].eta for key in chunk_keys])
+                # a route through a faster arc takes at least origin to its tail, the arc and its head to destination
+                through = self.lower_bounds(from_landmarks, to_landmarks, origins, tails) + arc_weights[None, :] + \
+                    self.lower_bounds(from_landmarks, to_landmarks, heads, destinations).T
+                beaten = (through < etas[:, None] - 1e-9).any(axis=1)
+                stale.update(key for key, is_beaten in zip(chunk_keys, beaten.tolist()) if is_beaten)
+        elif faster:
+            # without landmarks any route can be beaten by a faster arc
+            stale.update(keys)
+        for key in stale:
+            entry = self.routes.get(key)
+            if entry is not None and not entry.stale:
+                entry.stale = True
+        for tree in self.trees.values():
+            tree.pending |= changed
+        seconds = time.perf_counter() - start
+        self.stats["invalidated"] += len(stale)
+        self.stats["updates"] += 1
+        self.stats["update_seconds"] += seconds
+        self.metrics.counter("route_cache_invalidated").inc(len(stale))
+        return len(stale)
+
+    def set_speeds(self, traffic: Dict) -> int:
+        return self.invalidate(self.engine.set_speeds(traffic))
+
+    def update_from_chain(self, blockchain: Blockchain) -> int:
+        """Applies the traffic blocks the chain got since the last update and invalidates what they can affect."""
+        return self.invalidate(self.engine.update_from_chain(blockchain))
+
+    def clear(self):
+        self.routes.clear()
+        self.trees.clear()
+        self.arc_routes.clear()
+
+
+def simulate_rounds(cache: RouteCache, pairs: List[Tuple], origins: List, rounds: int, queries_per_round: int,
+                    changed_fraction: float, rng: random.Random) -> Dict:
+    """Rounds that each change the speed of a fraction of the edges and then query random cached routes."""
+    engine = cache.engine
+    full_seconds = 0.0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        edges = rng.sample(engine.edges, max(1, int(changed_fraction * len(engine.edges))))
+        cache.set_speeds({edge: rng.uniform(10, 80) for edge in edges})
+        for _ in range(queries_per_round):
+            source, target = rng.choice(pairs)
+            if rng.random() < 0.5:
+                cache.eta(source, target)
+            else:
+                cache.etas(rng.choice(origins), [target])
+        # what answering the same queries without a cache costs
+        full_start = time.perf_counter()
+        for source, target in pairs[:queries_per_round]:
+            engine.eta(source, target)
+        full_seconds += time.perf_counter() - full_start
+    seconds = time.perf_counter() - start - full_seconds
+    stats = cache.get_stats()
+    stats["seconds"] = seconds
+    stats["uncached_seconds"] = full_seconds
+    return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Measure the hit rate and the recompute cost of the route cache "
+                                                 "while traffic rounds change a part of the edges.")
+    parser.add_argument("--graph", default="graphs/nh7.gml")
+    parser.add_argument("--pairs", type=int, default=500, help="origin destination pairs the queries draw from")
+    parser.add_argument("--origins", type=int, default=20, help="origins with a one to many tree")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200, help="queries per round")
+    parser.add_argument("--changed-fractions", nargs="+", type=float, default=[0.01, 0.05, 0.2],
+                        help="share of the edges a round changes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for fraction in args.changed_fractions:
+        rng = random.Random(args.seed)
+        engine = RoutingEngine.from_gml(args.graph, seed=args.seed)
+        pairs = [(rng.choice(engine.nodes), rng.choice(engine.nodes)) for _ in range(args.pairs)]
+        origins = [rng.choice(engine.nodes) for _ in range(args.origins)]
+        stats = simulate_rounds(RouteCache(engine), pairs, origins, args.rounds, args.queries, fraction, rng)
+        print(f"{fraction:.0%} of the edges per round: hit rate {stats['hit_rate']:.3f}, {stats['invalidated']} "
+              f"invalidated, {stats['tree_repairs']} tree repairs over {stats['repaired_nodes']} nodes, "
+              f"{stats['seconds']:.3f}s with the cache against {stats['uncached_seconds']:.3f}s without")
+
+
+if __name__ == '__main__':
+    main()
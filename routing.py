@@ -0,0 +1,423 @@
+import argparse
+import heapq
+import math
+import os
+import random
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import networkx as nx
+import numpy as np
+
+from benchmark import DEFAULT_KEY_SIZE
+from Blockchain import Blockchain
+from Blockchain.Block import Block
+from utils import calc_edge_hash, decode_ordinal_traffic
+
+# the blocks whose traffic maps are the latest averages of a neighborhood
+TRAFFIC_BLOCK_TYPES = ("average_traffic", "average_traffic_delta", "approved")
+
+KMH_PER_MS = 3.6
+
+
+def dijkstra(adjacency: List[List[Tuple[int, int]]], weights: List[float], source: int,
+             targets: Optional[Set[int]] = None) -> Tuple[Dict[int, float], Dict[int, int]]:
+    """Distances and the arc into every settled node, until every target is settled when targets are given."""
+    distances = {source: 0.0}
+    parents = {source: -1}
+    settled = set()
+    remaining = set(targets) if targets is not None else None
+    heap = [(0.0, source)]
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        settled.add(node)
+        if remaining is not None:
+            remaining.discard(node)
+            if not remaining:
+                break
+        for neighbor, arc in adjacency[node]:
+            candidate = distance + weights[arc]
+            if candidate < distances.get(neighbor, math.inf):
+                distances[neighbor] = candidate
+                parents[neighbor] = arc
+                heapq.heappush(heap, (candidate, neighbor))
+    return {node: distances[node] for node in settled}, parents
+
+
+class RoutingEngine:
+    """
+    Travel times over a street graph weighted by length / the latest average speed of every edge.
+
+    Point to point queries run A* with ALT landmarks: the distances from and to a few far apart landmarks are computed
+    once on the free flow times at max_speed. Travel times at the approved speeds, which are capped at max_speed, are
+    never shorter, so these bounds stay admissible through every traffic update. update_from_chain also recomputes
+    the landmark distances on the approved times of the round, which are much tighter bounds, and an arc that gets
+    faster than they assume falls back to the free flow ones. One to many and many to one queries run a Dijkstra that
+    stops when every target is settled. Graphs without edge lengths get default_length for every edge, edges without
+    an approved speed drive at default_speed. Times are in seconds, speeds in km/h like the traffic logs.
+    """
+
+    def __init__(self, graph: nx.Graph, landmark_count: int = 8, default_speed: float = 50, max_speed: float = 130,
+                 min_speed: float = 5, default_length: float = 100, active_landmarks: int = 4,
+                 refresh_on_update: bool = True, seed: int = 0):
+        self.graph = graph
+        self.active_landmarks = active_landmarks
+        self.refresh_on_update = refresh_on_update
+        self.default_speed = default_speed
+        self.max_speed = max_speed
+        self.min_speed = min_speed
+        self.nodes = list(graph.nodes)
+        self.node_index = {node: index for index, node in enumerate(self.nodes)}
+        self.edges = list(graph.edges)
+        # every edge of an undirected graph is driven both ways, as two arcs
+        self.arcs: List[Tuple[int, int]] = []
+        self.arc_edges: List[Tuple] = []
+        self.edge_arcs: Dict = {}
+        for edge in self.edges:
+            start, end = self.node_index[edge[0]], self.node_index[edge[1]]
+            directions = [(start, end)] if graph.is_directed() else [(start, end), (end, start)]
+            arcs = []
+            for arc in directions:
+                arcs.append(len(self.arcs))
+                self.arcs.append(arc)
+                self.arc_edges.append(edge)
+            # traffic maps are keyed by the edge, its hash or, undirected, the edge read back the other way around
+            keys = [edge, calc_edge_hash(edge)]
+            if not graph.is_directed():
+                keys += [(edge[1], edge[0]), calc_edge_hash((edge[1], edge[0]))]
+            for key in keys:
+                self.edge_arcs.setdefault(key, arcs)
+        self.lengths = [float(graph.edges[edge].get("length", default_length)) for edge in self.arc_edges]
+        self.speeds = [float(default_speed)] * len(self.arcs)
+        self.weights = [self.travel_time(length, default_speed) for length in self.lengths]
+        self.lower_bounds = [length / (max_speed / KMH_PER_MS) for length in self.lengths]
+        self.forward: List[List[Tuple[int, int]]] = [[] for _ in self.nodes]
+        self.backward: List[List[Tuple[int, int]]] = [[] for _ in self.nodes]
+        self.arc_index = {arc: index for index, arc in enumerate(self.arcs)}
+        for arc, (start, end) in enumerate(self.arcs):
+            self.forward[start].append((end, arc))
+            self.backward[end].append((start, arc))
+        self.version = 0
+        self.last_settled = 0
+        self.chain_positions: Dict[int, Block] = {}
+        # the edges of the street_graph block of every neighborhood, what ordinal encoded blocks refer to
+        self.street_graphs: Dict[str, List] = {}
+        self.view_versions: Dict[int, int] = {}
+        self.landmarks: List[int] = []
+        self.landmark_weights = self.lower_bounds
+        self.free_flow_tables: Tuple[List, List] = ([], [])
+        self.from_landmarks: List[Tuple[float, ...]] = []
+        self.to_landmarks: List[Tuple[float, ...]] = []
+        self.select_landmarks(landmark_count, random.Random(seed))
+
+    @staticmethod
+    def from_gml(path: str, **kwargs) -> 'RoutingEngine':
+        return RoutingEngine(nx.read_gml(path), **kwargs)
+
+    def travel_time(self, length: float, speed: float) -> float:
+        return length / (min(max(speed, self.min_speed), self.max_speed) / KMH_PER_MS)
+
+    def select_landmarks(self, count: int, rng: random.Random):
+        # farthest point selection on the free flow times, every landmark as far as possible from the ones before
+        count = min(count, len(self.nodes))
+        if count == 0:
+            return
+        nearest = [math.inf] * len(self.nodes)
+        candidate = rng.randrange(len(self.nodes))
+        for _ in range(count):
+            self.landmarks.append(candidate)
+            from_column, to_column = self.landmark_distances(candidate, self.lower_bounds)
+            for node in range(len(self.nodes)):
+                nearest[node] = min(nearest[node], from_column[node], to_column[node])
+            # a node no landmark reaches yet is infinitely far, its component gets the next landmark
+            remaining = [node for node in range(len(self.nodes)) if node not in self.landmarks]
+            if not remaining:
+                break
+            candidate = max(remaining, key=lambda node: nearest[node])
+        self.compute_landmark_tables(self.lower_bounds)
+        self.free_flow_tables = (self.from_landmarks, self.to_landmarks)
+
+    def landmark_distances(self, landmark: int, weights: List[float]) -> Tuple[List[float], List[float]]:
+        from_distances, _ = dijkstra(self.forward, weights, landmark)
+        to_distances, _ = dijkstra(self.backward, weights, landmark)
+        return ([from_distances.get(node, math.inf) for node in range(len(self.nodes))],
+                [to_distances.get(node, math.inf) for node in range(len(self.nodes))])
+
+    def compute_landmark_tables(self, weights: List[float]):
+        columns = [self.landmark_distances(landmark, weights) for landmark in self.landmarks]
+        self.from_landmarks = list(zip(*[from_column for from_column, _ in columns]))
+        self.to_landmarks = list(zip(*[to_column for _, to_column in columns]))
+        # the bounds hold as long as no arc gets faster than these weights
+        self.landmark_weights = list(weights)
+
+    def refresh_landmarks(self):
+        """Recomputes the landmark distances on the current travel times, which tightens the bounds of A*."""
+        if self.landmarks:
+            self.compute_landmark_tables(self.weights)
+
+    def heuristic(self, source: int, target: int):
+        # d(v, t) >= d(L, t) - d(L, v) and >= d(v, L) - d(t, L), with the landmarks the target has distances to
+        from_target = [(k, distance) for k, distance in enumerate(self.from_landmarks[target]) if distance < math.inf]
+        to_target = [(k, distance) for k, distance in enumerate(self.to_landmarks[target]) if distance < math.inf]
+        from_landmarks, to_landmarks = self.from_landmarks, self.to_landmarks
+        # only the landmarks that bound the source best, fewer terms per node pay off more than slightly tighter bounds
+        from_source, to_source = from_landmarks[source], to_landmarks[source]
+        terms = [(distance - from_source[k], 0, k, distance) for k, distance in from_target] + \
+                [(to_source[k] - distance, 1, k, distance) for k, distance in to_target]
+        terms = sorted(terms, reverse=True)[:self.active_landmarks]
+        from_target = [(k, distance) for _, side, k, distance in terms if side == 0]
+        to_target = [(k, distance) for _, side, k, distance in terms if side == 1]
+
+        def bound(node: int) -> float:
+            best = 0.0
+            from_node, to_node = from_landmarks[node], to_landmarks[node]
+            for k, distance in from_target:
+                if distance - from_node[k] > best:
+                    best = distance - from_node[k]
+            for k, distance in to_target:
+                if to_node[k] - distance > best:
+                    best = to_node[k] - distance
+            return best
+
+        return bound
+
+    def route(self, source, target) -> Tuple[float, List]:
+        """The travel time in seconds and the nodes of the fastest route, inf and no nodes when there is none."""
+        start, goal = self.node_index[source], self.node_index[target]
+        bound = self.heuristic(start, goal) if self.landmarks else (lambda node: 0.0)
+        weights, forward = self.weights, self.forward
+        distances = {start: 0.0}
+        parents = {start: -1}
+        settled = set()
+        heap = [(bound(start), start)]
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled.add(node)
+            if node == goal:
+                break
+            distance = distances[node]
+            for neighbor, arc in forward[node]:
+                candidate = distance + weights[arc]
+                if candidate < distances.get(neighbor, math.inf):
+                    distances[neighbor] = candidate
+                    parents[neighbor] = arc
+                    heapq.heappush(heap, (candidate + bound(neighbor), neighbor))
+        self.last_settled = len(settled)
+        if goal not in settled:
+            return math.inf, []
+        return distances[goal], [self.nodes[node] for node in self.path(parents, goal)]
+
+    def path(self, parents: Dict[int, int], node: int) -> List[int]:
+        nodes = [node]
+        while parents[node] != -1:
+            node = self.arcs[parents[node]][0]
+            nodes.append(node)
+        return nodes[::-1]
+
+    def path_edges(self, nodes: Sequence) -> List[Tuple]:
+        # the graph edges a route drives on, in the orientation the graph stores them
+        return [self.arc_edges[self.arc_index[(self.node_index[start], self.node_index[end])]]
+                for start, end in zip(nodes, nodes[1:])]
+
+    def eta(self, source, target) -> float:
+        return self.route(source, target)[0]
+
+    def etas(self, source, targets: Optional[Iterable] = None) -> Dict:
+        """Travel times from source to every target, or to every node without targets."""
+        goals = None if targets is None else {self.node_index[target] for target in targets}
+        distances, _ = dijkstra(self.forward, self.weights, self.node_index[source], goals)
+        self.last_settled = len(distances)
+        if targets is None:
+            return {self.nodes[node]: distance for node, distance in distances.items()}
+        return {target: distances.get(self.node_index[target], math.inf) for target in targets}
+
+    def etas_to(self, target, sources: Optional[Iterable] = None) -> Dict:
+        """Travel times from every source to target, one search backwards from the target."""
+        goals = None if sources is None else {self.node_index[source] for source in sources}
+        distances, _ = dijkstra(self.backward, self.weights, self.node_index[target], goals)
+        self.last_settled = len(distances)
+        if sources is None:
+            return {self.nodes[node]: distance for node, distance in distances.items()}
+        return {source: distances.get(self.node_index[source], math.inf) for source in sources}
+
+    def eta_matrix(self, sources: Sequence, targets: Sequence) -> np.ndarray:
+        """The travel times of every source to every target as a len(sources) x len(targets) array."""
+        matrix = np.empty((len(sources), len(targets)))
+        if len(sources) <= len(targets):
+            for row, source in enumerate(sources):
+                etas = self.etas(source, targets)
+                matrix[row] = [etas[target] for target in targets]
+        else:
+            for column, target in enumerate(targets):
+                etas = self.etas_to(target, sources)
+                matrix[:, column] = [etas[source] for source in sources]
+        return matrix
+
+    def set_speeds(self, traffic: Dict) -> Set[int]:
+        """Takes average speeds keyed by edge or edge hash and returns the arcs whose travel time changed."""
+        changed = set()
+        for key, speed in traffic.items():
+            # the fully homomorphic scheme approves (average, variance) pairs
+            speed = speed[0] if isinstance(speed, (tuple, list)) else speed
+            for arc in self.edge_arcs.get(key, ()):
+                weight = self.travel_time(self.lengths[arc], float(speed))
+                if weight != self.weights[arc]:
+                    self.weights[arc] = weight
+                    changed.add(arc)
+                self.speeds[arc] = float(speed)
+        if changed:
+            self.version += 1
+        if self.landmarks and any(self.weights[arc] < self.landmark_weights[arc] for arc in changed):
+            # a faster arc would let refreshed bounds overestimate, the free flow ones hold for any speed
+            self.from_landmarks, self.to_landmarks = self.free_flow_tables
+            self.landmark_weights = self.lower_bounds
+        return changed
+
+    def decode_traffic(self, data: Dict) -> Dict:
+        traffic_key = "traffic" if data["type"] == "approved" else "average_traffic"
+        if "edges" in data:
+            # edge ordinals refer to the street_graph block of the neighborhood, without one on the chain to the
+            # street graph the router was built from
+            edges = self.street_graphs.get(data.get("neighborhood", ""), self.edges)
+            return decode_ordinal_traffic(data["edges"], data[traffic_key], edges)
+        return data[traffic_key]
+
+    def apply_block(self, block: Block) -> Set[int]:
+        if block.data.get("type") == "street_graph" and block.data.get("edges"):
+            self.street_graphs[block.data.get("neighborhood", "")] = block.data["edges"]
+            return set()
+        if block.data.get("type") not in TRAFFIC_BLOCK_TYPES:
+            return set()
+        return self.set_speeds(self.decode_traffic(block.data))
+
+    def update_from_chain(self, blockchain: Blockchain) -> Set[int]:
+        """
+        Applies the traffic blocks the chain got since the last call, the approved blocks the homomorphic schemes
+        forward to their global chain or the average traffic of a single chain, of the two scheme or of a city.
+        """
+        block = self.chain_positions.get(id(blockchain))
+        block = blockchain.head if block is None else block.next_block
+        changed = set()
+        last = None
+        while block is not None:
+            changed |= self.apply_block(block)
+            last = block
+            block = block.next_block
+        if last is not None:
+            self.chain_positions[id(blockchain)] = last
+        if changed and self.refresh_on_update:
+            self.refresh_landmarks()
+        return changed
+
+    def update_from_view(self, view) -> Set[int]:
+        """Applies the edges a live_traffic.LiveTrafficView changed since the last call, without reading the chain."""
+        version = view.version
+        slots = view.changed_since(self.view_versions.get(id(view), 0))
+        self.view_versions[id(view)] = version
+        changed = self.set_speeds({view.keys[slot]: view.speeds[slot] for slot in slots})
+        if changed and self.refresh_on_update:
+            self.refresh_landmarks()
+        return changed
+
+    def __str__(self):
+        return f"Routing engine over {len(self.nodes)} junctions and {len(self.arcs)} arcs with " \
+               f"{len(self.landmarks)} landmarks"
+
+
+def traffic_chain(simulation) -> Blockchain:
+    # the chain every neighborhood of a scheme posts its averages or its approved traffic to, the global chain of
+    # the two scheme, of a city or of the homomorphic schemes, which spell it globalBlockChain, or the single chain
+    for name in ("globalBlockchain", "globalBlockChain", "blockchain"):
+        chain = getattr(simulation, name, None)
+        if chain is not None:
+            return chain
+    raise ValueError("the simulation has no chain with average traffic")
+
+
+def create_scheme_simulation(scheme: str, graph_path: str, key_size: int):
+    """A simulation of scheme on graph_path on virtual time, the neighborhood name of the fully homomorphic scheme."""
+    if scheme != "fully":
+        from city import create_partition_simulation
+        return create_partition_simulation(scheme, "routing", graph_path, interval=10, sleep_time=0.2,
+                                           virtual_time=True, key_size=key_size)
+    # the fully homomorphic scheme reads its street graph from graphs/ by neighborhood name
+    name = os.path.splitext(os.path.basename(graph_path))[0]
+    if os.path.abspath(graph_path) != os.path.abspath(os.path.join("graphs", name + ".gml")):
+        raise ValueError("the fully homomorphic scheme only runs the neighborhoods in graphs/")
+    import FullyHomomorphyScheme
+    # sparse, so the edges without logs get the default speed instead of dividing by a zero count
+    return FullyHomomorphyScheme.Simulation(name, quiet=True, sleep_time=0.2, update_interval=10, sparse=True,
+                                            virtual_time=True)
+
+
+def benchmark_queries(engine: RoutingEngine, pairs: List[Tuple], matrix_size: int) -> Dict:
+    start = time.perf_counter()
+    settled = 0
+    alt_etas = []
+    for source, target in pairs:
+        alt_etas.append(engine.eta(source, target))
+        settled += engine.last_settled
+    alt_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    dijkstra_settled = 0
+    dijkstra_etas = []
+    for source, target in pairs:
+        dijkstra_etas.append(engine.etas(source, [target])[target])
+        dijkstra_settled += engine.last_settled
+    dijkstra_seconds = time.perf_counter() - start
+    mismatches = sum(1 for a, b in zip(alt_etas, dijkstra_etas) if not (a == b or abs(a - b) < 1e-6))
+    nodes = engine.nodes[:matrix_size]
+    start = time.perf_counter()
+    engine.eta_matrix(nodes, nodes)
+    matrix_seconds = time.perf_counter() - start
+    return {
+        "queries": len(pairs),
+        "alt_microseconds": alt_seconds / len(pairs) * 1e6,
+        "alt_settled": settled / len(pairs),
+        "dijkstra_microseconds": dijkstra_seconds / len(pairs) * 1e6,
+        "dijkstra_settled": dijkstra_settled / len(pairs),
+        "mismatches": mismatches,
+        "matrix_size": len(nodes),
+        "matrix_milliseconds": matrix_seconds * 1e3,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Route over the approved traffic of a scheme and time the queries.")
+    parser.add_argument("--graph", default="graphs/nh7.gml", help="street graph, a neighborhood or an imported net")
+    parser.add_argument("--scheme", default="single", choices=["none", "single", "two", "partial", "fully"],
+                        help="run a round of this scheme on the graph and route over its averages")
+    parser.add_argument("--log-count", type=int, default=1000)
+    parser.add_argument("--key-size", type=int, default=DEFAULT_KEY_SIZE)
+    parser.add_argument("--landmarks", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--matrix-size", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    engine = RoutingEngine.from_gml(args.graph, landmark_count=args.landmarks, seed=args.seed)
+    print(f"{engine} built in {time.perf_counter() - start:.3f}s")
+    if args.scheme != "none":
+        simulation = create_scheme_simulation(args.scheme, args.graph, args.key_size)
+        simulation.random_speed_log_count = args.log_count
+        simulation.run()
+        start = time.perf_counter()
+        changed = engine.update_from_chain(traffic_chain(simulation))
+        print(f"{len(changed)} arcs updated from the {args.scheme} scheme in {time.perf_counter() - start:.4f}s")
+        simulation.end_run()
+    rng = random.Random(args.seed)
+    pairs = [(rng.choice(engine.nodes), rng.choice(engine.nodes)) for _ in range(args.queries)]
+    result = benchmark_queries(engine, pairs, args.matrix_size)
+    print(f"point to point: ALT {result['alt_microseconds']:.0f}us settling {result['alt_settled']:.0f} nodes, "
+          f"Dijkstra {result['dijkstra_microseconds']:.0f}us settling {result['dijkstra_settled']:.0f} nodes, "
+          f"{result['mismatches']} mismatches")
+    print(f"{result['matrix_size']}x{result['matrix_size']} ETA matrix in {result['matrix_milliseconds']:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import json
+import math
+import os
+import sys
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from benchmark import REPOSITORY_ROOT, SCHEMES, DEFAULT_KEY_SIZE, DEFAULT_POLY_MODULUS_DEGREE, expand_grid, \
+    estimated_cost, load_finished_cells, run_grid
+
+# the variables every metric is fitted against
+VARIABLES = ["edges", "logs"]
+
+
+def fit_power_law(samples: List[Tuple[Dict[str, float], float]]) -> Optional[Dict]:
+    """Least squares fit of value = coefficient * edges ^ a * logs ^ b in log space."""
+    samples = [(variables, value) for variables, value in samples
+               if value > 0 and all(variables[name] > 0 for name in VARIABLES)]
+    # a variable that does not vary cannot be fitted
+    names = [name for name in VARIABLES if len({variables[name] for variables, _ in samples}) > 1]
+    if not names or len(samples) <= len(names):
+        return None
+    design = np.array([[1.0] + [math.log(variables[name]) for name in names] for variables, _ in samples])
+    targets = np.log([value for _, value in samples])
+    solution, _, rank, _ = np.linalg.lstsq(design, targets, rcond=None)
+    if rank < design.shape[1]:
+        return None
+    residual = float(np.sum((targets - design @ solution) ** 2))
+    total = float(np.sum((targets - targets.mean()) ** 2))
+    return {
+        "coefficient": math.exp(solution[0]),
+        "exponents": dict(zip(names, solution[1:].tolist())),
+        "r2": 1 - residual / total if total > 0 else 1.0,
+        "samples": len(samples),
+    }
+
+
+def collect_samples(records: List[Dict], neighborhoods_data: Dict) -> Dict[Tuple, Dict[str, List]]:
+    samples: Dict[Tuple, Dict[str, List]] = {}
+    for record in records:
+        if record.get("error") is not None or record.get("data") is None:
+            continue
+        variables = {
+            "edges": neighborhoods_data[record["neighborhood"]]["edge_count"],
+            "logs": record["log_count"],
+        }
+        metrics = {"wall_time": record.get("wall_time"), "peak_memory_kb": record.get("peak_memory_kb")}
+        metrics.update({metric: value for metric, value in record["data"].items() if metric.endswith("_time")})
+        group = samples.setdefault((record["scheme"], record["parameter"]), {})
+        for metric, value in metrics.items():
+            if isinstance(value, (int, float)):
+                group.setdefault(metric, []).append((variables, value))
+    return samples
+
+
+def fit_scaling(records: List[Dict], neighborhoods_data: Dict) -> Dict:
+    fits = {}
+    for (scheme, parameter), metrics in sorted(collect_samples(records, neighborhoods_data).items(),
+                                               key=lambda item: str(item[0])):
+        parameter_key = "default" if parameter is None else str(parameter)
+        for metric, samples in sorted(metrics.items()):
+            fit = fit_power_law(samples)
+            if fit is not None:
+                fits.setdefault(scheme, {}).setdefault(parameter_key, {})[metric] = fit
+    return fits
+
+
+def super_linear_fits(fits: Dict, max_exponent: float) -> List[str]:
+    findings = []
+    for scheme, parameters in fits.items():
+        for parameter, metrics in parameters.items():
+            for metric, fit in metrics.items():
+                for name, exponent in fit["exponents"].items():
+                    if exponent > max_exponent:
+                        findings.append(f"{scheme} ({parameter}) {metric} grows with {name} ^ {exponent:.2f}")
+    return findings
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Fit time and memory of every scheme against edges and logs on the "
+                                                 "generated neighborhoods.")
+    parser.add_argument("--schemes", nargs="+", default=["single", "two", "partial"], choices=SCHEMES)
+    parser.add_argument("--neighborhoods", nargs="+", default=None,
+                        help="defaults to every generated neighborhood in graphs/neighborhoods_data.json")
+    parser.add_argument("--log-counts", nargs="+", type=int, default=[10, 100, 1000])
+    parser.add_argument("--key-size", type=int, default=DEFAULT_KEY_SIZE)
+    parser.add_argument("--poly-modulus-degree", type=int, default=DEFAULT_POLY_MODULUS_DEGREE)
+    parser.add_argument("--repetitions", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--timeout", type=float, default=None, help="seconds before a cell is killed")
+    parser.add_argument("--sleep-time", type=float, default=0.2)
+    parser.add_argument("--wall-clock", action="store_true",
+                        help="wait for the update intervals in real time instead of on the virtual clock")
+    parser.add_argument("--max-exponent", type=float, default=1.1,
+                        help="exponents above this are reported as super-linear")
+    parser.add_argument("--strict", action="store_true", help="exit with an error when a fit is super-linear")
+    parser.add_argument("--output", default="benchmark_results/scaling")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    with open(os.path.join(REPOSITORY_ROOT, 'graphs', 'neighborhoods_data.json'), 'r') as f:
+        neighborhoods_data = json.load(f)
+    neighborhoods = args.neighborhoods if args.neighborhoods is not None else \
+        [neighborhood for neighborhood, data in neighborhoods_data.items() if "generator" in data]
+    if not neighborhoods:
+        parser.error("no generated neighborhoods, run generate_graphs.py first")
+
+    os.makedirs(args.output, exist_ok=True)
+    results_path = os.path.join(args.output, "scaling_results.jsonl")
+
+    cells = expand_grid(args.schemes, neighborhoods, args.log_counts, [args.key_size], [args.poly_modulus_degree],
+                        args.repetitions)
+    finished = load_finished_cells(results_path)
+    remaining = [cell for cell in cells if cell.key() not in finished]
+    remaining.sort(key=lambda cell: estimated_cost(cell, neighborhoods_data), reverse=True)
+    print(f"{len(cells)} cells in the grid, {len(cells) - len(remaining)} already finished", flush=True)
+
+    run_grid(remaining, results_path, args.jobs, args.timeout, args.sleep_time, None, not args.wall_clock,
+             args.verbose)
+
+    cell_keys = {cell.key() for cell in cells}
+    records = [record for key, record in load_finished_cells(results_path).items() if key in cell_keys]
+    fits = fit_scaling(records, neighborhoods_data)
+    with open(os.path.join(args.output, "scaling_summary.json"), 'w') as f:
+        json.dump(fits, f, indent=2)
+
+    for scheme, parameters in fits.items():
+        for parameter, metrics in parameters.items():
+            for metric, fit in metrics.items():
+                exponents = ", ".join(f"{name} ^ {exponent:.2f}" for name, exponent in fit["exponents"].items())
+                print(f"{scheme} ({parameter}) {metric}: {exponents} (r2 {fit['r2']:.2f})")
+    findings = super_linear_fits(fits, args.max_exponent)
+    for finding in findings:
+        print(f"super-linear: {finding}")
+    print(f"fits written to {os.path.join(args.output, 'scaling_summary.json')}")
+    if findings and args.strict:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
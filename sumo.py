@@ -1,10 +1,22 @@
-from lxml import etree
+import argparse
+import gzip
+import json
 import math
+from typing import Dict, Iterator, List, Optional, Tuple
+
 import networkx as nx
+import numpy as np
+from lxml import etree
 
 net_file = "BerlinSumo/osm.net.xml"
 route_file = "BerlinSumo/osm.passenger.trips.xml"
 gml_file = "BerlinSumo/osm.net.gml"
+# the committed gml_file is the undirected graph of the notebooks, the import writes next to it
+directed_gml_file = "BerlinSumo/osm.net.directed.gml"
+ids_file = "BerlinSumo/osm.net.ids.json"
+
+EARTH_RADIUS = 6371000  # meters
+
 
 def haversine_distance(coord1, coord2):
     """Calculate the distance between two coordinates in meters using the haversine formula."""
@@ -36,47 +48,217 @@ def interpolate_coords(coord1, coord2, max_distance):
     return interpolated_coords
 
 
-def convert_to_simple_graph(input_path, output_path):
-    try:
-        # Parse the XML file
-        tree = etree.parse(input_path)
-        root = tree.getroot()
+def haversine_distances(coords1: np.ndarray, coords2: np.ndarray) -> np.ndarray:
+    """haversine_distance of every pair of rows of two (n, 2) arrays of latitude and longitude, in meters."""
+    coords1 = np.radians(np.asarray(coords1, dtype=np.float64))
+    coords2 = np.radians(np.asarray(coords2, dtype=np.float64))
+    phi1, phi2 = coords1[..., 0], coords2[..., 0]
+    dphi = phi2 - phi1
+    dlambda = coords2[..., 1] - coords1[..., 1]
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def segment_distances(coords1: np.ndarray, coords2: np.ndarray, geographic: bool) -> np.ndarray:
+    # SUMO nets are projected to meters, FCD with --fcd-output.geo and OSM are latitude and longitude
+    if geographic:
+        return haversine_distances(coords1, coords2)
+    return np.hypot(coords2[..., 0] - coords1[..., 0], coords2[..., 1] - coords1[..., 1])
+
+
+def interpolate_coords_array(coord1, coord2, max_distance: float, geographic: bool = True) -> np.ndarray:
+    """interpolate_coords as one (k, 2) array."""
+    return densify(np.array([coord1, coord2], dtype=np.float64), np.array([0, 2]), max_distance, geographic)[0]
+
+
+def polyline_lengths(points: np.ndarray, offsets: np.ndarray, geographic: bool = False) -> np.ndarray:
+    """The length of every polyline of a flat (n, 2) point array, polyline i being points[offsets[i]:offsets[i + 1]]."""
+    if len(points) < 2:
+        return np.zeros(len(offsets) - 1)
+    lengths = np.concatenate(([0.0], segment_distances(points[:-1], points[1:], geographic)))
+    # the first point of a polyline does not continue the one before
+    lengths[offsets[:-1][offsets[:-1] < len(points)]] = 0.0
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+    return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+
+def densify(points: np.ndarray, offsets: np.ndarray, max_distance: float,
+            geographic: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Resamples every polyline of a flat point array so no segment is longer than max_distance, in one batch.
+
+    Polyline i is points[offsets[i]:offsets[i + 1]]. A segment of length d is split into ceil(d / max_distance)
+    equal parts like interpolate_coords does, and the original points are kept. Returns the new points and offsets.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    count = len(points)
+    if count == 0:
+        return points.reshape(0, 2), offsets.copy()
+    nonempty = offsets[1:] > offsets[:-1]
+    is_last = np.zeros(count, dtype=bool)
+    is_last[offsets[1:][nonempty] - 1] = True
+    following = np.where(is_last, np.arange(count), np.minimum(np.arange(count) + 1, count - 1))
+    distances = segment_distances(points, points[following], geographic)
+    # the points every original point stands for, itself and the ones up to the next original point
+    parts = np.where(is_last, 1, np.maximum(1, np.ceil(distances / max_distance))).astype(np.int64)
+    sources = np.repeat(np.arange(count), parts)
+    starts = np.cumsum(parts) - parts
+    fractions = (np.arange(len(sources)) - np.repeat(starts, parts)) / np.repeat(parts, parts)
+    dense = points[sources] + (points[following[sources]] - points[sources]) * fractions[:, None]
+    dense_offsets = np.concatenate(([0], np.cumsum(parts)))[offsets]
+    return dense, dense_offsets
 
-        G = nx.Graph()  # Create an undirected graph
 
-        nodes = set()
-        edges = set()
+def parse_shapes(shapes: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """The SUMO shape attributes ("x,y x,y ...") as one flat (n, 2) point array and its offsets."""
+    counts = np.array([len(shape.split()) for shape in shapes], dtype=np.int64)
+    text = " ".join(shapes)
+    if text.count(",") == counts.sum():
+        values = np.array(text.replace(",", " ").split(), dtype=np.float64).reshape(-1, 2)
+    else:
+        # shapes with heights, "x,y,z"
+        values = np.array([point.split(",")[:2] for point in text.split()], dtype=np.float64).reshape(-1, 2)
+    return values, np.concatenate(([0], np.cumsum(counts)))
 
-        # Extract edges
-        for edge in root.findall("edge"):
-            print(edge)
-            from_node_id = edge.attrib.get("from")  # Safely get the 'from' attribute
-            to_node_id = edge.attrib.get("to")  # Safely get the 'to' attribute
-            # print all attributes of the edge
-            print(edge.attrib)
-            # add from_node_id to nodes if it is not none
-            if from_node_id is not None:
-                nodes.add(from_node_id)
-            if to_node_id is not None:
-                nodes.add(to_node_id)
 
-            # add the edge to the edges set
-            edges.add((from_node_id, to_node_id))
+def read_lane_shapes(input_path: str) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """The ids and shapes of the lanes of every normal edge of a SUMO net, as parse_shapes returns them."""
+    lane_ids = []
+    shapes = []
+    with open_sumo_file(input_path) as f:
+        for _, element in etree.iterparse(f, events=("end",), tag="edge"):
+            if element.get("function") is None:
+                for lane in element.iterfind("lane"):
+                    lane_ids.append(lane.get("id"))
+                    shapes.append(lane.get("shape", ""))
+            element.clear()
+    points, offsets = parse_shapes(shapes)
+    return lane_ids, points, offsets
 
-        for node in nodes:
-            G.add_node(node)
 
-        for edge in edges:
-            if edge[0] is not None and edge[1] is not None:
-                G.add_edge(*edge)
+def open_sumo_file(input_path: str):
+    # SUMO writes its nets and outputs gzipped as often as not
+    if input_path.endswith(".gz"):
+        return gzip.open(input_path, 'rb')
+    return open(input_path, 'rb')
+
+
+def iter_net_edges(input_path: str, keep_shapes: bool = True) -> Iterator[Dict]:
+    """
+    Streams the normal edges of a SUMO net, internal edges inside the junctions are skipped.
+
+    Every element under <net> is cleared after it was read, so memory stays bounded however big the net is.
+    """
+    with open_sumo_file(input_path) as f:
+        for _, element in etree.iterparse(f, events=("end",)):
+            parent = element.getparent()
+            # lanes and params are read with their edge
+            if parent is None or parent.getparent() is not None:
+                continue
+            if element.tag == "edge" and element.get("function") is None and element.get("from") is not None:
+                lanes = element.findall("lane")
+                edge = {
+                    "id": element.get("id"),
+                    "from": element.get("from"),
+                    "to": element.get("to"),
+                    "length": max((float(lane.get("length", 0)) for lane in lanes), default=0.0),
+                    "speed": max((float(lane.get("speed", 0)) for lane in lanes), default=0.0),
+                    "lanes": len(lanes),
+                    "type": element.get("type", ""),
+                    "name": element.get("name", ""),
+                }
+                if keep_shapes:
+                    shape = element.get("shape")
+                    if shape is None and lanes:
+                        shape = lanes[0].get("shape", "")
+                    edge["shape"] = shape or ""
+                yield edge
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+
+class SumoNet:
+    """
+    The street graph of a SUMO net, directed like the edges of the net and keyed by junction ids.
+
+    Every graph edge keeps the SUMO id, the length in meters, the speed limit in m/s, the lane count, the road type
+    and the street name of its SUMO edge. SUMO edges between the same two junctions share one graph edge, the one
+    read first gives its attributes, and sumo_id_to_edge maps every SUMO id to its graph edge.
+    """
+
+    def __init__(self, graph: nx.DiGraph, sumo_id_to_edge: Dict[str, Tuple[str, str]]):
+        self.graph = graph
+        self.sumo_id_to_edge = sumo_id_to_edge
+
+    @staticmethod
+    def from_net_file(input_path: str, keep_shapes: bool = True) -> 'SumoNet':
+        graph = nx.DiGraph()
+        sumo_id_to_edge = {}
+        for edge in iter_net_edges(input_path, keep_shapes):
+            key = (edge["from"], edge["to"])
+            sumo_id_to_edge[edge["id"]] = key
+            if graph.has_edge(*key):
+                continue
+            attributes = {name: value for name, value in edge.items() if name not in ("id", "from", "to")}
+            graph.add_edge(*key, sumo_id=edge["id"], **attributes)
+        return SumoNet(graph, sumo_id_to_edge)
+
+    def sumo_edge_ids(self) -> List[Tuple[str, str, str]]:
+        # the (start, end, id) triples Simulation.add_sumo_edge_ids takes
+        return [(start, end, sumo_id) for sumo_id, (start, end) in self.sumo_id_to_edge.items()]
+
+    def write(self, output_path: str, ids_path: Optional[str] = None, undirected: bool = False):
+        graph = self.graph.to_undirected() if undirected else self.graph
+        nx.write_gml(graph, output_path)
+        if ids_path is not None:
+            with open(ids_path, 'w') as f:
+                json.dump({sumo_id: list(edge) for sumo_id, edge in self.sumo_id_to_edge.items()}, f)
+
+
+def load_sumo_edge_ids(ids_path: str) -> List[Tuple[str, str, str]]:
+    """The id map written next to an imported graph, ready for Simulation.add_sumo_edge_ids."""
+    with open(ids_path, 'r') as f:
+        sumo_id_to_edge = json.load(f)
+    return [(start, end, sumo_id) for sumo_id, (start, end) in sumo_id_to_edge.items()]
+
+
+def convert_to_simple_graph(input_path, output_path):
+    # the undirected graph without attributes the notebooks started with
+    net = SumoNet.from_net_file(input_path, keep_shapes=False)
+    graph = nx.Graph()
+    graph.add_edges_from(net.graph.edges)
+    nx.write_gml(graph, output_path)
+    print(f"Graph conversion completed. GML file saved to: {output_path}")
+    return net.sumo_edge_ids()
+
 
-        # Write the graph to a GML file
-        nx.write_gml(G, output_path)
-        print(f"Graph conversion completed. GML file saved to: {output_path}")
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Import a SUMO net as a street graph with its SUMO edge ids.")
+    parser.add_argument("--net", default=net_file, help="osm.net.xml or osm.net.xml.gz")
+    parser.add_argument("--gml", default=directed_gml_file)
+    parser.add_argument("--ids", default=ids_file, help="JSON map of SUMO edge id to graph edge")
+    parser.add_argument("--no-shapes", action="store_true", help="leave the edge shapes out of the graph")
+    parser.add_argument("--undirected", action="store_true",
+                        help="write an undirected graph like the one in BerlinSumo/osm.net.gml")
+    parser.add_argument("--densify", type=float, default=None, metavar="METERS",
+                        help="also resample every lane shape to segments of at most this length")
+    parser.add_argument("--shapes-output", default="BerlinSumo/osm.lanes.npz",
+                        help="where the densified lane shapes are written")
+    args = parser.parse_args(argv)
 
-    except Exception as e:
-        print(f"Error during conversion: {e}")
+    net = SumoNet.from_net_file(args.net, keep_shapes=not args.no_shapes)
+    net.write(args.gml, args.ids, args.undirected)
+    print(f"{net.graph.number_of_nodes()} junctions and {net.graph.number_of_edges()} edges "
+          f"({len(net.sumo_id_to_edge)} SUMO edges) written to {args.gml} and {args.ids}")
+    if args.densify is not None:
+        lane_ids, points, offsets = read_lane_shapes(args.net)
+        points, offsets = densify(points, offsets, args.densify)
+        np.savez_compressed(args.shapes_output, lane_ids=np.array(lane_ids), points=points, offsets=offsets,
+                            lengths=polyline_lengths(points, offsets))
+        print(f"{len(lane_ids)} lanes densified to {len(points)} points written to {args.shapes_output}")
 
 
 if __name__ == "__main__":
-    convert_to_simple_graph(net_file, gml_file)
+    main()
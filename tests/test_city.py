@@ -0,0 +1,28 @@
+import os
+
+import networkx as nx
+import pytest
+
+from city import CityPartition
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("path", ["BerlinSumo/osm.net.gml", "graphs/nh7.gml", "graphs/nh3.gml"])
+@pytest.mark.parametrize("parts", [2, 3, 5, 7])
+def test_parts_own_balanced_edge_counts(path, parts):
+    graph = nx.read_gml(os.path.join(REPOSITORY_ROOT, path))
+    partition = CityPartition.from_graph(graph, parts=parts)
+    counts = partition.edge_counts()
+    assert sum(counts) == graph.number_of_edges()
+    assert min(counts) > 0
+    if len(counts) == parts:
+        # a part can be off by the few edges of the junction that would overshoot its share
+        assert max(counts) - min(counts) <= max(3, graph.number_of_edges() // (4 * parts))
+
+
+def test_max_edges_gives_the_minimal_part_count():
+    graph = nx.read_gml(os.path.join(REPOSITORY_ROOT, "BerlinSumo/osm.net.gml"))
+    partition = CityPartition.from_graph(graph, max_edges=50)
+    assert len(partition.parts) == 5
+    assert max(partition.edge_counts()) <= 50
@@ -0,0 +1,21 @@
+from compare_results import compare_scheme
+
+
+def test_overlapping_repetitions_of_one_cell_are_not_a_regression():
+    baseline = {("nh7", 100): {"traffic_time": [1.0, 1.5, 0.7, 1.3, 0.9]}}
+    candidate = {("nh7", 100): {"traffic_time": [1.2, 0.8, 1.6, 1.0, 1.4]}}
+    result = compare_scheme(baseline, candidate, {}, 0.1, 0.05)["traffic_time"]
+    assert result["verdict"] == "unchanged"
+    assert result["ci"][0] < 1 < result["ci"][1]
+
+
+def test_a_clear_slowdown_of_one_cell_is_a_regression():
+    baseline = {("nh7", 100): {"traffic_time": [1.0, 1.01, 0.99, 1.02, 0.98]}}
+    candidate = {("nh7", 100): {"traffic_time": [1.5, 1.52, 1.49, 1.51, 1.48]}}
+    assert compare_scheme(baseline, candidate, {}, 0.1, 0.05)["traffic_time"]["verdict"] == "regression"
+
+
+def test_one_value_against_one_value_is_insufficient_data():
+    baseline = {("nh7", 100): {"traffic_time": [1.0]}}
+    candidate = {("nh7", 100): {"traffic_time": [1.36]}}
+    assert compare_scheme(baseline, candidate, {}, 0.1, 0.05)["traffic_time"]["verdict"] == "insufficient data"
@@ -0,0 +1,34 @@
+import os
+
+import networkx as nx
+
+import TwoBlockchainsScheme
+from live_traffic import LiveTrafficView
+from routing import RoutingEngine
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_ordinal_averages_decode_from_the_global_chain_alone():
+    graph_path = os.path.join(REPOSITORY_ROOT, "graphs/nh3.gml")
+    simulation = TwoBlockchainsScheme.Simulation("nh3", quiet=True, random_speed_log_count=30, sleep_time=0.01,
+                                                 traffic_update_interval_in_seconds=1, gml_file=graph_path,
+                                                 ordinal_encoding=True, virtual_time=True)
+    simulation.run()
+    simulation.end_run()
+    node = simulation.node
+    expected = node.decode_average_traffic(node.latest_average_block.data)
+    assert [block.data["type"] for block in simulation.globalBlockchain][1] == "street_graph"
+
+    view = LiveTrafficView(simulation.globalBlockchain)
+    view.refresh()
+    # a router whose graph lists the edges in another order than the street_graph block
+    graph = nx.read_gml(graph_path)
+    shuffled = nx.Graph()
+    shuffled.add_nodes_from(graph.nodes(data=True))
+    shuffled.add_edges_from(reversed(list(graph.edges(data=True))))
+    engine = RoutingEngine(shuffled, max_speed=1000)
+    engine.update_from_chain(simulation.globalBlockchain)
+    for edge, speed in expected.items():
+        assert view.speed(edge) == speed
+        assert engine.speeds[engine.edge_arcs[edge][0]] == speed
@@ -0,0 +1,27 @@
+import os
+import random
+
+import pytest
+
+from Blockchain.Metrics import MetricsRegistry
+from route_cache import RouteCache
+from routing import RoutingEngine
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_repair_records_its_cost_with_an_enabled_registry():
+    engine = RoutingEngine.from_gml(os.path.join(REPOSITORY_ROOT, "graphs/nh7.gml"))
+    metrics = MetricsRegistry(enabled=True)
+    cache = RouteCache(engine, metrics=metrics)
+    origin = engine.nodes[0]
+    cache.etas(origin)
+    rng = random.Random(0)
+    cache.set_speeds({edge: rng.uniform(10, 80) for edge in rng.sample(engine.edges, 10)})
+    repaired = cache.etas(origin)
+    assert cache.stats["tree_repairs"] == 1
+    assert metrics.histogram("route_cache_recompute", kind="repair").count == 1
+    expected = engine.etas(origin)
+    assert repaired.keys() == expected.keys()
+    for node, eta in expected.items():
+        assert repaired[node] == pytest.approx(eta)
@@ -0,0 +1,22 @@
+import numpy as np
+
+from workload import Workload
+
+
+def test_generated_reports_are_in_timestamp_order():
+    workload = Workload([(node, node + 1) for node in range(50)], seed=0, base_rate=400)
+    batch = workload.generate(5)
+    assert len(batch) > 0
+    assert np.all(np.diff(batch.timestamps) >= 0)
+    count_batch = workload.generate_count(1000)
+    assert len(count_batch) == 1000
+    assert np.all(np.diff(count_batch.timestamps) >= 0)
+
+
+def test_a_round_without_reports_is_an_empty_batch():
+    workload = Workload([(node, node + 1) for node in range(50)], seed=0)
+    start = workload.time
+    batch = workload.generate_count(0)
+    assert len(batch) == 0
+    assert list(batch) == []
+    assert workload.time == start
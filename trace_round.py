@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+from typing import List, Optional
+
+from benchmark import DEFAULT_KEY_SIZE, DEFAULT_POLY_MODULUS_DEGREE, Cell, create_simulation
+from Blockchain.Tracing import default_tracer
+
+# the schemes that run the ten protocol steps across a local and the global chain
+TRACED_SCHEMES = ["partial", "fully"]
+
+
+def print_waterfall(waterfall: List[dict]):
+    for span in waterfall:
+        print(f"{span['offset_seconds']:10.3f}s {span['duration_seconds']:10.3f}s  {span['kind']:<4}  "
+              f"{span['name']:<40} {span['node']:<15} {span['chain']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run one round of a scheme and export its timeline as a Chrome "
+                                                 "trace, open it in chrome://tracing or ui.perfetto.dev.")
+    parser.add_argument("--scheme", default="partial", choices=TRACED_SCHEMES)
+    parser.add_argument("--neighborhood", default="nh7")
+    parser.add_argument("--log-count", type=int, default=100)
+    parser.add_argument("--parameter", type=int, default=None,
+                        help="key size or poly modulus degree, defaults to the benchmark defaults")
+    parser.add_argument("--interval", type=float, default=10, help="traffic update interval in seconds")
+    parser.add_argument("--sleep-time", type=float, default=0.2)
+    parser.add_argument("--virtual-time", action="store_true")
+    parser.add_argument("--output", default="benchmark_results/traces")
+    args = parser.parse_args(argv)
+
+    parameter = args.parameter
+    if parameter is None:
+        parameter = DEFAULT_KEY_SIZE if args.scheme == "partial" else DEFAULT_POLY_MODULUS_DEGREE
+
+    default_tracer.enable()
+    simulation = create_simulation(Cell(args.scheme, args.neighborhood, args.log_count, parameter, 0),
+                                   args.sleep_time, args.interval, args.virtual_time)
+    simulation.run()
+    simulation.end_run()
+
+    os.makedirs(args.output, exist_ok=True)
+    name = f"{args.scheme}_{args.neighborhood}_{args.log_count}"
+    trace_path = os.path.join(args.output, name + ".trace.json")
+    default_tracer.write_chrome_trace(trace_path)
+    for trace_id in default_tracer.trace_ids():
+        print(f"round {trace_id}")
+        print_waterfall(default_tracer.waterfall(trace_id))
+    with open(os.path.join(args.output, name + ".summary.json"), 'w') as f:
+        json.dump(default_tracer.summary(), f, indent=2)
+    print(f"trace written to {trace_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import time
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import traci
+    import traci.constants as tc
+except ImportError:
+    # only needed to ingest, sumo ships it in $SUMO_HOME/tools and pip has it as traci
+    traci = None
+
+from fcd import KMH_PER_MS, FcdTrace
+
+MODES = ["polling", "variable", "context"]
+
+
+class TraciMissingError(Exception):
+    def __init__(self):
+        self.message = "Ingesting over TraCI needs the traci package, pip install traci or add $SUMO_HOME/tools"
+        super().__init__(self.message)
+
+
+class TraciIngestion:
+    """
+    Turns the vehicles of a running TraCI simulation into traffic logs, step by step.
+
+    polling asks for the ids, then the speed and road of every vehicle, three round trips per vehicle per step like
+    BerlinSumo/sumo_sim.py. variable subscribes every vehicle to its speed and road once when it departs, and
+    context subscribes the vehicles around junction within radius once, so every step is a single round trip whose
+    answer carries all vehicles. The reports of a step are sent as one batch through simulation.send_sumo_traffic,
+    speeds in km/h; without a simulation they are only counted.
+    """
+
+    def __init__(self, connection, simulation=None, mode: str = "variable", junction: Optional[str] = None,
+                 radius: float = 1e6):
+        if traci is None:
+            raise TraciMissingError()
+        if mode not in MODES:
+            raise ValueError(f"unknown ingestion mode {mode}")
+        if mode == "context" and junction is None:
+            raise ValueError("a context subscription needs the junction to subscribe around")
+        self.connection = connection
+        self.simulation = simulation
+        self.mode = mode
+        self.junction = junction
+        self.radius = radius
+        self.steps = 0
+        self.reports = 0
+        self.skipped = 0
+        self.subscribed = False
+
+    def subscribe(self):
+        if self.mode == "polling":
+            return
+        # the expected vehicle count comes with every step instead of a round trip of its own
+        self.connection.simulation.subscribe([tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_MIN_EXPECTED_VEHICLES])
+        if self.mode == "context":
+            self.connection.junction.subscribeContext(self.junction, tc.CMD_GET_VEHICLE_VARIABLE, self.radius,
+                                                      [tc.VAR_SPEED, tc.VAR_ROAD_ID])
+
+    def poll(self) -> Dict[str, Dict[int, object]]:
+        vehicle = self.connection.vehicle
+        if self.mode == "polling":
+            return {vehicle_id: {tc.VAR_SPEED: vehicle.getSpeed(vehicle_id),
+                                 tc.VAR_ROAD_ID: vehicle.getRoadID(vehicle_id)} for vehicle_id in vehicle.getIDList()}
+        if self.mode == "context":
+            return self.connection.junction.getContextSubscriptionResults(self.junction) or {}
+        departed = self.connection.simulation.getSubscriptionResults().get(tc.VAR_DEPARTED_VEHICLES_IDS, ())
+        for vehicle_id in departed:
+            # the subscribe answer carries the values of this step already
+            vehicle.subscribe(vehicle_id, [tc.VAR_SPEED, tc.VAR_ROAD_ID])
+        return vehicle.getAllSubscriptionResults()
+
+    def batch(self, results: Dict[str, Dict[int, object]]) -> List[Tuple[str, int]]:
+        known = self.simulation.sumo_id_to_edge if self.simulation is not None else None
+        reports = []
+        for values in results.values():
+            edge = values.get(tc.VAR_ROAD_ID)
+            # vehicles inside junctions, not yet inserted or off the street graph
+            if not edge or edge.startswith(":") or (known is not None and edge not in known):
+                self.skipped += 1
+                continue
+            reports.append((edge, int(values.get(tc.VAR_SPEED, 0) * KMH_PER_MS)))
+        return reports
+
+    def expected(self) -> int:
+        if self.mode == "polling" or not self.subscribed:
+            return self.connection.simulation.getMinExpectedNumber()
+        return self.connection.simulation.getSubscriptionResults().get(tc.VAR_MIN_EXPECTED_VEHICLES, 0)
+
+    def step(self) -> int:
+        if not self.subscribed:
+            self.subscribe()
+            self.subscribed = True
+        self.connection.simulationStep()
+        reports = self.batch(self.poll())
+        if self.simulation is not None:
+            for edge, speed in reports:
+                self.simulation.send_sumo_traffic(edge, speed)
+        self.steps += 1
+        self.reports += len(reports)
+        return len(reports)
+
+    def run(self, max_steps: Optional[int] = None) -> int:
+        while self.expected() > 0:
+            if max_steps is not None and self.steps >= max_steps:
+                break
+            self.step()
+        return self.reports
+
+
+def benchmark_modes(trace: FcdTrace, modes: List[str], junction: str, max_steps: Optional[int] = None) -> Dict:
+    """Ingests the trace from a fake TraCI server once per mode and counts the round trips."""
+    from fake_traci import FakeTraciServer
+
+    results = {}
+    for mode in modes:
+        server = FakeTraciServer(trace)
+        server.start()
+        connection = traci.connect(server.port)
+        connection.getVersion()
+        ingestion = TraciIngestion(connection, mode=mode, junction=junction)
+        start = time.perf_counter()
+        ingestion.run(max_steps)
+        seconds = time.perf_counter() - start
+        connection.close()
+        server.stop()
+        results[mode] = {
+            "steps": ingestion.steps,
+            "reports": ingestion.reports,
+            "seconds": seconds,
+            "round_trips": server.messages,
+            "round_trips_per_step": server.messages / max(ingestion.steps, 1),
+            "reports_per_second": ingestion.reports / seconds if seconds else None,
+        }
+    return results
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Ingest vehicles over TraCI, from SUMO or from a fake server that "
+                                                 "replays an FCD trace, and compare the ingestion modes.")
+    parser.add_argument("--trace", default=None, help="FCD XML or .npz trace to serve with the fake TraCI server")
+    parser.add_argument("--port", type=int, default=None, help="port of a SUMO started with --remote-port instead")
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--junction", default="fake", help="junction the context subscription is around")
+    parser.add_argument("--steps", type=int, default=None, help="stop after this many steps")
+    args = parser.parse_args(argv)
+
+    if traci is None:
+        raise TraciMissingError()
+    if args.trace is not None:
+        trace = FcdTrace.load(args.trace)
+        print(trace)
+        for mode, result in benchmark_modes(trace, args.modes, args.junction, args.steps).items():
+            print(f"{mode:<8} {result['steps']} steps, {result['reports']} reports in {result['seconds']:.3f}s, "
+                  f"{result['round_trips_per_step']:.1f} round trips per step")
+        return
+    if args.port is None:
+        parser.error("pass --trace or --port")
+    connection = traci.connect(args.port)
+    connection.getVersion()
+    ingestion = TraciIngestion(connection, mode=args.modes[0], junction=args.junction)
+    start = time.perf_counter()
+    ingestion.run(args.steps)
+    print(f"{ingestion.steps} steps, {ingestion.reports} reports in {time.perf_counter() - start:.3f}s")
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 from hashlib import sha256
+from array import array
+import sys
 
 import base64
 
@@ -10,3 +12,40 @@ def b64_dec(data):
 
 def calc_edge_hash(edge: tuple) -> str:
     return sha256(str(edge).encode('utf-8')).hexdigest()
+
+def encode_edge_bitmap(ordinals, edge_count: int) -> str:
+    bitmap = bytearray((edge_count + 7) // 8)
+    for ordinal in ordinals:
+        bitmap[ordinal >> 3] |= 1 << (ordinal & 7)
+    return b64_enc(bytes(bitmap))
+
+def decode_edge_bitmap(bitmap: str) -> list:
+    ordinals = []
+    for byte_index, byte in enumerate(b64_dec(bitmap)):
+        while byte:
+            lowest_bit = byte & -byte
+            ordinals.append(byte_index * 8 + lowest_bit.bit_length() - 1)
+            byte ^= lowest_bit
+    return ordinals
+
+def pack_edge_ordinals(ordinals) -> str:
+    packed = array('I', ordinals)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return b64_enc(packed.tobytes())
+
+def unpack_edge_ordinals(packed: str) -> list:
+    ordinals = array('I')
+    ordinals.frombytes(b64_dec(packed))
+    if sys.byteorder != 'little':
+        ordinals.byteswap()
+    return ordinals.tolist()
+
+def encode_ordinal_traffic(traffic: dict, edge_ordinals: dict):
+    """Turn an edge keyed traffic map into packed edge ordinals and a parallel list of values."""
+    ordinals = [edge_ordinals[key] for key in traffic]
+    return pack_edge_ordinals(ordinals), list(traffic.values())
+
+def decode_ordinal_traffic(edges: str, values: list, edge_keys: list) -> dict:
+    """The inverse of encode_ordinal_traffic, edge_keys are the edges of the street_graph block in order."""
+    return {edge_keys[ordinal]: value for ordinal, value in zip(unpack_edge_ordinals(edges), values)}
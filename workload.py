@@ -0,0 +1,193 @@
+import math
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class RoadClass:
+    def __init__(self, name: str, mean_speed: float, speed_deviation: float, max_speed: int, share: float):
+        self.name = name
+        self.mean_speed = mean_speed
+        self.speed_deviation = speed_deviation
+        self.max_speed = max_speed
+        # the fraction of the edges of a neighborhood that belong to this class
+        self.share = share
+
+    def __str__(self):
+        return f"Road class {self.name} with speeds around {self.mean_speed}"
+
+
+DEFAULT_ROAD_CLASSES = [
+    RoadClass("residential", 30, 8, 50, 0.7),
+    RoadClass("arterial", 50, 12, 80, 0.2),
+    RoadClass("highway", 85, 15, 100, 0.1),
+]
+
+
+class CongestionEvent:
+    def __init__(self, edges: Sequence, start: float, end: float, speed_factor: float = 0.3):
+        # start and end are seconds of the day
+        self.edges = list(edges)
+        self.start = start
+        self.end = end
+        self.speed_factor = speed_factor
+
+    def __str__(self):
+        return f"Congestion on {len(self.edges)} edges from {self.start} to {self.end}"
+
+
+class RateCurve:
+    """Reports per second over the day, a base rate raised by the rush hour peaks."""
+
+    def __init__(self, base_rate: float, peaks: Sequence[Tuple[float, float, float]] = ((8, 1.5, 3), (17.5, 2, 3))):
+        self.base_rate = base_rate
+        # (hour of the peak, width in hours, multiplier at the top of the peak)
+        self.peaks = list(peaks)
+
+    def rate(self, seconds_of_day: np.ndarray) -> np.ndarray:
+        hours = (np.asarray(seconds_of_day, dtype=float) % SECONDS_PER_DAY) / 3600
+        factor = np.ones_like(hours)
+        for hour, width, multiplier in self.peaks:
+            factor += (multiplier - 1) * np.exp(-0.5 * ((hours - hour) / width) ** 2)
+        return self.base_rate * factor
+
+
+class WorkloadBatch:
+    def __init__(self, edges: List, edge_indices: np.ndarray, speeds: np.ndarray, timestamps: np.ndarray,
+                 vehicles: np.ndarray):
+        self.edges = edges
+        self.edge_indices = edge_indices
+        self.speeds = speeds
+        # seconds of the day
+        self.timestamps = timestamps
+        self.vehicles = vehicles
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self) -> Iterator[Tuple]:
+        for edge_index, speed, timestamp, vehicle in zip(self.edge_indices.tolist(), self.speeds.tolist(),
+                                                         self.timestamps.tolist(), self.vehicles.tolist()):
+            yield self.edges[edge_index], speed, timestamp, vehicle
+
+    def __str__(self):
+        return f"Workload batch with {len(self)} reports"
+
+
+class Workload:
+    """
+    Generates traffic reports for the edges of a neighborhood in vectorized batches.
+
+    Reports arrive as a Poisson process whose rate follows a RateCurve, edges are picked with Zipf-skewed popularity,
+    speeds follow the road class of the edge and congestion events slow their edges down while they last.
+    """
+
+    def __init__(self, edges: Sequence, seed: Optional[int] = None, base_rate: float = 100,
+                 rate_curve: Optional[RateCurve] = None, zipf_exponent: float = 1.0,
+                 road_classes: Optional[List[RoadClass]] = None, edge_road_classes: Optional[Dict] = None,
+                 events: Sequence[CongestionEvent] = (), fleet_size: int = 1000, start_time: float = 7 * 3600):
+        self.edges = list(edges)
+        self.rng = np.random.default_rng(seed)
+        self.rate_curve = rate_curve if rate_curve is not None else RateCurve(base_rate)
+        self.road_classes = road_classes if road_classes is not None else DEFAULT_ROAD_CLASSES
+        self.fleet_size = fleet_size
+        self.time = start_time
+        self.edge_index: Dict = {edge: index for index, edge in enumerate(self.edges)}
+
+        # the most popular edge is a random one, not the first of the graph
+        ranks = self.rng.permutation(len(self.edges)) + 1
+        weights = 1 / ranks.astype(float) ** zipf_exponent
+        self.edge_cdf = np.cumsum(weights / weights.sum())
+        self.edge_cdf[-1] = 1.0
+
+        class_names = [road_class.name for road_class in self.road_classes]
+        if edge_road_classes is not None:
+            classes = np.array([class_names.index(edge_road_classes[edge]) for edge in self.edges])
+        else:
+            shares = np.array([road_class.share for road_class in self.road_classes], dtype=float)
+            classes = self.rng.choice(len(self.road_classes), size=len(self.edges), p=shares / shares.sum())
+        self.edge_classes = classes
+        self.mean_speeds = np.array([road_class.mean_speed for road_class in self.road_classes], dtype=float)[classes]
+        self.speed_deviations = np.array([road_class.speed_deviation for road_class in self.road_classes],
+                                         dtype=float)[classes]
+        self.max_speeds = np.array([road_class.max_speed for road_class in self.road_classes])[classes]
+
+        self.events = [(np.array([self.edge_index[edge] for edge in event.edges], dtype=np.int64), event)
+                       for event in events]
+
+    def generate(self, duration: float) -> WorkloadBatch:
+        # one second bins, the rate is taken at the middle of every bin
+        bin_count = max(1, math.ceil(duration))
+        bin_starts = self.time + np.arange(bin_count, dtype=float)
+        bin_lengths = np.minimum(1.0, duration - np.arange(bin_count)) if duration > 0 else np.zeros(1)
+        counts = self.rng.poisson(self.rate_curve.rate(bin_starts + bin_lengths / 2) * bin_lengths)
+        total = int(counts.sum())
+        # sorted because stream paces the reports by their timestamps, the fields below are drawn in that order
+        timestamps = np.sort(np.repeat(bin_starts, counts) + self.rng.random(total) * np.repeat(bin_lengths, counts))
+        self.time += duration
+
+        edge_indices = np.searchsorted(self.edge_cdf, self.rng.random(total), side='right')
+        speeds = self.rng.normal(self.mean_speeds[edge_indices], self.speed_deviations[edge_indices])
+        for event_edges, event in self.events:
+            congested = np.isin(edge_indices, event_edges) & (timestamps >= event.start) & (timestamps < event.end)
+            speeds[congested] *= event.speed_factor
+        speeds = np.clip(np.rint(speeds), 1, self.max_speeds[edge_indices]).astype(np.int64)
+        vehicles = self.rng.integers(self.fleet_size, size=total)
+        return WorkloadBatch(self.edges, edge_indices, speeds, timestamps, vehicles)
+
+    def generate_count(self, count: int) -> WorkloadBatch:
+        if count <= 0:
+            # a round without reports
+            return WorkloadBatch(self.edges, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0),
+                                 np.zeros(0, dtype=np.int64))
+        # keeps drawing a little more than the expected duration until there are count reports
+        parts: List[WorkloadBatch] = []
+        total = 0
+        while total < count:
+            rate = float(self.rate_curve.rate(np.array([self.time]))[0])
+            part = self.generate(max(1.0, 1.1 * (count - total) / rate))
+            parts.append(part)
+            total += len(part)
+        batch = WorkloadBatch(self.edges, *(np.concatenate([getattr(part, field) for part in parts])[:count]
+                                            for field in ("edge_indices", "speeds", "timestamps", "vehicles")))
+        if count < total:
+            # the reports that were cut off are not in the past of the workload
+            self.time = float(batch.timestamps[-1])
+        return batch
+
+    def batches(self, duration: float, batch_duration: float = 60) -> Iterator[WorkloadBatch]:
+        remaining = duration
+        while remaining > 0:
+            part = min(batch_duration, remaining)
+            yield self.generate(part)
+            remaining -= part
+
+    def stream(self, simulation, batch: WorkloadBatch, speedup: float = 1.0, rate: Optional[float] = None,
+               tick: float = 0.05) -> int:
+        """
+        Sends the reports of a batch through simulation.send_traffic_log, paced on the clock of the simulation.
+        The reports keep their own spacing, sped up by speedup, unless a fixed rate in reports per second is given.
+        """
+        if len(batch) == 0:
+            return 0
+        if rate is not None:
+            send_times = np.arange(len(batch)) / rate
+        else:
+            send_times = (batch.timestamps - batch.timestamps[0]) / speedup
+        edges = batch.edges
+        edge_indices = batch.edge_indices.tolist()
+        speeds = batch.speeds.tolist()
+        clock = simulation.clock
+        start = clock.now()
+        sent = 0
+        while sent < len(batch):
+            elapsed = (clock.now() - start).total_seconds()
+            due = int(np.searchsorted(send_times, elapsed, side='right'))
+            for index in range(sent, due):
+                simulation.send_traffic_log(edges[edge_indices[index]], speeds[index])
+            sent = max(sent, due)
+            if sent < len(batch):
+                clock.sleep(min(tick, float(send_times[sent]) - elapsed))
+        return sent